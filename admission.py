@@ -0,0 +1,246 @@
+# admission.py
+"""
+Admission control and priority load shedding for the app's routes.
+
+Requests are sorted into route classes. Interactive ones (pages, login)
+never call TikTok and are always let in. The others compete for
+`limit` concurrent slots per worker, in priority order:
+
+    create  (POST creates)        may use the whole limit
+    read    (list/search reads)   may start while < 80% of it is in use
+    poll    (task status polls)   may start while < 50% of it is in use
+    long    (campaigns, re-syncs) may start while < 25% of it is in use
+
+so background polling can never take the slots an interactive create
+needs, and requests that hold a slot for minutes never take most of them.
+A request that cannot start right away waits in a priority queue
+(highest class first, FIFO within a class) up to its class deadline. If
+the wait it can expect - the time it already spent in front of the app
+(X-Request-Start, set by Heroku's router and most proxies) plus the queue
+ahead of it - would miss that deadline, it gets an immediate 503 with a
+Retry-After instead of occupying a worker until it times out.
+
+The limit adapts to TikTok's latency (gradient + AIMD), once per
+`update_interval`: while recent upstream latency stays near its
+long-term average and the limit is in use, it grows by about
+sqrt(limit); as latency rises above `tolerance` times the average it
+shrinks in proportion, and an interval in which at least `failure_ratio`
+of the calls failed or were throttled cuts it by `backoff`.
+"""
+import math
+import threading
+import time
+
+from flask import g, jsonify, request
+
+# class -> (priority, share of the limit it may start within, queue deadline in seconds)
+ROUTE_CLASSES = {
+    "interactive": (0, None, 10.0),
+    "create": (1, 1.0, 10.0),
+    "read": (2, 0.8, 5.0),
+    "poll": (3, 0.5, 2.0),
+    "long": (4, 0.25, 10.0),
+}
+
+
+def queued_for(header, now=None):
+    """Seconds spent in front of the app according to an X-Request-Start header (0 if absent/garbled)."""
+    if not header:
+        return 0.0
+    try:
+        started = float(header.strip().removeprefix("t="))
+    except ValueError:
+        return 0.0
+    # Routers send seconds, milliseconds or microseconds since the epoch
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+    return max(0.0, (now or time.time()) - started)
+
+
+class _Ticket:
+    __slots__ = ("route_class", "started")
+
+    def __init__(self, route_class):
+        self.route_class = route_class
+        self.started = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(self, limit=20, min_limit=2, max_limit=200, max_queue=100, deadlines=None,
+                 tolerance=1.5, smoothing=0.2, backoff=0.9, failure_ratio=0.1, update_interval=1.0):
+        self.limit = float(limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.deadlines = {name: deadline for name, (_, _, deadline) in ROUTE_CLASSES.items()}
+        self.deadlines.update(deadlines or {})
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.failure_ratio = failure_ratio
+        self.update_interval = update_interval
+
+        self._cond = threading.Condition()
+        self._in_flight = {name: 0 for name in ROUTE_CLASSES}
+        self._waiting = {name: [] for name in ROUTE_CLASSES}  # FIFO of waiter ids per class
+        self._seq = 0
+        self._service_time = {name: 0.5 for name in ROUTE_CLASSES}  # EWMA seconds per admitted request
+        self._short_rtt = None  # fast EWMA of upstream latency
+        self._long_rtt = None   # slow EWMA of upstream latency
+        self._window_calls = 0
+        self._window_failures = 0
+        self._updated_at = 0.0
+        self._counters = {"admitted": 0, "queued": 0, "shed": 0, "timed_out": 0}
+        self._shed_by_class = {name: 0 for name in ROUTE_CLASSES}
+
+    # --- admission ---
+
+    def _limited_in_flight(self):
+        return sum(count for name, count in self._in_flight.items() if ROUTE_CLASSES[name][1] is not None)
+
+    def _has_slot(self, route_class):
+        share = ROUTE_CLASSES[route_class][1]
+        return share is None or self._limited_in_flight() < max(1.0, self.limit * share)
+
+    def _is_next(self, route_class, waiter):
+        """Whether `waiter` is first in line: first of its class and no higher class waiting."""
+        priority = ROUTE_CLASSES[route_class][0]
+        for name, queue in self._waiting.items():
+            if queue and ROUTE_CLASSES[name][0] < priority:
+                return False
+        return self._waiting[route_class][0] == waiter
+
+    def _waiting_ahead(self, route_class):
+        priority = ROUTE_CLASSES[route_class][0]
+        return sum(len(queue) for name, queue in self._waiting.items() if ROUTE_CLASSES[name][0] <= priority)
+
+    def _expected_wait(self, route_class):
+        share = ROUTE_CLASSES[route_class][1] or 1.0
+        return (self._waiting_ahead(route_class) + 1) * self._service_time[route_class] / max(1.0, self.limit * share)
+
+    def admit(self, route_class, already_queued=0.0):
+        """
+        Try to start a request of `route_class`. Returns (ticket, None) once it
+        may run, or (None, retry_after_seconds) when it should be shed.
+        """
+        deadline = self.deadlines[route_class] - already_queued
+        with self._cond:
+            if deadline <= 0:
+                return None, self._shed(route_class, 1.0)
+            if self._has_slot(route_class) and not self._waiting_ahead(route_class):
+                return self._start(route_class), None
+
+            expected = self._expected_wait(route_class)
+            if expected > deadline or sum(len(q) for q in self._waiting.values()) >= self.max_queue:
+                return None, self._shed(route_class, expected)
+
+            self._seq += 1
+            waiter = self._seq
+            queue = self._waiting[route_class]
+            queue.append(waiter)
+            self._counters["queued"] += 1
+            give_up = time.monotonic() + deadline
+            try:
+                while not (self._is_next(route_class, waiter) and self._has_slot(route_class)):
+                    remaining = give_up - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timed_out"] += 1
+                        return None, self._shed(route_class, self._expected_wait(route_class))
+                    self._cond.wait(remaining)
+            finally:
+                queue.remove(waiter)
+                # Whoever is behind this waiter may be able to go now
+                self._cond.notify_all()
+            return self._start(route_class), None
+
+    def _start(self, route_class):
+        self._in_flight[route_class] += 1
+        self._counters["admitted"] += 1
+        return _Ticket(route_class)
+
+    def _shed(self, route_class, expected_wait):
+        self._counters["shed"] += 1
+        self._shed_by_class[route_class] += 1
+        return max(1, min(30, math.ceil(expected_wait)))
+
+    def release(self, ticket):
+        duration = time.monotonic() - ticket.started
+        with self._cond:
+            self._in_flight[ticket.route_class] -= 1
+            previous = self._service_time[ticket.route_class]
+            self._service_time[ticket.route_class] = previous + 0.1 * (duration - previous)
+            self._cond.notify_all()
+
+    # --- adaptive limit ---
+
+    def observe_upstream(self, seconds, failed):
+        """Feed one TikTok call's latency (and whether it failed or was throttled) into the limit."""
+        with self._cond:
+            self._window_calls += 1
+            if failed:
+                self._window_failures += 1
+            elif self._short_rtt is None:
+                self._short_rtt = self._long_rtt = seconds
+            else:
+                self._short_rtt += 0.2 * (seconds - self._short_rtt)
+                self._long_rtt += 0.01 * (seconds - self._long_rtt)
+            now = time.monotonic()
+            if now - self._updated_at >= self.update_interval:
+                self._updated_at = now
+                self._update_limit()
+
+    def _update_limit(self):
+        """Adjust the limit once per update_interval from what was observed since the last update."""
+        calls, failures = self._window_calls, self._window_failures
+        self._window_calls = self._window_failures = 0
+        if calls and failures / calls >= self.failure_ratio:
+            new_limit = self.limit * self.backoff
+        elif self._short_rtt is None:
+            return
+        else:
+            gradient = max(0.5, min(1.0, self.tolerance * self._long_rtt / self._short_rtt))
+            new_limit = self.limit * gradient
+            # Only grow while the limit is actually being used
+            if gradient == 1.0 and self._limited_in_flight() >= self.limit / 2:
+                new_limit += math.sqrt(self.limit)
+            new_limit = self.limit + self.smoothing * (new_limit - self.limit)
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+        self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "limit": round(self.limit, 2),
+                "in_flight": dict(self._in_flight),
+                "waiting": {name: len(queue) for name, queue in self._waiting.items()},
+                "shed_by_class": dict(self._shed_by_class),
+                "upstream_rtt_ms": {
+                    "short": round(self._short_rtt * 1000, 1) if self._short_rtt is not None else None,
+                    "long": round(self._long_rtt * 1000, 1) if self._long_rtt is not None else None,
+                },
+                **self._counters,
+            }
+
+    def init_app(self, app, classify):
+        """Admit every request `classify(request)` puts in a class (None = not controlled)."""
+        @app.before_request
+        def _admit():
+            route_class = classify(request)
+            if route_class is None:
+                return None
+            ticket, retry_after = self.admit(route_class, queued_for(request.headers.get("X-Request-Start")))
+            if ticket is None:
+                response = jsonify({"error": "Server is busy, please retry shortly", "retry_after": retry_after})
+                response.status_code = 503
+                response.headers["Retry-After"] = str(retry_after)
+                return response
+            g.admission_ticket = ticket
+            return None
+
+        @app.teardown_request
+        def _release(exc):
+            ticket = g.pop("admission_ticket", None)
+            if ticket is not None:
+                self.release(ticket)
@@ -1,18 +1,62 @@
 # app.py
 import os
+import time
 import requests
-from flask import Flask, request, jsonify, send_from_directory, session, redirect, url_for, render_template_string
+from flask import Flask, Response, g, make_response, request, jsonify, send_file, send_from_directory, session, redirect, url_for, stream_with_context
 from flask_cors import CORS
 from functools import wraps
 from dotenv import load_dotenv
+import logging
+import mimetypes
+import metrics
+import structured_logging
+import tracing
+from compression import Compressor, accepted_encodings
+from tiktok_client import TIKTOK_BASE, TikTokClient, fast_json, never_sent
+from task_tracker import TaskTracker
+from response_cache import ResponseCache
+from singleflight import SingleFlight
+from script_store import ScriptStore
+from script_index import ScriptIndex, text_key
+from asset_index import AssetIndex
+from video_info import VideoInfoLookup
+from rate_limiter import THROTTLE_CODES, RateLimiter
+from circuit_breaker import CircuitBreakers
+from idempotency import IdempotencyStore, request_hash
+from bulk_jobs import BulkJobRunner, ManifestError, parse_manifest
+from admission import AdmissionController
+from script_campaigns import CampaignRunner
+from video_uploads import MODES as UPLOAD_MODES, VideoUploader
+from media_cache import KINDS as MEDIA_KINDS, MediaCache, media_key
+from url_guard import DEFAULT_MEDIA_HOSTS, URLGuard
+import build_static
 
 # Load environment variables
 load_dotenv()
 
-TIKTOK_BASE = "https://business-api.tiktok.com/open_api/v1.3"
+structured_logging.setup_logging(
+    level=os.getenv('LOG_LEVEL', 'INFO'),
+    log_file=os.getenv('LOG_FILE') or None,
+    body_sample_rate=float(os.getenv('LOG_BODY_SAMPLE_RATE', '0.01')),
+    max_field_chars=int(os.getenv('LOG_MAX_FIELD_CHARS', '2000')),
+)
+log = logging.getLogger("app")
 
 app = Flask(__name__, static_url_path="", static_folder="static")
+# Span timings per request: Server-Timing header, slow-request buffer, on-demand cProfile.
+# Set up first so the trace covers every other hook.
+tracer = tracing.Tracer(
+    slow_ms=float(os.getenv('TRACE_SLOW_MS', '500')),
+    keep=int(os.getenv('TRACE_KEEP', '100')),
+    header=os.getenv('TRACE_SERVER_TIMING', 'True').lower() in ('1', 'true', 'yes'),
+)
+tracer.init_app(app)
 CORS(app, supports_credentials=True)
+metrics.init_app(app)
+structured_logging.init_app(app)
+# gzip/brotli + strong ETags / 304s for JSON and page responses
+compressor = Compressor(min_size=int(os.getenv('COMPRESS_MIN_BYTES', '1024')))
+compressor.init_app(app)
 app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-here-change-this')
 
 # Get auth credentials and API settings from environment
@@ -20,12 +64,234 @@ AUTH_USERNAME = os.getenv('AUTH_USERNAME', 'admin')
 AUTH_PASSWORD = os.getenv('AUTH_PASSWORD', 'password')
 TIKTOK_ACCESS_TOKEN = os.getenv('TIKTOK_ACCESS_TOKEN', '')
 TIKTOK_ADVERTISER_ID = os.getenv('TIKTOK_ADVERTISER_ID', '')
-
-def tt_headers(access_token: str, content_type="application/json"):
-    return {
-        "Access-Token": access_token,
-        "Content-Type": content_type
-    }
+# Streams are closed after this long; EventSource reconnects on its own.
+# Keep it under the gunicorn worker timeout for sync workers.
+STREAM_MAX_SECONDS = int(os.getenv('STREAM_MAX_SECONDS', '90'))
+# Local state shared by the workers on this host (caches, indexes)
+DATA_DIR = os.getenv('DATA_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+# (ttl, stale window) in seconds for cached catalog/list endpoints
+CACHE_TTLS = {
+    "/creative/digital_avatar/get/": (3600, 86400),
+    "/creative/aigc/script/list/": (30, 300),
+    "/creative/digital_avatar/video/list/": (30, 300),
+    "/file/video/ad/search/": (120, 600),
+}
+# Minimum seconds between background syncs of the local script library
+SCRIPT_SYNC_INTERVAL = int(os.getenv('SCRIPT_SYNC_INTERVAL', '60'))
+# Minimum seconds between background refreshes of the asset library index
+ASSET_REFRESH_INTERVAL = int(os.getenv('ASSET_REFRESH_INTERVAL', '300'))
+
+# Identical concurrent TikTok GETs share one upstream call (optionally across workers)
+singleflight = SingleFlight(
+    lock_dir=os.path.join(DATA_DIR, 'singleflight'),
+    shared=os.getenv('SINGLEFLIGHT_SHARED', 'False').lower() in ('1', 'true', 'yes'),
+)
+# Outbound token buckets per access token and endpoint family, shared across workers
+rate_limiter = RateLimiter(
+    os.path.join(DATA_DIR, 'ratelimit.sqlite3'),
+    rate=float(os.getenv('TIKTOK_RATE_LIMIT', '10')),
+    max_wait=float(os.getenv('TIKTOK_RATE_MAX_WAIT', '10')),
+)
+# Per endpoint family: stop calling TikTok for a while once most recent calls fail or crawl
+breakers = CircuitBreakers(
+    failure_ratio=float(os.getenv('BREAKER_FAILURE_RATIO', '0.5')),
+    slow_call_seconds=float(os.getenv('BREAKER_SLOW_SECONDS', '10')),
+    open_seconds=float(os.getenv('BREAKER_OPEN_SECONDS', '15')),
+)
+# Latency-sensitive reads that may be hedged with a second attempt after their p95
+HEDGED_PATHS = (
+    "/creative/aigc/script/task/get/",
+    "/creative/digital_avatar/video/task/get/",
+    "/creative/digital_avatar/get/",
+)
+
+# Per-worker concurrency limit for routes that call TikTok, adapted to its latency.
+# Polls give way to reads, reads to creates; pages are never held back.
+admission = AdmissionController(
+    limit=int(os.getenv('ADMISSION_LIMIT', '20')),
+    min_limit=1,
+    max_limit=int(os.getenv('ADMISSION_MAX_LIMIT', '100')),
+    # A sync worker's queued requests each hold a thread; keep half of them free for pages
+    max_queue=int(os.getenv('ADMISSION_MAX_QUEUE') or (
+        100 if os.getenv('WORKER_MODE', 'sync').lower() == 'async' else max(1, int(os.getenv('GUNICORN_THREADS', '1')) // 2)
+    )),
+)
+# endpoint -> admission class; other GETs are "read", other POSTs "create"
+ROUTE_CLASSES = {
+    "login": "interactive",
+    "logout": "interactive",
+    "home": "interactive",
+    "script_generator": "interactive",
+    "avatar": "interactive",
+    "get_config": "interactive",
+    "task_status": "poll",
+    "get_avatar_video_task_status": "poll",
+    "get_bulk_avatar_job": "poll",
+    "list_bulk_avatar_job_items": "poll",
+    "get_video_info": "read",
+    "get_video_upload": "poll",
+    # POSTs that call TikTok for as long as they run
+    "create_script_campaign": "long",
+    "sync_scripts": "long",
+    "refresh_assets_index": "long",
+}
+# Not admission controlled: cheap local answers and the long-lived task stream
+ADMISSION_EXEMPT = {"static", "static_asset", "prometheus_metrics", "upstream_stats", "stream_tasks", "cached_media",
+                    "slow_requests", "arm_profile", "get_profile"}
+
+def admission_class(req):
+    if req.endpoint is None or req.endpoint in ADMISSION_EXEMPT:
+        return None
+    return ROUTE_CLASSES.get(req.endpoint) or ("read" if req.method in ("GET", "HEAD") else "create")
+
+if os.getenv('ADMISSION_CONTROL', 'True').lower() in ('1', 'true', 'yes'):
+    admission.init_app(app, admission_class)
+
+LONG_TRANSFER_PATHS = {"/file/video/ad/upload/"}
+
+def on_upstream_response(method, path, seconds, status_code, code, error):
+    """Record every TikTok call; refresh this worker's pool gauges at most once a second."""
+    metrics.observe_upstream(method, path, seconds, status_code, code, error)
+    tracing.record("tiktok", seconds, path=path, status=status_code, code=code, error=error)
+    metrics.update_pool(tiktok, min_interval=1.0)
+    # A video upload takes as long as the file is big; it says nothing about TikTok's latency
+    if path not in LONG_TRANSFER_PATHS:
+        admission.observe_upstream(seconds, bool(error) or (status_code or 0) >= 500 or str(code) in THROTTLE_CODES)
+
+# One pooled TikTok API client per worker process
+tiktok = TikTokClient(
+    base_url=os.getenv('TIKTOK_BASE_URL', TIKTOK_BASE),
+    singleflight=singleflight,
+    rate_limiter=rate_limiter,
+    breakers=breakers,
+    hedge_paths=HEDGED_PATHS if os.getenv('TIKTOK_HEDGE_READS', 'False').lower() in ('1', 'true', 'yes') else (),
+    on_response=on_upstream_response,
+)
+# Response cache for catalog-style endpoints, shared across workers
+response_cache = ResponseCache(
+    os.path.join(DATA_DIR, 'response_cache.sqlite3'),
+    max_bytes=int(os.getenv('CACHE_MAX_MB', '64')) * 1024 * 1024,
+)
+
+# MinHash near-duplicate index over the script library and already rendered scripts (needs numpy)
+script_index = ScriptIndex(
+    os.path.join(DATA_DIR, 'script_index.sqlite3'),
+    threshold=float(os.getenv('SCRIPT_DUPLICATE_THRESHOLD', '0.8')),
+)
+# How create_avatar_video_task treats near-duplicate scripts by default: off, flag or drop
+SCRIPT_DUPLICATE_CHECK = os.getenv('SCRIPT_DUPLICATE_CHECK', 'off').lower()
+
+def index_new_scripts(access_token, scripts):
+    if script_index.available:
+        script_index.add(access_token, "library", [(item.get("script_id"), item.get("script")) for item in scripts])
+
+# Local mirror of the generated-script library with full-text search
+script_store = ScriptStore(os.path.join(DATA_DIR, 'scripts.sqlite3'), on_added=index_new_scripts)
+
+def backfill_script_index(access_token):
+    """Index scripts stored before the near-duplicate index existed (once per token)."""
+    if script_index.count(access_token, "library") == 0:
+        script_index.add(access_token, "library", script_store.all_scripts(access_token))
+
+# Per-video metadata cache in front of /file/video/ad/info/
+video_info = VideoInfoLookup(
+    os.path.join(DATA_DIR, 'video_info.sqlite3'),
+    ttl=int(os.getenv('VIDEO_INFO_TTL', '3600')),
+)
+# Local index of each advertiser's video asset library
+asset_index = AssetIndex(
+    os.path.join(DATA_DIR, 'assets.sqlite3'),
+    concurrency=int(os.getenv('ASSET_CRAWL_CONCURRENCY', '4')),
+)
+
+def on_task_done(kind: str, access_token: str, task):
+    """A finished task adds entries to the matching list; drop the cached pages."""
+    if kind == "script":
+        response_cache.invalidate("/creative/aigc/script/list/", access_token)
+        script_store.add_scripts(access_token, (task.result or {}).get("list") or [], task_id=task.task_id)
+    else:
+        response_cache.invalidate("/creative/digital_avatar/video/list/", access_token)
+
+# Stored responses of create calls, replayed for repeated Idempotency-Keys
+idempotency = IdempotencyStore(os.path.join(DATA_DIR, 'idempotency.sqlite3'))
+
+# Task status store shared by all workers; one worker at a time polls TikTok for all open tabs
+task_tracker = TaskTracker(
+    os.path.join(DATA_DIR, 'task_tracker.sqlite3'),
+    tiktok,
+    default_token=TIKTOK_ACCESS_TOKEN,
+    poll_concurrency=int(os.getenv('TASK_POLL_CONCURRENCY', '4')),
+    on_done=on_task_done,
+)
+# Fan-out of many script-generation tasks per request
+campaign_runner = CampaignRunner(tiktok, task_tracker, concurrency=int(os.getenv('CAMPAIGN_CONCURRENCY', '5')))
+CAMPAIGN_MAX_ITEMS = int(os.getenv('CAMPAIGN_MAX_ITEMS', '100'))
+# Durable bulk avatar-video jobs; every worker runs (and resumes) leased jobs
+bulk_runner = BulkJobRunner(
+    os.path.join(DATA_DIR, 'bulk_jobs.sqlite3'),
+    tiktok,
+    task_tracker,
+    default_token=TIKTOK_ACCESS_TOKEN,
+    batch_size=int(os.getenv('BULK_BATCH_SIZE', '10')),
+    submit_interval=float(os.getenv('BULK_SUBMIT_INTERVAL', '2')),
+)
+bulk_runner.start()
+
+def on_video_uploaded(access_token: str, advertiser_id: str, video_id):
+    """A new video is in the advertiser's library; drop the cached search pages."""
+    response_cache.invalidate("/file/video/ad/search/", access_token)
+
+# Media URLs the server fetches for clients: TikTok CDN hosts (or MEDIA_CACHE_HOSTS) resolving to public addresses
+media_guard = URLGuard(
+    allowed_hosts=[h.strip() for h in os.getenv('MEDIA_CACHE_HOSTS', '').split(',') if h.strip()] or DEFAULT_MEDIA_HOSTS,
+    allow_private=os.getenv('MEDIA_ALLOW_PRIVATE', 'False').lower() in ('1', 'true', 'yes'),
+)
+
+# Background transfers of finished videos into the Ads library, streamed through disk
+video_uploader = VideoUploader(
+    os.path.join(DATA_DIR, 'video_uploads.sqlite3'),
+    tiktok,
+    spool_dir=os.path.join(DATA_DIR, 'upload_spool'),
+    concurrency=int(os.getenv('UPLOAD_CONCURRENCY', '3')),
+    max_bytes=int(os.getenv('UPLOAD_MAX_MB', '500')) * 1024 * 1024,
+    guard=media_guard,
+    on_uploaded=on_video_uploaded,
+)
+UPLOAD_MODE = os.getenv('UPLOAD_MODE', 'auto').lower()
+
+# Finished videos, covers and avatar images cached on local disk (LRU, size-capped)
+media_cache = MediaCache(
+    os.path.join(DATA_DIR, 'media'),
+    max_bytes=int(os.getenv('MEDIA_CACHE_MAX_MB', '2048')) * 1024 * 1024,
+    concurrency=int(os.getenv('MEDIA_CACHE_CONCURRENCY', '8')),
+    thumb_width=int(os.getenv('MEDIA_THUMB_WIDTH', '320')),
+    guard=media_guard,
+)
+# How long an image miss may wait for its download before the browser is sent to the source
+MEDIA_CACHE_WAIT = float(os.getenv('MEDIA_CACHE_WAIT', '3'))
+
+def relay(r, stream=False):
+    """
+    Pass a TikTok response through unchanged: same status, content type and
+    bytes, never parsed and re-serialized. With stream=True (for responses
+    requested with stream=True) the body is forwarded in chunks as it arrives.
+    """
+    content_type = r.headers.get("Content-Type", "application/json")
+    body = r.iter_content(64 * 1024) if stream else r.content
+    return Response(body, status=r.status_code, content_type=content_type)
+
+def cached_get(path: str, access_token: str, params: dict):
+    """GET a catalog endpoint through the shared response cache and relay the body unchanged."""
+    def fetch():
+        r = tiktok.get(path, access_token, params=params)
+        return r.content, r.status_code
+
+    ttl, stale_ttl = CACHE_TTLS[path]
+    with tracing.span("cache", path=path):
+        body, status_code, state = response_cache.get_or_fetch(path, access_token, params, fetch, ttl, stale_ttl)
+    metrics.CACHE_LOOKUPS.labels(path, state).inc()
+    return Response(body, status=status_code, mimetype="application/json", headers={"X-Cache": state})
 
 # Login HTML template
 LOGIN_HTML = '''
@@ -144,14 +410,89 @@ LOGIN_HTML = '''
 </html>
 '''
 
+# Compiled once; the plain GET page never changes so it is rendered once too
+LOGIN_TEMPLATE = app.jinja_env.from_string(LOGIN_HTML)
+LOGIN_PAGE = LOGIN_TEMPLATE.render()
+
+# Page shells with their CSS/JS moved out to fingerprinted /assets/ files.
+# If the build cannot be written the pages are served as-is from static/.
+try:
+    BUILT_PAGES = build_static.build_if_stale()["pages"]
+except OSError as e:
+    log.warning("Static build failed; serving unbuilt pages", extra={"error": str(e)})
+    BUILT_PAGES = {}
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if 'logged_in' not in session:
+        with tracing.span("auth"):
+            logged_in = 'logged_in' in session
+        if not logged_in:
             return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    """Operator-only routes: a logged-in session, or "Authorization: Bearer <ADMIN_TOKEN>" once ADMIN_TOKEN is set."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        token = os.getenv('ADMIN_TOKEN', '')
+        if token:
+            if request.headers.get("Authorization", "") != f"Bearer {token}":
+                return jsonify({"error": "Unauthorized"}), 401
+        elif 'logged_in' not in session:
+            return jsonify({"error": "Unauthorized"}), 401
+        return f(*args, **kwargs)
+    return decorated_function
+
+def idempotent(endpoint: str):
+    """
+    Honour an Idempotency-Key header (or "idempotency_key" body field) on a
+    task-creating route: the first response is stored and returned again for
+    repeats of the same key, so a retried create never starts a second task.
+    Only a failure the route marked with note_send_failure() as certainly not
+    sent to TikTok frees the key; any other error is stored like a success,
+    since the task may exist upstream.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            data = request.get_json(force=True, silent=True) or {}
+            key = (request.headers.get("Idempotency-Key") or str(data.get("idempotency_key") or "")).strip()
+            if not key:
+                return f(*args, **kwargs)
+            if len(key) > 255:
+                return jsonify({"error": "Idempotency-Key must be at most 255 characters"}), 400
+
+            access_token = (data.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+            state, stored = idempotency.begin(access_token, endpoint, key, request_hash(data))
+            if state == "conflict":
+                return jsonify({"error": "Idempotency-Key was already used with a different request body"}), 422
+            if state == "in_progress":
+                return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409, {"Retry-After": "1"}
+            if state == "done":
+                body, status_code = stored
+                return Response(body, status=status_code, mimetype="application/json",
+                                headers={"Idempotent-Replayed": "true"})
+
+            try:
+                response = make_response(f(*args, **kwargs))
+            except Exception:
+                # Unknown how far the create got; answer the same for every retry of the key
+                log.exception("Idempotent create failed", extra={"endpoint": endpoint})
+                response = make_response(jsonify({"error": "Internal error; the task may have been created"}), 500)
+            if response.status_code >= 500 and g.get("create_never_sent"):
+                idempotency.release(access_token, endpoint, key)
+            else:
+                idempotency.finish(access_token, endpoint, key, response.get_data(), response.status_code)
+            return response
+        return decorated_function
+    return decorator
+
+def note_send_failure(error):
+    """Tell @idempotent whether the create that raised `error` certainly never reached TikTok."""
+    g.create_never_sent = never_sent(error)
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -167,31 +508,103 @@ def login():
         else:
             if request.is_json:
                 return jsonify({"success": False, "message": "Invalid credentials"}), 401
-            return render_template_string(LOGIN_HTML, error="Invalid username or password")
+            return LOGIN_TEMPLATE.render(error="Invalid username or password")
 
-    return render_template_string(LOGIN_HTML)
+    return LOGIN_PAGE
 
 @app.route('/logout')
 def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+def send_page(name, directory):
+    """The built shell for a page if there is one, else its source with everything inline"""
+    shell = BUILT_PAGES.get(name)
+    if shell:
+        return send_from_directory(os.path.dirname(shell), os.path.basename(shell))
+    return send_from_directory(directory, "index.html")
+
 @app.route("/")
 @login_required
 def home():
-    return send_from_directory("static", "index.html")
+    return send_page("index", "static")
 
 @app.route("/script_generator")
 @app.route("/script_generator/")
 @login_required
 def script_generator():
-    return send_from_directory("static/script_generator", "index.html")
+    return send_page("script_generator", "static/script_generator")
 
 @app.route("/avatar")
 @app.route("/avatar/")
 @login_required
 def avatar():
-    return send_from_directory("static/avatar", "index.html")
+    return send_page("avatar", "static/avatar")
+
+@app.get("/assets/<path:filename>")
+def static_asset(filename):
+    """Content-hashed CSS/JS from the static build, precompressed and cacheable forever"""
+    assets_dir = os.path.join(build_static.BUILD_DIR, "assets")
+    suffixes = {"br": ".br", "gzip": ".gz"}
+    for encoding in accepted_encodings(request.headers.get("Accept-Encoding", "")):
+        variant = filename + suffixes[encoding]
+        if os.path.isfile(os.path.join(assets_dir, variant)):
+            response = send_from_directory(assets_dir, variant, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers["Content-Encoding"] = encoding
+            break
+    else:
+        response = send_from_directory(assets_dir, filename)
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+@app.get("/api/media")
+@login_required
+def cached_media():
+    """
+    A video, cover or avatar image served from the local media cache.
+    Query params:
+      url=https://... (the short-lived URL TikTok returned)
+      kind=image | video
+      thumb=1 (optional, images: the downscaled thumbnail)
+    A miss starts the download in the background; images wait up to
+    MEDIA_CACHE_WAIT seconds for it, otherwise the browser is redirected
+    to the source this time (only ever an allowed media host).
+    """
+    url = (request.args.get("url") or "").strip()
+    kind = request.args.get("kind", "image")
+    thumb = request.args.get("thumb", "").lower() in ("1", "true", "yes")
+
+    if kind not in MEDIA_KINDS:
+        return jsonify({"error": f"kind must be one of {', '.join(MEDIA_KINDS)}"}), 400
+    if not media_cache.allowed(url):
+        return jsonify({"error": "url is not an allowed media URL"}), 400
+
+    key = media_key(kind, url)
+    state = "HIT"
+    entry = media_cache.lookup(key, thumb=thumb)
+    if entry is None:
+        state = "MISS"
+        done = media_cache.fetch(key, kind, url)
+        if kind == "image" and done.wait(MEDIA_CACHE_WAIT):
+            entry = media_cache.lookup(key, thumb=thumb)
+    if entry is not None:
+        path, content_type = entry
+        try:
+            response = send_file(path, mimetype=content_type, conditional=True, max_age=86400)
+        except FileNotFoundError:  # evicted in the meantime
+            entry = None
+        else:
+            response.headers["X-Content-Type-Options"] = "nosniff"
+            response.headers["Content-Disposition"] = "inline"
+    if entry is None:
+        response = redirect(url)
+        response.headers["Cache-Control"] = "no-store"
+    else:
+        response.cache_control.public = False
+        response.cache_control.private = True
+    response.headers["X-Cache"] = state
+    return response
 
 @app.route('/api/get_config')
 @login_required
@@ -202,50 +615,105 @@ def get_config():
         "advertiser_id": TIKTOK_ADVERTISER_ID
     }), 200
 
-@app.post("/api/create_task")
-@login_required
-def create_task():
+@app.get("/metrics")
+def prometheus_metrics():
     """
-    Body JSON:
-    {
-      "access_token": "...",
-      "mode": "CUSTOM" | "PRODUCT",
-      "custom_prompt": "...",                # when CUSTOM
-      "script_generation_count": 3,          # 1..8
-      "script_info": { ... },                # tone/style/pov/lang/industry (optional)
-      "product_info": { ... },               # when PRODUCT
-      "media_list": { "video_id_list": [], "image_url_list": [] },  # optional for PRODUCT
-      "video_duration": "15S" | "30S"        # optional
-    }
+    Prometheus metrics summed over all gunicorn workers. Open to scrapers
+    unless METRICS_TOKEN is set, then it needs "Authorization: Bearer <token>".
     """
-    data = request.get_json(force=True) or {}
-
-    # Debug logging
-    print(f"Received data: {data}")
-
-    # Use access token from environment if not provided
-    access_token = data.get("access_token", "").strip() or TIKTOK_ACCESS_TOKEN
-    mode = data.get("mode", "CUSTOM")
+    token = os.getenv('METRICS_TOKEN', '')
+    if token and request.headers.get("Authorization", "") != f"Bearer {token}":
+        return jsonify({"error": "Unauthorized"}), 401
+    metrics.update_pool(tiktok, min_interval=0)
+    body, content_type = metrics.render()
+    return Response(body, mimetype=None, content_type=content_type)
+
+@app.get("/api/upstream_stats")
+@login_required
+def upstream_stats():
+    """Connection pool and request counters for this worker's TikTok client"""
+    return jsonify({
+        "tiktok_client": tiktok.pool_stats(),
+        "singleflight": singleflight.stats(),
+        "rate_limiter": rate_limiter.stats(),
+        "circuit_breakers": breakers.stats(),
+        "admission": admission.stats(),
+        "idempotency": idempotency.stats(),
+        "task_tracker": task_tracker.stats(),
+        "response_cache": response_cache.stats(),
+        "video_info": video_info.stats(),
+        "logging": structured_logging.stats(),
+        "compression": compressor.stats(),
+        "video_uploads": video_uploader.stats(),
+        "media_cache": media_cache.stats(),
+        "tracing": tracer.stats(),
+    }), 200
 
-    if not access_token:
-        return jsonify({"error": "Missing access_token"}), 400
+@app.get("/api/admin/slow_requests")
+@admin_required
+def slow_requests():
+    """
+    This worker's most recent requests slower than TRACE_SLOW_MS, newest first,
+    each with its span breakdown. Query params: limit (optional)
+    """
+    limit = request.args.get("limit", type=int)
+    return jsonify({"pid": os.getpid(), **tracer.stats(), "requests": tracer.slow_requests(limit)}), 200
 
+@app.post("/api/admin/profile")
+@admin_required
+def arm_profile():
+    """
+    Run the next requests of this worker under cProfile (clears the previous capture).
+    Body JSON: {"requests": 10, "path_prefix": "/api/assets/"}
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    requests_to_profile = int(data.get("requests", 10))
+    if not 1 <= requests_to_profile <= 1000:
+        return jsonify({"error": "requests must be between 1 and 1000"}), 400
+    tracer.arm_profile(requests_to_profile, str(data.get("path_prefix") or ""))
+    return jsonify({"pid": os.getpid(), **tracer.stats()}), 200
+
+@app.get("/api/admin/profile")
+@admin_required
+def get_profile():
+    """
+    The cProfile capture of this worker as text.
+    Query params: sort=cumulative|tottime|calls (optional), limit=40 (optional),
+    format=pstats for the binary dump (open with snakeviz or pstats.Stats)
+    """
+    if request.args.get("format") == "pstats":
+        dump = tracer.profile_dump()
+        if dump is None:
+            return jsonify({"error": "Nothing captured yet"}), 404
+        return Response(dump, mimetype="application/octet-stream",
+                        headers={"Content-Disposition": f"attachment; filename=profile-{os.getpid()}.pstats"})
+    sort = request.args.get("sort", "cumulative")
+    if sort not in ("cumulative", "tottime", "calls", "ncalls", "time"):
+        return jsonify({"error": "sort must be cumulative, tottime or calls"}), 400
+    report = tracer.profile_report(sort=sort, limit=request.args.get("limit", 40, type=int))
+    if report is None:
+        return jsonify({"error": "Nothing captured yet"}), 404
+    return Response(report, mimetype="text/plain")
+
+def build_script_payload(data: dict):
+    """
+    TikTok script_generation payload for a create_task body, as (payload, None),
+    or (None, error body) when the body is invalid.
+    """
     payload = {
         "script_generation_count": data.get("script_generation_count", 3),
     }
 
     # Attach mode-specific fields
-    if mode.upper() == "CUSTOM":
+    if data.get("mode", "CUSTOM").upper() == "CUSTOM":
         payload["script_source"] = "CUSTOM"
         custom_prompt = data.get("custom_prompt", "").strip()
 
-        print(f"Custom prompt received: {custom_prompt}")
-
         if not custom_prompt:
-            return jsonify({
+            return None, {
                 "error": "custom_prompt is required for CUSTOM mode",
                 "details": f"Received data keys: {list(data.keys())}"
-            }), 400
+            }
         payload["custom_prompt"] = custom_prompt
         # Note: script_info is NOT allowed for CUSTOM mode per TikTok API
     else:
@@ -260,7 +728,7 @@ def create_task():
         }
         product_info = data.get("product_info")
         if not product_info:
-            return jsonify({"error": "product_info is required for PRODUCT mode"}), 400
+            return None, {"error": "product_info is required for PRODUCT mode"}
         payload["product_info"] = product_info
         media_list = data.get("media_list")
         if media_list:
@@ -268,17 +736,54 @@ def create_task():
         vd = data.get("video_duration")
         if vd in ("15S", "30S"):
             payload["video_duration"] = vd
+    return payload, None
+
+@app.post("/api/create_task")
+@login_required
+@idempotent("create_task")
+def create_task():
+    """
+    Body JSON:
+    {
+      "access_token": "...",
+      "mode": "CUSTOM" | "PRODUCT",
+      "custom_prompt": "...",                # when CUSTOM
+      "script_generation_count": 3,          # 1..8
+      "script_info": { ... },                # tone/style/pov/lang/industry (optional)
+      "product_info": { ... },               # when PRODUCT
+      "media_list": { "video_id_list": [], "image_url_list": [] },  # optional for PRODUCT
+      "video_duration": "15S" | "30S"        # optional
+    }
+    Send an Idempotency-Key header to make retries safe.
+    """
+    data = request.get_json(force=True) or {}
+    log.debug("create_task request", extra={"body": data})
+
+    # Use access token from environment if not provided
+    access_token = data.get("access_token", "").strip() or TIKTOK_ACCESS_TOKEN
+
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+
+    with tracing.span("build"):
+        payload, error = build_script_payload(data)
+    if error:
+        return jsonify(error), 400
 
     try:
-        print(f"Sending payload to TikTok API: {payload}")
-        r = requests.post(
-            f"{TIKTOK_BASE}/creative/aigc/script_generation/task/create/",
-            headers=tt_headers(access_token),
+        r = tiktok.post(
+            "/creative/aigc/script_generation/task/create/",
+            access_token,
             json=payload,
-            timeout=30,
         )
-        response_data = r.json()
-        print(f"TikTok API response: {response_data}")
+        with tracing.span("parse"):
+            response_data = fast_json.loads(r.content)
+        log.info("create_task upstream response", extra={
+            "status": r.status_code,
+            "code": response_data.get("code"),
+            "payload": structured_logging.sample_body(payload),
+            "body": structured_logging.sample_body(response_data),
+        })
 
         # If TikTok API returns an error, provide more context
         # TikTok API returns code as string "0" for success
@@ -293,14 +798,93 @@ def create_task():
             }
             return jsonify(error_response), r.status_code if r.status_code != 200 else 400
 
-        return jsonify(response_data), r.status_code
+        task_id = (response_data.get("data") or {}).get("task_id")
+        if task_id:
+            task_tracker.track("script", access_token, [task_id])
+            response_cache.invalidate("/creative/aigc/script/list/", access_token)
+        return relay(r)
+    except requests.ReadTimeout as e:
+        # The task may exist upstream; with an Idempotency-Key this answer is kept
+        return jsonify({"error": f"TikTok did not answer in time; the task may still have been created: {e}"}), 504
     except requests.RequestException as e:
-        print(f"Request exception: {str(e)}")
+        log.warning("create_task request failed: %s", e)
+        note_send_failure(e)
         return jsonify({"error": f"Request failed: {str(e)}"}), 500
     except Exception as e:
-        print(f"Unexpected error: {str(e)}")
+        log.exception("create_task failed unexpectedly")
         return jsonify({"error": f"Unexpected error: {str(e)}"}), 500
 
+@app.post("/api/script_campaigns")
+@login_required
+def create_script_campaign():
+    """
+    Generate scripts for many prompts and/or products in one go.
+    Body JSON:
+    {
+      "access_token": "...",
+      "items": [                            # up to CAMPAIGN_MAX_ITEMS create_task bodies
+        {"mode": "CUSTOM", "custom_prompt": "..."},
+        {"mode": "PRODUCT", "product_info": { ... }, "media_list": { ... }}
+      ],
+      "script_info": { ... },               # shared by PRODUCT items (optional)
+      "video_duration": "15S" | "30S",      # shared by PRODUCT items (optional)
+      "script_generation_count": 3,         # shared default (optional)
+      "wait": 90,                           # seconds to follow the tasks, 0..STREAM_MAX_SECONDS
+      "stream": false                       # true: NDJSON events as they happen
+    }
+    Items without a mode are PRODUCT when they have product_info, else CUSTOM.
+    Nothing is submitted unless every item is valid. Tasks still running
+    when the wait ends are returned as pending and keep being tracked.
+    """
+    data = request.get_json(force=True) or {}
+    access_token = data.get("access_token", "").strip() or TIKTOK_ACCESS_TOKEN
+    items = data.get("items")
+
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+    if not isinstance(items, list) or not items:
+        return jsonify({"error": "items must be a non-empty list"}), 400
+    if len(items) > CAMPAIGN_MAX_ITEMS:
+        return jsonify({"error": f"At most {CAMPAIGN_MAX_ITEMS} items per campaign"}), 400
+
+    shared = {key: data[key] for key in ("script_info", "video_duration", "script_generation_count") if key in data}
+    payloads, errors = [], []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({"index": index, "error": "item must be an object"})
+            continue
+        body = {**shared, **item}
+        body.setdefault("mode", "PRODUCT" if "product_info" in body else "CUSTOM")
+        payload, error = build_script_payload(body)
+        if error:
+            errors.append({"index": index, **error})
+        else:
+            payloads.append(payload)
+    if errors:
+        return jsonify({"error": "Invalid campaign items", "items": errors}), 400
+
+    try:
+        wait = max(0.0, min(float(data.get("wait", STREAM_MAX_SECONDS)), STREAM_MAX_SECONDS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "wait must be a number of seconds"}), 400
+
+    events = campaign_runner.run(access_token, payloads, wait)
+    if data.get("stream"):
+        # Keep the request context, and with it the admission ticket, until the last event is sent
+        return Response(stream_with_context(fast_json.dumps(event) + "\n" for event in events),
+                        mimetype="application/x-ndjson", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    results = [{"index": index} for index in range(len(payloads))]
+    for event in events:
+        if event["event"] == "done":
+            for entry in event["pending"]:
+                results[entry["index"]]["status"] = "PENDING"
+            return jsonify({"summary": event["summary"], "items": results}), 200
+        results[event["index"]].update({k: v for k, v in event.items() if k not in ("event", "index")})
+    # The runner always ends with "done"; never answer None if that ever changes
+    return jsonify({"error": "Campaign ended without a summary", "items": results}), 500
+
+
 @app.get("/api/task_status")
 @login_required
 def task_status():
@@ -315,13 +899,12 @@ def task_status():
         return jsonify({"error": "access_token and task_id are required"}), 400
 
     try:
-        r = requests.get(
-            f"{TIKTOK_BASE}/creative/aigc/script/task/get/",
-            headers={"Access-Token": access_token},
-            params={"task_id": task_id},
-            timeout=30,
-        )
-        return jsonify(r.json()), r.status_code
+        # Served from the task tracker; TikTok is only called for unseen task IDs
+        tasks, error = task_tracker.lookup("script", access_token, [task_id])
+        if error:
+            return jsonify(error[0]), error[1]
+        task = tasks[task_id]
+        return jsonify({**task.envelope, "data": task.result}), 200
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
@@ -341,13 +924,166 @@ def list_scripts():
     page_size = int(request.args.get("page_size", 20))
 
     try:
-        r = requests.get(
-            f"{TIKTOK_BASE}/creative/aigc/script/list/",
-            headers={"Access-Token": access_token},
-            params={"page": page, "page_size": page_size},
-            timeout=30,
-        )
-        return jsonify(r.json()), r.status_code
+        response = cached_get("/creative/aigc/script/list/", access_token, {"page": page, "page_size": page_size})
+        if response.status_code == 200 and response.headers.get("X-Cache") == "MISS":
+            # A fresh page: keep the local library (and with it the near-duplicate index) current
+            with tracing.span("parse"):
+                body = fast_json.loads(response.get_data())
+            if str(body.get("code")) == "0":
+                script_store.add_scripts(access_token, (body.get("data") or {}).get("list") or [])
+        return response
+    except requests.RequestException as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.get("/api/scripts/search")
+@login_required
+def search_scripts():
+    """
+    Search the local script library without calling TikTok. The library is
+    synced in the background when it is older than SCRIPT_SYNC_INTERVAL.
+    Query params:
+      access_token=...
+      q=keywords (optional, matches title and script text)
+      start_date=YYYY-MM-DD (optional)
+      end_date=YYYY-MM-DD (optional)
+      page=1 (optional)
+      page_size=20 (optional, max 100)
+    """
+    access_token = (request.args.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    if not access_token:
+        return jsonify({"error": "access_token is required"}), 400
+
+    page = max(1, int(request.args.get("page", 1)))
+    page_size = min(100, max(1, int(request.args.get("page_size", 20))))
+
+    script_store.sync_in_background(tiktok, access_token, SCRIPT_SYNC_INTERVAL)
+    scripts, page_info = script_store.search(
+        access_token,
+        q=(request.args.get("q") or "").strip(),
+        start_date=request.args.get("start_date"),
+        end_date=request.args.get("end_date"),
+        page=page,
+        page_size=page_size,
+    )
+    return jsonify({
+        "code": 0,
+        "message": "OK",
+        "data": {
+            "list": scripts,
+            "page_info": page_info,
+            "sync": {
+                "last_sync": script_store.last_sync(access_token),
+                "syncing": script_store.is_syncing(access_token),
+            },
+        },
+    }), 200
+
+@app.get("/api/scripts/near_duplicates")
+@login_required
+def script_near_duplicates():
+    """
+    Scripts similar to a stored script or to a piece of text.
+    Query params:
+      access_token=...
+      script_id=... or text=...
+      corpus=library | rendered (optional, default library)
+      threshold=0.8 (optional, estimated Jaccard similarity of 3-word shingles)
+      limit=20 (optional, max 200)
+    """
+    access_token = (request.args.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    if not access_token:
+        return jsonify({"error": "access_token is required"}), 400
+    if not script_index.available:
+        return jsonify({"error": "Near-duplicate search needs numpy, which is not installed"}), 501
+    corpus = request.args.get("corpus", "library")
+    if corpus not in ("library", "rendered"):
+        return jsonify({"error": "corpus must be library or rendered"}), 400
+
+    script_id = (request.args.get("script_id") or "").strip()
+    text = request.args.get("text") or ""
+    if script_id:
+        script = script_store.get(access_token, script_id)
+        if script is None:
+            return jsonify({"error": "Unknown script_id; sync the script library first"}), 404
+        text = script.get("script") or ""
+    if not text.strip():
+        return jsonify({"error": "script_id or text is required"}), 400
+
+    backfill_script_index(access_token)
+    matches = script_index.near_duplicates(
+        access_token, corpus, text,
+        threshold=float(request.args.get("threshold", script_index.threshold)),
+        limit=min(200, max(1, int(request.args.get("limit", 20)))),
+        exclude_key=script_id or None,
+    )
+    return jsonify({"code": 0, "message": "OK", "data": {"list": matches}}), 200
+
+@app.post("/api/scripts/clusters")
+@login_required
+def cluster_scripts():
+    """
+    Group a batch of scripts into near-duplicate clusters.
+    Body JSON:
+    {
+      "access_token": "...",
+      "scripts": ["...", ...]   or   "script_ids": ["...", ...],   # up to 2000
+      "threshold": 0.8          # optional
+    }
+    Returns clusters as lists of batch indexes (script_ids when given), largest first.
+    """
+    data = request.get_json(force=True) or {}
+    access_token = data.get("access_token", "").strip() or TIKTOK_ACCESS_TOKEN
+    if not script_index.available:
+        return jsonify({"error": "Clustering needs numpy, which is not installed"}), 501
+
+    script_ids = data.get("script_ids")
+    if script_ids:
+        if not access_token:
+            return jsonify({"error": "Missing access_token"}), 400
+        found = [script_store.get(access_token, str(script_id)) for script_id in script_ids]
+        missing = [script_id for script_id, script in zip(script_ids, found) if script is None]
+        if missing:
+            return jsonify({"error": "Unknown script_ids", "script_ids": missing}), 404
+        texts = [script.get("script") or "" for script in found]
+    else:
+        texts = data.get("scripts")
+        if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+            return jsonify({"error": "scripts (list of strings) or script_ids is required"}), 400
+    if len(texts) > 2000:
+        return jsonify({"error": "At most 2000 scripts per request"}), 400
+
+    try:
+        threshold = data.get("threshold")
+        threshold = float(script_index.threshold if threshold is None else threshold)
+    except (TypeError, ValueError):
+        return jsonify({"error": "threshold must be a number"}), 400
+    clusters = script_index.cluster(texts, threshold)
+    if script_ids:
+        clusters = [[script_ids[i] for i in cluster] for cluster in clusters]
+    return jsonify({"code": 0, "message": "OK", "data": {
+        "clusters": clusters,
+        "duplicates": sum(len(cluster) - 1 for cluster in clusters),
+    }}), 200
+
+@app.post("/api/scripts/sync")
+@login_required
+def sync_scripts():
+    """
+    Sync the local script library now.
+    Body JSON:
+    {
+      "access_token": "...",
+      "full": false            # true re-walks every page instead of stopping at known scripts
+    }
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    access_token = (data.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+
+    try:
+        result = script_store.sync(tiktok, access_token, full=bool(data.get("full")))
+        return jsonify(result), 200 if result["ok"] else 502
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
@@ -369,18 +1105,13 @@ def get_avatars():
     page_size = int(request.args.get("page_size", 10))
 
     try:
-        r = requests.get(
-            f"{TIKTOK_BASE}/creative/digital_avatar/get/",
-            headers={"Access-Token": access_token},
-            params={"page": page, "page_size": page_size},
-            timeout=30,
-        )
-        return jsonify(r.json()), r.status_code
+        return cached_get("/creative/digital_avatar/get/", access_token, {"page": page, "page_size": page_size})
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
 @app.post("/api/create_avatar_video_task")
 @login_required
+@idempotent("create_avatar_video_task")
 def create_avatar_video_task():
     """
     Create digital avatar video tasks.
@@ -394,12 +1125,20 @@ def create_avatar_video_task():
           "video_name": "..." (optional),
           "package_id": "..." (optional)
         }
-      ]
+      ],
+      "duplicate_check": "off" | "flag" | "drop",  (optional, default SCRIPT_DUPLICATE_CHECK)
+      "duplicate_threshold": 0.8                     (optional)
     }
+    duplicate_check compares each script with the scripts already rendered
+    and with the earlier packages of this request. "flag" answers 409 with
+    the near-duplicates and submits nothing; "drop" submits the rest and
+    lists the dropped package indexes in the X-Dropped-Packages header.
+    Send an Idempotency-Key header to make retries safe.
     """
     data = request.get_json(force=True) or {}
     access_token = data.get("access_token", "").strip() or TIKTOK_ACCESS_TOKEN
     material_packages = data.get("material_packages", [])
+    duplicate_check = (data.get("duplicate_check") or SCRIPT_DUPLICATE_CHECK).lower()
 
     if not access_token:
         return jsonify({"error": "Missing access_token"}), 400
@@ -413,17 +1152,49 @@ def create_avatar_video_task():
         if not package.get("script"):
             return jsonify({"error": "script is required in material_packages"}), 400
 
+    dropped = []
+    if duplicate_check in ("flag", "drop"):
+        if not script_index.available:
+            return jsonify({"error": "Duplicate checks need numpy, which is not installed"}), 501
+        try:
+            threshold = data.get("duplicate_threshold")
+            threshold = float(script_index.threshold if threshold is None else threshold)
+        except (TypeError, ValueError):
+            return jsonify({"error": "duplicate_threshold must be a number"}), 400
+        findings = script_index.check_batch(access_token, [p["script"] for p in material_packages], threshold)
+        duplicates = [{"index": i, **finding} for i, finding in enumerate(findings) if finding]
+        if duplicates and (duplicate_check == "flag" or len(duplicates) == len(material_packages)):
+            return jsonify({
+                "error": "Scripts are near-duplicates of videos already rendered or of each other",
+                "duplicates": duplicates,
+            }), 409
+        dropped = [d["index"] for d in duplicates]
+        material_packages = [p for i, p in enumerate(material_packages) if i not in dropped]
+
     payload = {"material_packages": material_packages}
 
     try:
-        r = requests.post(
-            f"{TIKTOK_BASE}/creative/digital_avatar/video/task/create/",
-            headers=tt_headers(access_token),
+        r = tiktok.post(
+            "/creative/digital_avatar/video/task/create/",
+            access_token,
             json=payload,
-            timeout=30,
         )
-        return jsonify(r.json()), r.status_code
+        with tracing.span("parse"):
+            response_data = fast_json.loads(r.content)
+        task_ids = [item["task_id"] for item in (response_data.get("data") or {}).get("list") or [] if item.get("task_id")]
+        if task_ids:
+            task_tracker.track("avatar", access_token, task_ids)
+            response_cache.invalidate("/creative/digital_avatar/video/list/", access_token)
+            if script_index.available:
+                script_index.add(access_token, "rendered", [(text_key(p["script"]), p["script"]) for p in material_packages])
+        response = relay(r)
+        if dropped:
+            response.headers["X-Dropped-Packages"] = ",".join(map(str, dropped))
+        return response
+    except requests.ReadTimeout as e:
+        return jsonify({"error": f"TikTok did not answer in time; the tasks may still have been created: {e}"}), 504
     except requests.RequestException as e:
+        note_send_failure(e)
         return jsonify({"error": str(e)}), 500
 
 @app.get("/api/get_avatar_video_task_status")
@@ -453,16 +1224,89 @@ def get_avatar_video_task_status():
         return jsonify({"error": f"task_ids must be a valid JSON array: {str(e)}"}), 400
 
     try:
-        r = requests.get(
-            f"{TIKTOK_BASE}/creative/digital_avatar/video/task/get/",
-            headers={"Access-Token": access_token},
-            params={"task_ids": task_ids_str},
-            timeout=30,
-        )
-        return jsonify(r.json()), r.status_code
+        # Served from the task tracker; unseen IDs are fetched in one batched call
+        task_ids = [str(task_id) for task_id in task_ids]
+        tasks, error = task_tracker.lookup("avatar", access_token, task_ids)
+        if error:
+            return jsonify(error[0]), error[1]
+        envelope = next(iter(tasks.values())).envelope if tasks else {"code": 0, "message": "OK"}
+        return jsonify({
+            **envelope,
+            "data": {"list": [tasks[task_id].result for task_id in task_ids if task_id in tasks]},
+        }), 200
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
+@app.get("/api/tasks/stream")
+@login_required
+def stream_tasks():
+    """
+    Server-Sent Events stream of task status transitions.
+    Query params:
+      access_token=...
+      kind=script | avatar
+      task_ids=id1,id2,... (or a JSON array as string)
+    Events:
+      status          {"task_id", "status", "result"} on every status change
+      upstream_error  TikTok rejected the task IDs; the stream ends
+      done            every task reached SUCCESS / PARTIAL_SUCCESS / FAILED
+    """
+    import json
+    access_token = (request.args.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    kind = (request.args.get("kind") or "script").strip()
+    task_ids_str = (request.args.get("task_ids") or "").strip()
+
+    if not access_token:
+        return jsonify({"error": "access_token is required"}), 400
+    if kind not in ("script", "avatar"):
+        return jsonify({"error": "kind must be script or avatar"}), 400
+    try:
+        task_ids = json.loads(task_ids_str) if task_ids_str.startswith("[") else task_ids_str.split(",")
+        task_ids = [str(task_id).strip() for task_id in task_ids if str(task_id).strip()]
+    except json.JSONDecodeError:
+        task_ids = []
+    if not task_ids:
+        return jsonify({"error": "task_ids is required"}), 400
+
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+    def generate():
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        sent = {}
+        yield "retry: 3000\n\n"
+        while True:
+            version = task_tracker.version
+            try:
+                tasks, error = task_tracker.lookup(kind, access_token, task_ids)
+            except requests.RequestException as e:
+                # Transient; the background poller keeps trying
+                tasks, error = {}, None
+                yield f": upstream unavailable ({type(e).__name__})\n\n"
+            if error:
+                yield event("upstream_error", error[0])
+                return
+
+            for task_id, task in tasks.items():
+                if sent.get(task_id) != task.status:
+                    sent[task_id] = task.status
+                    yield event("status", {"task_id": task_id, "status": task.status, "result": task.result})
+
+            if len(tasks) == len(task_ids) and all(task.done for task in tasks.values()):
+                yield event("done", {"task_ids": task_ids})
+                return
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            if task_tracker.wait_for_change(version, timeout=min(15, remaining)) == version:
+                yield ": keep-alive\n\n"
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
 @app.get("/api/list_avatar_videos")
 @login_required
 def list_avatar_videos():
@@ -501,13 +1345,7 @@ def list_avatar_videos():
         params["filtering"] = filtering
 
     try:
-        r = requests.get(
-            f"{TIKTOK_BASE}/creative/digital_avatar/video/list/",
-            headers={"Access-Token": access_token},
-            params=params,
-            timeout=30,
-        )
-        return jsonify(r.json()), r.status_code
+        return cached_get("/creative/digital_avatar/video/list/", access_token, params)
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
@@ -541,57 +1379,64 @@ def update_avatar_video_name():
     }
 
     try:
-        r = requests.post(
-            f"{TIKTOK_BASE}/file/video/ad/update/",
-            headers=tt_headers(access_token),
+        r = tiktok.post(
+            "/file/video/ad/update/",
+            access_token,
             json=payload,
-            timeout=30,
+            stream=True,
         )
-        return jsonify(r.json()), r.status_code
+        if r.status_code == 200:
+            # The renamed video shows up in both lists
+            response_cache.invalidate("/creative/digital_avatar/video/list/", access_token)
+            response_cache.invalidate("/file/video/ad/search/", access_token)
+        return relay(r, stream=True)
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
-@app.get("/api/get_video_info")
+@app.route("/api/get_video_info", methods=["GET", "POST"])
 @login_required
 def get_video_info():
     """
-    Get detailed information about specific videos including thumbnail URLs
-    Query params:
+    Get detailed information about specific videos including thumbnail URLs.
+    Any number of IDs is accepted: cached entries are answered locally and
+    the rest is fetched in concurrent chunks. Results keep the request order.
+    Query params (GET):
       access_token=...
       advertiser_id=...
       video_ids=["video_id1","video_id2"] (JSON array as string)
+    Body JSON (POST, for lists too long for a URL):
+    {
+      "access_token": "...",
+      "advertiser_id": "...",
+      "video_ids": ["video_id1", "video_id2", ...]
+    }
     """
-    access_token = (request.args.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
-    advertiser_id = (request.args.get("advertiser_id") or "").strip() or TIKTOK_ADVERTISER_ID
-    video_ids_str = (request.args.get("video_ids") or "").strip()
+    import json
+    if request.method == "POST":
+        data = request.get_json(force=True, silent=True) or {}
+    else:
+        data = request.args
+    access_token = (data.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    advertiser_id = (str(data.get("advertiser_id") or "")).strip() or TIKTOK_ADVERTISER_ID
+    video_ids = data.get("video_ids")
 
-    if not access_token or not advertiser_id or not video_ids_str:
+    if not access_token or not advertiser_id or not video_ids:
         return jsonify({"error": "access_token, advertiser_id and video_ids are required"}), 400
 
-    try:
-        import json
-        video_ids = json.loads(video_ids_str)
-        if not isinstance(video_ids, list):
-            return jsonify({"error": "video_ids must be a JSON array"}), 400
-    except:
-        return jsonify({"error": "video_ids must be a valid JSON array"}), 400
+    if isinstance(video_ids, str):
+        try:
+            video_ids = json.loads(video_ids.strip())
+        except json.JSONDecodeError:
+            return jsonify({"error": "video_ids must be a valid JSON array"}), 400
+    if not isinstance(video_ids, list):
+        return jsonify({"error": "video_ids must be a JSON array"}), 400
 
     try:
-        # v1.3 endpoint for video info
-        r = requests.get(
-            f"{TIKTOK_BASE}/file/video/ad/info/",
-            headers={"Access-Token": access_token},
-            params={
-                "advertiser_id": advertiser_id,
-                "video_ids": json.dumps(video_ids)
-            },
-            timeout=30,
-        )
-
-        response_data = r.json()
-        print(f"Video info response: {response_data}")
-
-        return jsonify(response_data), r.status_code
+        videos, error, stats = video_info.lookup(tiktok, access_token, advertiser_id, video_ids)
+        log.info("video info lookup", extra=stats)
+        if error:
+            return jsonify(error[0]), error[1]
+        return jsonify({"code": 0, "message": "OK", "data": {"list": videos}}), 200
     except requests.RequestException as e:
         return jsonify({"error": str(e)}), 500
 
@@ -623,27 +1468,222 @@ def get_assets_videos():
             "page": page,
             "page_size": page_size
         }
+        response = cached_get("/file/video/ad/search/", access_token, params)
+        log.debug("asset video search", extra={"params": params, "status": response.status_code,
+                                               "cache": response.headers["X-Cache"]})
+        return response
+    except requests.RequestException as e:
+        log.warning("get_assets_videos request failed: %s", e)
+        return jsonify({"error": str(e)}), 500
 
-        print(f"Fetching videos with params: {params}")
+@app.get("/api/assets/videos")
+@login_required
+def search_assets_videos():
+    """
+    Filter, sort and paginate the local index of the asset video library.
+    The index is crawled from TikTok in the background.
+    Query params:
+      access_token=...
+      advertiser_id=...
+      q=text (optional, matches file name)
+      min_duration / max_duration=seconds (optional)
+      sort=create_time | modify_time | name | duration (optional)
+      order=desc | asc (optional)
+      page=1 (optional)
+      page_size=100 (optional, max 500)
+    """
+    access_token = (request.args.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    advertiser_id = (request.args.get("advertiser_id") or "").strip() or TIKTOK_ADVERTISER_ID
 
-        r = requests.get(
-            f"{TIKTOK_BASE}/file/video/ad/search/",
-            headers={"Access-Token": access_token},
-            params=params,
-            timeout=30,
+    if not access_token:
+        return jsonify({"error": "access_token is required"}), 400
+    if not advertiser_id:
+        return jsonify({"error": "advertiser_id is required"}), 400
+
+    page = max(1, int(request.args.get("page", 1)))
+    page_size = min(500, max(1, int(request.args.get("page_size", 100))))
+    min_duration = request.args.get("min_duration", type=float)
+    max_duration = request.args.get("max_duration", type=float)
+
+    # An empty index waits for the first crawled page; otherwise refresh behind the response
+    never_indexed = asset_index.last_refresh(access_token, advertiser_id) == 0
+    asset_index.refresh_in_background(
+        tiktok, access_token, advertiser_id, ASSET_REFRESH_INTERVAL,
+        wait_first_page=20 if never_indexed else 0,
+    )
+
+    with tracing.span("query"):
+        videos, page_info = asset_index.query(
+            access_token, advertiser_id,
+            q=(request.args.get("q") or "").strip(),
+            min_duration=min_duration,
+            max_duration=max_duration,
+            sort=request.args.get("sort", "create_time"),
+            order=request.args.get("order", "desc"),
+            page=page,
+            page_size=page_size,
         )
+    with tracing.span("serialize"):
+        response = jsonify({
+            "code": 0,
+            "message": "OK",
+            "data": {
+                "list": videos,
+                "page_info": page_info,
+                "index": {
+                    "last_refresh": asset_index.last_refresh(access_token, advertiser_id),
+                    "refreshing": asset_index.is_refreshing(access_token, advertiser_id),
+                },
+            },
+        })
+    return response, 200
 
-        response_data = r.json()
-        print(f"TikTok video search response: {response_data}")
+@app.post("/api/assets/refresh")
+@login_required
+def refresh_assets_index():
+    """
+    Re-crawl the asset video library now.
+    Body JSON:
+    {
+      "access_token": "...",
+      "advertiser_id": "...",
+      "full": true              # false only pulls pages until known videos are reached
+    }
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    access_token = (data.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    advertiser_id = (data.get("advertiser_id") or "").strip() or TIKTOK_ADVERTISER_ID
 
-        return jsonify(response_data), r.status_code
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+    if not advertiser_id:
+        return jsonify({"error": "Missing advertiser_id"}), 400
+    full = data.get("full", True)
+    if not isinstance(full, bool):
+        return jsonify({"error": "full must be true or false"}), 400
+
+    try:
+        summary = asset_index.refresh(tiktok, access_token, advertiser_id, full=full)
+        if summary is None:
+            return jsonify({"error": "The asset library is already being crawled, try again shortly"}), 409
+        return jsonify(summary), 200
     except requests.RequestException as e:
-        print(f"Request error in get_assets_videos: {str(e)}")
         return jsonify({"error": str(e)}), 500
+    except RuntimeError as e:
+        return jsonify({"error": str(e)}), 502
 
-# Video/Image upload endpoints have been removed as per requirements
+@app.post("/api/bulk/avatar_jobs")
+@login_required
+def create_bulk_avatar_job():
+    """
+    Queue a bulk avatar-video job from a manifest.
+    Multipart form: manifest=<file.jsonl|file.csv>, access_token, name
+    or a raw JSONL / CSV request body with ?access_token=&name=
+    Each row needs avatar_id and script; video_name is optional.
+    """
+    upload = request.files.get("manifest")
+    if upload is not None:
+        raw, filename, content_type = upload.read(), upload.filename or "", upload.mimetype or ""
+    else:
+        raw, filename, content_type = request.get_data(), "", request.mimetype or ""
+    access_token = (request.values.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    name = (request.values.get("name") or filename).strip()
+
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+    if not raw:
+        return jsonify({"error": "manifest is required"}), 400
+
+    try:
+        packages = parse_manifest(raw, filename, content_type,
+                                  max_items=int(os.getenv('BULK_MAX_ITEMS', '20000')))
+    except (ManifestError, UnicodeDecodeError) as e:
+        return jsonify({"error": f"Invalid manifest: {e}"}), 400
+
+    job_id = bulk_runner.create_job(access_token, packages, name=name)
+    return jsonify(bulk_runner.job_status(job_id)), 201
+
+@app.get("/api/bulk/avatar_jobs")
+@login_required
+def list_bulk_avatar_jobs():
+    """Most recent bulk jobs with progress. Query params: limit (default 50)"""
+    limit = int(request.args.get("limit", 50))
+    return jsonify({"jobs": bulk_runner.list_jobs(limit=limit)}), 200
+
+@app.get("/api/bulk/avatar_jobs/<job_id>")
+@login_required
+def get_bulk_avatar_job(job_id):
+    """Progress of one bulk job: item counts per state, throughput and ETA"""
+    job = bulk_runner.job_status(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job), 200
+
+@app.get("/api/bulk/avatar_jobs/<job_id>/items")
+@login_required
+def list_bulk_avatar_job_items(job_id):
+    """
+    Items of a bulk job with their task IDs and results.
+    Query params: state (pending|submitting|submitted|success|failed), page, page_size
+    """
+    page = int(request.args.get("page", 1))
+    page_size = min(int(request.args.get("page_size", 100)), 1000)
+    items, page_info = bulk_runner.job_items(job_id, request.args.get("state") or None, page, page_size)
+    return jsonify({"list": items, "page_info": page_info}), 200
 
+@app.post("/api/bulk/avatar_jobs/<job_id>/cancel")
+@login_required
+def cancel_bulk_avatar_job(job_id):
+    """Stop submitting the job's pending items; submitted tasks are still tracked to completion"""
+    if not bulk_runner.cancel_job(job_id):
+        return jsonify({"error": "Job not found or not running"}), 409
+    return jsonify(bulk_runner.job_status(job_id)), 200
 
+@app.post("/api/upload_video_to_ads")
+@login_required
+@idempotent("upload_video_to_ads")
+def upload_video_to_ads():
+    """
+    Copy a finished video into the advertiser's Ads library in the background.
+    Body JSON:
+    {
+      "access_token": "...",
+      "advertiser_id": "...",
+      "video_url": "https://...",
+      "video_name": "...",
+      "mode": "auto" | "url" | "file"   (optional, default UPLOAD_MODE)
+    }
+    Answers 202 with the job; follow it at /api/upload_video_to_ads/<job_id>.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    access_token = (data.get("access_token") or "").strip() or TIKTOK_ACCESS_TOKEN
+    advertiser_id = str(data.get("advertiser_id") or "").strip() or TIKTOK_ADVERTISER_ID
+    video_url = (data.get("video_url") or "").strip()
+    video_name = (data.get("video_name") or "").strip()
+    mode = (data.get("mode") or UPLOAD_MODE).lower()
+
+    if not access_token:
+        return jsonify({"error": "Missing access_token"}), 400
+    if not advertiser_id:
+        return jsonify({"error": "Missing advertiser_id"}), 400
+    if not media_guard.allowed(video_url):
+        return jsonify({"error": "video_url must be an http(s) URL on an allowed media host"}), 400
+    if mode not in UPLOAD_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(UPLOAD_MODES)}"}), 400
+
+    job_id = video_uploader.submit(access_token, advertiser_id, video_url, video_name, mode=mode)
+    job = video_uploader.job_status(job_id)
+    job["status_url"] = url_for("get_video_upload", job_id=job_id)
+    return jsonify(job), 202
+
+@app.get("/api/upload_video_to_ads/<job_id>")
+@login_required
+def get_video_upload(job_id):
+    """State of an upload job: phase, bytes done / total, and the video_id once it succeeded"""
+    job = video_uploader.job_status(job_id)
+    if job is None:
+        return jsonify({"error": "Upload not found"}), 404
+    return jsonify(job), 200
 
 
 if __name__ == "__main__":
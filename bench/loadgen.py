@@ -0,0 +1,399 @@
+# bench/loadgen.py
+"""
+Load generator and benchmark report for the app.
+
+Starts bench/mock_tiktok.py and the app under gunicorn (gunicorn_config.py
+with the worker/thread settings being measured), drives it with simulated
+users running a weighted mix of operations for a fixed time, and reports
+throughput, latency percentiles per operation and upstream call
+amplification (TikTok calls made per app request, read from the mock).
+
+    python bench/loadgen.py --scenario mixed --users 20 --duration 30 \\
+        --workers 2,4 --threads 1,4 --mode sync,async
+
+Every run is written to bench/results/. Pass --save-baseline to store it
+as the baseline for its scenario, mock profile and server settings; later runs with the
+same settings are compared against it and the exit status is 1 when
+throughput dropped or p95 latency grew by more than --tolerance.
+--app-url benchmarks an app that is already running instead (amplification
+is only reported when --mock-url points at the mock it uses).
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+RESULTS_DIR = os.path.join(BENCH_DIR, "results")
+BASELINES_DIR = os.path.join(BENCH_DIR, "baselines")
+
+USERNAME, PASSWORD = "bench", "bench"
+
+
+# --- operations: each takes a User and returns the response ---
+
+def page_load(user):
+    path = random.choice(["/", "/script_generator", "/avatar"])
+    r = user.get(path)
+    # A browser with a warm cache only revalidates the shell; fingerprinted assets are not refetched
+    if r.status_code == 200 and r.headers.get("ETag"):
+        user.get(path, headers={"If-None-Match": r.headers["ETag"]})
+    return r
+
+
+def list_scripts(user):
+    return user.get("/api/list_scripts", params={"page": random.randint(1, 3), "page_size": 20})
+
+
+def get_avatars(user):
+    return user.get("/api/get_avatars", params={"page": 1, "page_size": 50})
+
+
+def list_avatar_videos(user):
+    return user.get("/api/list_avatar_videos", params={"page": 1, "page_size": 20})
+
+
+def get_assets_videos(user):
+    return user.get("/api/get_assets_videos", params={"page": random.randint(1, 5), "page_size": 20})
+
+
+def create_script_task(user):
+    r = user.post("/api/create_task", json={"mode": "CUSTOM", "custom_prompt": "A 15 second ad for a travel mug",
+                                           "script_generation_count": 3},
+                  headers={"Idempotency-Key": uuid.uuid4().hex})
+    task_id = ((r.json() if r.ok else {}).get("data") or {}).get("task_id")
+    if task_id:
+        user.script_tasks.append(task_id)
+    return r
+
+
+def create_avatar_task(user):
+    packages = [{"avatar_id": f"av{random.randint(0, 23):03d}", "script": "Meet the mug that keeps coffee hot all day."}
+                for _ in range(random.randint(1, 3))]
+    r = user.post("/api/create_avatar_video_task", json={"material_packages": packages},
+                  headers={"Idempotency-Key": uuid.uuid4().hex})
+    for item in ((r.json() if r.ok else {}).get("data") or {}).get("list") or []:
+        if item.get("task_id"):
+            user.avatar_tasks.append(item["task_id"])
+    return r
+
+
+def poll_script_task(user):
+    if not user.script_tasks:
+        return create_script_task(user)
+    return user.get("/api/task_status", params={"task_id": random.choice(user.script_tasks[-5:])})
+
+
+def poll_avatar_tasks(user):
+    if not user.avatar_tasks:
+        return create_avatar_task(user)
+    return user.get("/api/get_avatar_video_task_status", params={"task_ids": json.dumps(user.avatar_tasks[-10:])})
+
+
+OPERATIONS = {f.__name__: f for f in (page_load, list_scripts, get_avatars, list_avatar_videos, get_assets_videos,
+                                      create_script_task, create_avatar_task, poll_script_task, poll_avatar_tasks)}
+
+# scenario -> {operation: weight}, plus think time between a user's operations (seconds)
+SCENARIOS = {
+    "browse": {"mix": {"page_load": 2, "list_scripts": 3, "get_avatars": 3, "list_avatar_videos": 3,
+                       "get_assets_videos": 3}, "think": 0.2},
+    "polling": {"mix": {"poll_script_task": 5, "poll_avatar_tasks": 5, "create_script_task": 1,
+                        "create_avatar_task": 1}, "think": 0.5},
+    "creates": {"mix": {"create_script_task": 1, "create_avatar_task": 1}, "think": 0.5},
+    "mixed": {"mix": {"page_load": 1, "list_scripts": 2, "get_avatars": 2, "list_avatar_videos": 2,
+                      "get_assets_videos": 2, "poll_script_task": 4, "poll_avatar_tasks": 4,
+                      "create_script_task": 1, "create_avatar_task": 1}, "think": 0.3},
+}
+
+
+class User:
+    """One logged-in browser session."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Accept-Encoding"] = "gzip, br"
+        self.script_tasks = []
+        self.avatar_tasks = []
+
+    def login(self):
+        r = self.session.post(self.base_url + "/login", json={"username": USERNAME, "password": PASSWORD},
+                              timeout=self.timeout)
+        r.raise_for_status()
+
+    def request(self, method, path, headers=None, **kwargs):
+        # Stamped like a front router would, so time spent queued in gunicorn counts toward deadlines
+        headers = {"X-Request-Start": f"t={int(time.time() * 1e6)}", **(headers or {})}
+        return self.session.request(method, self.base_url + path, headers=headers, timeout=self.timeout, **kwargs)
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(q / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples, seconds):
+    """samples: [(operation, latency seconds, ok)] -> dict of throughput and latency stats."""
+    def stats(rows):
+        latencies = sorted(latency for _, latency, _ in rows)
+        errors = sum(1 for _, _, ok in rows if not ok)
+        return {
+            "requests": len(rows),
+            "rps": round(len(rows) / seconds, 2),
+            "error_rate": round(errors / len(rows), 4) if rows else 0.0,
+            **{f"p{q}_ms": round(percentile(latencies, q) * 1000, 1) if latencies else None for q in (50, 90, 95, 99)},
+            "max_ms": round(latencies[-1] * 1000, 1) if latencies else None,
+        }
+
+    by_operation = {}
+    for row in samples:
+        by_operation.setdefault(row[0], []).append(row)
+    return {"overall": stats(samples), "operations": {op: stats(rows) for op, rows in sorted(by_operation.items())}}
+
+
+def run_load(base_url, scenario, users, duration, warmup, timeout):
+    """Drive `users` concurrent users for warmup + duration seconds; returns (samples, measured seconds)."""
+    mix = SCENARIOS[scenario]["mix"]
+    think = SCENARIOS[scenario]["think"]
+    names, weights = list(mix), list(mix.values())
+    samples, lock = [], threading.Lock()
+    started = time.monotonic()
+    measure_from, stop_at = started + warmup, started + warmup + duration
+
+    def user_loop(seed):
+        rng = random.Random(seed)
+        user = User(base_url, timeout)
+        user.login()
+        while time.monotonic() < stop_at:
+            name = rng.choices(names, weights)[0]
+            began = time.monotonic()
+            try:
+                ok = OPERATIONS[name](user).status_code < 500
+            except requests.RequestException:
+                ok = False
+            elapsed = time.monotonic() - began
+            if began >= measure_from:
+                with lock:
+                    samples.append((name, elapsed, ok))
+            time.sleep(rng.uniform(0, 2 * think))
+
+    threads = [threading.Thread(target=user_loop, args=(i,), daemon=True) for i in range(users)]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.01)  # stagger logins a little
+    for thread in threads:
+        thread.join(timeout + stop_at - time.monotonic() + 5)
+    return samples, duration
+
+
+def _upstream_calls(mock_url):
+    try:
+        return requests.get(mock_url + "/_stats", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def _wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def _start_mock(port, profile):
+    command = [sys.executable, os.path.join(BENCH_DIR, "mock_tiktok.py"), "--port", str(port)]
+    if profile:
+        command += ["--profile", profile]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_until_up(f"http://127.0.0.1:{port}/_stats")
+    return process
+
+
+def _start_app(port, mock_url, workers, threads, mode, data_dir, extra_env):
+    env = dict(os.environ)
+    env.update({
+        "TIKTOK_BASE_URL": mock_url + "/open_api/v1.3",
+        "TIKTOK_ACCESS_TOKEN": "bench-token",
+        "TIKTOK_ADVERTISER_ID": "bench-advertiser",
+        "AUTH_USERNAME": USERNAME,
+        "AUTH_PASSWORD": PASSWORD,
+        "DATA_DIR": data_dir,
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(data_dir, "metrics"),
+        "WORKER_MODE": mode,
+        "LOG_LEVEL": "WARNING",
+        # The bench measures the app, not the per-token outbound limit
+        "TIKTOK_RATE_LIMIT": env.get("TIKTOK_RATE_LIMIT", "1000"),
+    })
+    env.update(extra_env)
+    command = ["gunicorn", "app:app", "--config", "gunicorn_config.py", "--bind", f"127.0.0.1:{port}",
+               "--workers", str(workers), "--threads", str(threads), "--access-logfile", os.devnull]
+    process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_until_up(f"http://127.0.0.1:{port}/login")
+    return process
+
+
+def _stop(process):
+    process.terminate()
+    try:
+        process.wait(15)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def baseline_path(report):
+    server = report["server"]
+    name = f"{report['scenario']}-{report['profile']}-{server['mode']}-w{server['workers']}-t{server['threads']}-u{report['users']}.json"
+    return os.path.join(BASELINES_DIR, name)
+
+
+def compare(report, baseline, tolerance):
+    """Regression messages for `report` against `baseline` (empty when within tolerance)."""
+    problems = []
+    new, old = report["results"]["overall"], baseline["results"]["overall"]
+    if old["rps"] and new["rps"] < old["rps"] * (1 - tolerance):
+        problems.append(f"throughput {new['rps']} rps < baseline {old['rps']} rps")
+    for op, stats in report["results"]["operations"].items():
+        before = baseline["results"]["operations"].get(op)
+        if before and before["p95_ms"] and stats["p95_ms"] and stats["p95_ms"] > before["p95_ms"] * (1 + tolerance):
+            problems.append(f"{op} p95 {stats['p95_ms']}ms > baseline {before['p95_ms']}ms")
+    old_amp, new_amp = baseline.get("amplification"), report.get("amplification")
+    if old_amp and new_amp and new_amp["ratio"] > old_amp["ratio"] * (1 + tolerance):
+        problems.append(f"upstream amplification {new_amp['ratio']} > baseline {old_amp['ratio']}")
+    return problems
+
+
+def print_report(report):
+    server = report["server"]
+    print(f"\n== {report['scenario']} | {server['mode']} workers={server['workers']} threads={server['threads']} "
+          f"| users={report['users']} {report['duration']}s")
+    print(f"{'operation':<22}{'reqs':>7}{'rps':>8}{'err%':>7}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    rows = list(report["results"]["operations"].items()) + [("TOTAL", report["results"]["overall"])]
+    for op, s in rows:
+        print(f"{op:<22}{s['requests']:>7}{s['rps']:>8}{s['error_rate'] * 100:>7.1f}"
+              f"{s['p50_ms'] or 0:>9}{s['p95_ms'] or 0:>9}{s['p99_ms'] or 0:>9}{s['max_ms'] or 0:>9}")
+    amplification = report.get("amplification")
+    if amplification:
+        print(f"upstream calls: {amplification['upstream_calls']} for {amplification['app_requests']} app requests "
+              f"(x{amplification['ratio']})")
+
+
+def run_one(args, workers, threads, mode):
+    mock_process = app_process = None
+    mock_url = args.mock_url
+    try:
+        if args.app_url:
+            base_url = args.app_url.rstrip("/")
+        else:
+            if not mock_url:
+                mock_process = _start_mock(args.mock_port, args.profile)
+                mock_url = f"http://127.0.0.1:{args.mock_port}"
+            data_dir = tempfile.mkdtemp(prefix="bench-data-")
+            app_process = _start_app(args.app_port, mock_url, workers, threads, mode, data_dir,
+                                     dict(kv.split("=", 1) for kv in args.env))
+            base_url = f"http://127.0.0.1:{args.app_port}"
+
+        before = _upstream_calls(mock_url) if mock_url else None
+        samples, seconds = run_load(base_url, args.scenario, args.users, args.duration, args.warmup, args.timeout)
+        after = _upstream_calls(mock_url) if mock_url else None
+    finally:
+        if app_process:
+            _stop(app_process)
+        if mock_process:
+            _stop(mock_process)
+
+    report = {
+        "scenario": args.scenario,
+        "users": args.users,
+        "duration": args.duration,
+        "profile": os.path.splitext(os.path.basename(args.profile))[0] if args.profile else "default",
+        "server": {"mode": mode, "workers": workers, "threads": threads},
+        "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "results": summarize(samples, seconds),
+    }
+    if before and after:
+        # Counted over warmup too, so the ratio is slightly pessimistic for short runs
+        upstream = after["total"] - before["total"]
+        app_requests = report["results"]["overall"]["requests"]
+        report["amplification"] = {
+            "upstream_calls": upstream,
+            "app_requests": app_requests,
+            "ratio": round(upstream / app_requests, 3) if app_requests else None,
+            "by_path": {path: sum(outcomes.values()) - sum((before["by_path"].get(path) or {}).values())
+                        for path, outcomes in after["by_path"].items()},
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the app against a local TikTok stand-in")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="mixed")
+    parser.add_argument("--users", type=int, default=20, help="concurrent simulated users")
+    parser.add_argument("--duration", type=int, default=30, help="measured seconds per run")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured seconds before each run")
+    parser.add_argument("--timeout", type=float, default=60, help="per-request timeout (seconds)")
+    parser.add_argument("--workers", default="2", help="comma-separated gunicorn worker counts to try")
+    parser.add_argument("--threads", default="2", help="comma-separated gunicorn thread counts to try")
+    parser.add_argument("--mode", default="sync", help="comma-separated WORKER_MODE values to try (sync, async)")
+    parser.add_argument("--profile", help="mock latency/error profile (JSON), e.g. bench/profiles/degraded.json")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="extra app environment")
+    parser.add_argument("--app-port", type=int, default=5100)
+    parser.add_argument("--mock-port", type=int, default=5999)
+    parser.add_argument("--app-url", help="benchmark an already running app instead of starting one")
+    parser.add_argument("--mock-url", help="an already running mock_tiktok.py (used for amplification)")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression against the baseline")
+    args = parser.parse_args()
+
+    regressions = []
+    combinations = itertools.product(args.mode.split(","), args.workers.split(","), args.threads.split(","))
+    for mode, workers, threads in combinations:
+        report = run_one(args, int(workers), int(threads), mode.strip())
+        print_report(report)
+
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stem = os.path.basename(baseline_path(report))[:-len(".json")]
+        with open(os.path.join(RESULTS_DIR, f"{stem}-{time.strftime('%Y%m%d-%H%M%S')}.json"), "w") as f:
+            json.dump(report, f, indent=2)
+
+        path = baseline_path(report)
+        if args.save_baseline:
+            os.makedirs(BASELINES_DIR, exist_ok=True)
+            with open(path, "w") as f:
+                json.dump(report, f, indent=2)
+            print(f"baseline saved: {os.path.relpath(path, ROOT)}")
+        elif os.path.exists(path):
+            with open(path) as f:
+                problems = compare(report, json.load(f), args.tolerance)
+            for problem in problems:
+                print(f"REGRESSION: {problem}")
+            if not problems:
+                print(f"within {args.tolerance:.0%} of {os.path.relpath(path, ROOT)}")
+            regressions += problems
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
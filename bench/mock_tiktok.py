@@ -0,0 +1,283 @@
+# bench/mock_tiktok.py
+"""
+Local stand-in for the parts of the TikTok Business API the app uses.
+
+Implements the /creative/aigc/*, /creative/digital_avatar/* and
+/file/video/ad/* endpoints with believable response shapes, so the app can
+be load tested without a real account. Point the app at it with
+
+    TIKTOK_BASE_URL=http://127.0.0.1:5999/open_api/v1.3
+
+Per endpoint family (script, avatar, file) a profile sets:
+
+    latency_ms     [median, p99] of a log-normal response time
+    error_rate     share of calls answered with HTTP 500
+    throttle_rate  share of calls answered with code 40100 (rate limited)
+    task_seconds   how long created tasks take to reach SUCCESS
+    url_uploads    (file only) whether UPLOAD_BY_URL is accepted; when false
+                   the app has to send the file itself
+
+Profiles come from --profile (a JSON file overriding DEFAULT_PROFILE) and
+can be changed while running with POST /_config. GET /_stats returns the
+number of calls per path and outcome; POST /_reset clears it.
+GET /_media/<bytes> streams a fake video of that size to upload from; the
+app only fetches it with MEDIA_CACHE_HOSTS=127.0.0.1 and MEDIA_ALLOW_PRIVATE=1.
+
+Task state is encoded in the task ID (creation time), so the server keeps
+nothing per task and restarts do not lose anything.
+"""
+import argparse
+import hashlib
+import itertools
+import json
+import math
+import random
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+from werkzeug.serving import WSGIRequestHandler
+
+PREFIX = "/open_api/v1.3"
+THROTTLE_CODE = 40100
+
+DEFAULT_PROFILE = {
+    "script": {"latency_ms": [250, 1200], "error_rate": 0.0, "throttle_rate": 0.0, "task_seconds": 8},
+    "avatar": {"latency_ms": [200, 900], "error_rate": 0.0, "throttle_rate": 0.0, "task_seconds": 20},
+    "file": {"latency_ms": [120, 600], "error_rate": 0.0, "throttle_rate": 0.0, "task_seconds": 0, "url_uploads": True},
+}
+
+mock = Flask(__name__)
+_profile = json.loads(json.dumps(DEFAULT_PROFILE))
+_calls = Counter()  # (path, outcome) -> count
+_lock = threading.Lock()
+_ids = itertools.count()
+
+AVATARS = [{"avatar_id": f"av{i:03d}", "avatar_name": f"Presenter {i}", "avatar_thumbnail": f"https://example.com/av/{i}.jpg"}
+           for i in range(24)]
+VIDEOS = [{"video_id": f"v{i:05d}", "file_name": f"clip_{i}.mp4", "duration": 5 + i % 55, "width": 720, "height": 1280,
+           "video_cover_url": f"https://example.com/cover/{i}.jpg", "create_time": f"2026-{1 + i % 9:02d}-{1 + i % 28:02d}T00:00:00Z"}
+          for i in range(1500)]
+SCRIPTS = [{"script_id": f"sc{i:04d}", "title": f"Script {i}", "script": f"Meet the product that changes mornings, take {i}.",
+            "create_time": f"2026-{1 + i % 9:02d}-{1 + i % 28:02d} 10:00:00"} for i in range(300)]
+
+
+def family_of(path):
+    if path.startswith("/creative/aigc/"):
+        return "script"
+    if path.startswith("/creative/digital_avatar/"):
+        return "avatar"
+    return "file"
+
+
+def _latency(median_ms, p99_ms):
+    sigma = math.log(max(p99_ms, median_ms) / median_ms) / 2.326 if median_ms > 0 else 0
+    return median_ms * math.exp(random.gauss(0, sigma)) / 1000 if median_ms > 0 else 0.0
+
+
+def _new_task_id(kind):
+    return f"{kind}-{int(time.time() * 1000)}-{next(_ids)}"
+
+
+def _task_status(task_id, task_seconds):
+    try:
+        age = time.time() - int(task_id.split("-")[1]) / 1000
+    except (IndexError, ValueError):
+        return "FAILED"
+    if age >= task_seconds:
+        return "SUCCESS"
+    return "PROCESSING" if age >= task_seconds / 4 else "SUBMITTED"
+
+
+def _ok(data):
+    return jsonify({"code": 0, "message": "OK", "request_id": f"mock{next(_ids)}", "data": data})
+
+
+def _page(items):
+    page = int(request.args.get("page", 1))
+    page_size = int(request.args.get("page_size", 20))
+    return {
+        "list": items[(page - 1) * page_size:page * page_size],
+        "page_info": {"page": page, "page_size": page_size, "total_number": len(items),
+                      "total_page": -(-len(items) // page_size)},
+    }
+
+
+@mock.before_request
+def _simulate():
+    """Apply the family's latency, then maybe fail or throttle the call."""
+    if not request.path.startswith(PREFIX):
+        return None
+    path = request.path[len(PREFIX):]
+    with _lock:
+        settings = dict(_profile[family_of(path)])
+    time.sleep(_latency(*settings["latency_ms"]))
+    roll = random.random()
+    if roll < settings["error_rate"]:
+        outcome, response = "error", ("upstream error", 500)
+    elif roll < settings["error_rate"] + settings["throttle_rate"]:
+        outcome, response = "throttled", jsonify({"code": THROTTLE_CODE, "message": "Too many requests", "data": {}})
+    else:
+        outcome, response = "ok", None
+    with _lock:
+        _calls[(path, outcome)] += 1
+    return response
+
+
+# --- script generation ---
+
+@mock.post(PREFIX + "/creative/aigc/script_generation/task/create/")
+def script_create():
+    return _ok({"task_id": _new_task_id("st")})
+
+
+@mock.get(PREFIX + "/creative/aigc/script/task/get/")
+def script_get():
+    task_id = request.args.get("task_id", "")
+    status = _task_status(task_id, _profile["script"]["task_seconds"])
+    data = {"task_id": task_id, "status": status}
+    if status == "SUCCESS":
+        data["list"] = [{"script_id": f"{task_id}-{i}", "script": f"Generated script {i} for {task_id}"} for i in range(3)]
+    return _ok(data)
+
+
+@mock.get(PREFIX + "/creative/aigc/script/list/")
+def script_list():
+    return _ok(_page(SCRIPTS))
+
+
+# --- digital avatars ---
+
+@mock.get(PREFIX + "/creative/digital_avatar/get/")
+def avatar_get():
+    return _ok(_page(AVATARS))
+
+
+@mock.post(PREFIX + "/creative/digital_avatar/video/task/create/")
+def avatar_create():
+    packages = (request.get_json(silent=True) or {}).get("material_packages") or []
+    return _ok({"list": [{"task_id": _new_task_id("at"), "package_id": p.get("package_id")} for p in packages]})
+
+
+@mock.get(PREFIX + "/creative/digital_avatar/video/task/get/")
+def avatar_task_get():
+    task_ids = json.loads(request.args.get("task_ids") or "[]")
+    task_seconds = _profile["avatar"]["task_seconds"]
+    results = []
+    for task_id in task_ids:
+        status = _task_status(task_id, task_seconds)
+        item = {"task_id": task_id, "status": status}
+        if status == "SUCCESS":
+            item.update({"video_id": f"vid-{task_id}", "preview_url": f"https://example.com/preview/{task_id}.mp4"})
+        results.append(item)
+    return _ok({"list": results})
+
+
+@mock.get(PREFIX + "/creative/digital_avatar/video/list/")
+def avatar_video_list():
+    return _ok(_page(VIDEOS[:200]))
+
+
+# --- ad videos ---
+
+@mock.get(PREFIX + "/file/video/ad/search/")
+def video_search():
+    return _ok(_page(VIDEOS))
+
+
+@mock.get(PREFIX + "/file/video/ad/info/")
+def video_info():
+    wanted = set(json.loads(request.args.get("video_ids") or "[]"))
+    return _ok({"list": [video for video in VIDEOS if video["video_id"] in wanted]})
+
+
+@mock.post(PREFIX + "/file/video/ad/update/")
+def video_update():
+    return _ok({})
+
+
+@mock.post(PREFIX + "/file/video/ad/upload/")
+def video_upload():
+    if request.mimetype == "multipart/form-data":
+        upload_type = request.form.get("upload_type")
+        name = request.form.get("file_name") or "upload.mp4"
+        md5 = hashlib.md5()
+        size = 0
+        video_file = request.files.get("video_file")
+        for chunk in iter(lambda: video_file.stream.read(1024 * 1024), b"") if video_file else ():
+            md5.update(chunk)
+            size += len(chunk)
+        if upload_type != "UPLOAD_BY_FILE" or not size:
+            return jsonify({"code": 40002, "message": "video_file is required", "data": {}})
+        if md5.hexdigest() != request.form.get("video_signature"):
+            return jsonify({"code": 40002, "message": "video_signature does not match the file", "data": {}})
+    else:
+        body = request.get_json(silent=True) or {}
+        name, size = body.get("file_name") or "upload.mp4", 0
+        if body.get("upload_type") != "UPLOAD_BY_URL" or not body.get("video_url"):
+            return jsonify({"code": 40002, "message": "video_url is required", "data": {}})
+        if not _profile["file"].get("url_uploads", True):
+            return jsonify({"code": 40002, "message": "The video URL cannot be accessed", "data": {}})
+    return _ok([{"video_id": f"v-up-{next(_ids)}", "file_name": name, "size": size, "format": "mp4"}])
+
+
+@mock.get("/_media/<int:size>")
+def media(size):
+    """A fake video of `size` bytes, streamed in 64 KiB pieces."""
+    block = bytes(range(256)) * 256
+
+    def generate():
+        for start in range(0, size, len(block)):
+            yield block[:min(len(block), size - start)]
+    return Response(generate(), mimetype="video/mp4", headers={"Content-Length": str(size)})
+
+
+# --- control ---
+
+@mock.get("/_stats")
+def stats():
+    with _lock:
+        calls = dict(_calls)
+    by_path = {}
+    for (path, outcome), count in calls.items():
+        by_path.setdefault(path, {})[outcome] = count
+    return jsonify({"total": sum(calls.values()), "by_path": by_path})
+
+
+@mock.post("/_reset")
+def reset():
+    with _lock:
+        _calls.clear()
+    return jsonify({"ok": True})
+
+
+@mock.post("/_config")
+def config():
+    """Body: {"<family>": {<settings to change>}, ...}"""
+    _apply(request.get_json(force=True) or {})
+    return jsonify(_profile)
+
+
+def _apply(overrides):
+    with _lock:
+        for family, settings in overrides.items():
+            _profile.setdefault(family, dict(DEFAULT_PROFILE["file"])).update(settings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5999)
+    parser.add_argument("--profile", help="JSON file with per-family overrides of DEFAULT_PROFILE")
+    args = parser.parse_args()
+    if args.profile:
+        with open(args.profile) as f:
+            _apply(json.load(f))
+    # Keep-alive, like the real API, so the app's connection pool is exercised
+    WSGIRequestHandler.protocol_version = "HTTP/1.1"
+    mock.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# build_static.py
+"""
+Static build for the app's pages.
+
+The pages under static/ inline all of their CSS and JS, so every visit
+downloads everything again. The build moves each inline <style> and
+<script> block into a content-hashed file under BUILD_DIR/assets/ (blocks
+that are identical across pages become one shared file), writes .gz and
+.br (brotli, when installed) siblings of each asset next to it, and
+leaves a small HTML shell per page that links to them. Asset names change
+whenever their content does, so they can be cached forever; only the
+shell is revalidated.
+
+    python build_static.py          # build into ./build
+
+The app also calls build_if_stale() at startup, which rebuilds only when
+a source page changed since the last build.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+
+try:
+    import brotli
+except ImportError:  # optional; .gz only
+    brotli = None
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BUILD_DIR = os.getenv("STATIC_BUILD_DIR", os.path.join(ROOT, "build"))
+
+# page name -> source file
+PAGES = {
+    "index": os.path.join(ROOT, "static", "index.html"),
+    "script_generator": os.path.join(ROOT, "static", "script_generator", "index.html"),
+    "avatar": os.path.join(ROOT, "static", "avatar", "index.html"),
+}
+
+INLINE_STYLE = re.compile(r"<style>(.*?)</style>", re.DOTALL)
+INLINE_SCRIPT = re.compile(r"<script>(.*?)</script>", re.DOTALL)
+ASSET_URL = "/assets/"
+
+
+def _write(path, data: bytes):
+    # Write-then-rename so a worker never serves a half-written file
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _sources_hash():
+    digest = hashlib.sha256()
+    for name, path in sorted(PAGES.items()):
+        digest.update(name.encode())
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def _emit_asset(assets_dir, text, ext, written):
+    data = text.strip().encode() + b"\n"
+    name = f"{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+    if name not in written:
+        path = os.path.join(assets_dir, name)
+        _write(path, data)
+        _write(path + ".gz", gzip.compress(data, compresslevel=9, mtime=0))
+        if brotli is not None:
+            _write(path + ".br", brotli.compress(data, quality=11))
+        written.add(name)
+    return ASSET_URL + name
+
+
+def build(build_dir=BUILD_DIR):
+    """Build every page; returns the manifest that was written."""
+    assets_dir = os.path.join(build_dir, "assets")
+    os.makedirs(assets_dir, exist_ok=True)
+    written = set()
+    manifest = {"sources": _sources_hash(), "pages": {}}
+
+    for page, source in PAGES.items():
+        with open(source, encoding="utf-8") as f:
+            html = f.read()
+        html = INLINE_STYLE.sub(
+            lambda m: f'<link rel="stylesheet" href="{_emit_asset(assets_dir, m.group(1), "css", written)}">', html
+        )
+        # An external classic script runs at the same point of parsing as the inline one did
+        html = INLINE_SCRIPT.sub(
+            lambda m: f'<script src="{_emit_asset(assets_dir, m.group(1), "js", written)}"></script>', html
+        )
+        shell = os.path.join(build_dir, f"{page}.html")
+        _write(shell, html.encode("utf-8"))
+        manifest["pages"][page] = shell
+
+    # Drop assets from earlier builds that no page links to any more
+    for name in os.listdir(assets_dir):
+        if name.split(".gz")[0].split(".br")[0] not in written and not name.endswith(".tmp"):
+            os.remove(os.path.join(assets_dir, name))
+
+    _write(os.path.join(build_dir, "manifest.json"), json.dumps(manifest, indent=2).encode())
+    return manifest
+
+
+def build_if_stale(build_dir=BUILD_DIR):
+    """Rebuild unless the manifest already matches the current sources."""
+    try:
+        with open(os.path.join(build_dir, "manifest.json")) as f:
+            manifest = json.load(f)
+        if manifest.get("sources") == _sources_hash() and all(os.path.exists(p) for p in manifest["pages"].values()):
+            return manifest
+    except (OSError, ValueError, KeyError):
+        pass
+    return build(build_dir)
+
+
+if __name__ == "__main__":
+    out = sys.argv[1] if len(sys.argv) > 1 else BUILD_DIR
+    result = build(out)
+    print(f"Built {len(result['pages'])} pages into {out}")
@@ -0,0 +1,520 @@
+# bulk_jobs.py
+"""
+Durable bulk avatar-video jobs.
+
+A job is a manifest of (avatar_id, script, video_name) rows uploaded as
+JSONL or CSV. Everything lives in SQLite under DATA_DIR, so jobs survive a
+restart:
+
+- every manifest row becomes an item in state `pending`
+- a runner thread in each worker leases jobs (one worker per job at a
+  time; a lease that is not renewed expires and another worker takes the
+  job over), submits pending items as `material_packages` batches of
+  `batch_size` at most once per `submit_interval` seconds and records the
+  returned task IDs; a batch TikTok turns away with throttling or a server
+  error goes back to `pending` and is sent again `retry_interval` seconds
+  later
+- submitted items are followed through the task tracker until TikTok
+  reports SUCCESS or FAILED; an item whose task ID TikTok rejects
+  `max_rejections` polls in a row, or that has no final status
+  `task_timeout` seconds after it was submitted, is failed instead of
+  keeping the job open forever
+
+Items are marked `submitting` before their batch is sent. If the process
+dies mid-request those items are failed on resume instead of being sent
+again, so a crash never creates duplicate paid renders.
+
+Resuming needs the access token, so unlike the other stores the jobs table
+keeps it - except for the server's own TIKTOK_ACCESS_TOKEN, which is stored
+as an empty string and taken from `default_token` again at run time.
+"""
+import csv
+import io
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+import requests
+
+from rate_limiter import THROTTLE_CODES
+from tiktok_client import never_sent
+
+log = logging.getLogger(__name__)
+
+CREATE_PATH = "/creative/digital_avatar/video/task/create/"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL DEFAULT '',
+    access_token TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'running',
+    total INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    next_submit_at REAL NOT NULL DEFAULT 0,
+    next_poll_at REAL NOT NULL DEFAULT 0,
+    lease_owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    job_id TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    avatar_id TEXT NOT NULL,
+    script TEXT NOT NULL,
+    video_name TEXT,
+    state TEXT NOT NULL DEFAULT 'pending',
+    task_id TEXT,
+    error TEXT,
+    result TEXT,
+    submitted_at REAL,
+    finished_at REAL,
+    PRIMARY KEY (job_id, idx)
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (job_id, state);
+"""
+
+ITEM_STATES = ("pending", "submitting", "submitted", "success", "failed")
+
+
+class ManifestError(ValueError):
+    pass
+
+
+def parse_manifest(raw: bytes, filename="", content_type="", max_items=20000):
+    """
+    Parse a JSONL or CSV manifest into a list of package dicts.
+    Raises ManifestError with the offending line number on bad input.
+    """
+    text = raw.decode("utf-8-sig")
+    stripped = text.lstrip()
+    is_jsonl = (
+        filename.endswith((".jsonl", ".ndjson", ".json"))
+        or "json" in content_type
+        or (not filename.endswith(".csv") and "csv" not in content_type and stripped.startswith("{"))
+    )
+
+    rows = []
+    if is_jsonl:
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ManifestError(f"line {line_no}: invalid JSON ({e.msg})")
+            if not isinstance(row, dict):
+                raise ManifestError(f"line {line_no}: expected a JSON object")
+            rows.append((line_no, row))
+    else:
+        reader = csv.DictReader(io.StringIO(text))
+        if not reader.fieldnames or "avatar_id" not in reader.fieldnames or "script" not in reader.fieldnames:
+            raise ManifestError("CSV header must include avatar_id and script columns")
+        for row in reader:
+            rows.append((reader.line_num, row))
+
+    packages = []
+    for line_no, row in rows:
+        avatar_id = str(row.get("avatar_id") or "").strip()
+        script = str(row.get("script") or "").strip()
+        if not avatar_id:
+            raise ManifestError(f"line {line_no}: avatar_id is required")
+        if not script:
+            raise ManifestError(f"line {line_no}: script is required")
+        packages.append({
+            "avatar_id": avatar_id,
+            "script": script,
+            "video_name": str(row.get("video_name") or "").strip() or None,
+        })
+    if not packages:
+        raise ManifestError("manifest is empty")
+    if len(packages) > max_items:
+        raise ManifestError(f"manifest has {len(packages)} rows; the limit is {max_items}")
+    return packages
+
+
+def _transient(error):
+    """Whether a (body, status_code) error from TikTok is throttling or a server error, worth polling again."""
+    body, status_code = error
+    return status_code == 429 or status_code >= 500 or str(body.get("code")) in THROTTLE_CODES
+
+
+class BulkJobRunner:
+    def __init__(self, path, client, task_tracker, default_token="", batch_size=10, submit_interval=2.0,
+                 poll_interval=10.0, lease_seconds=60, tick=1.0, max_rejections=5, task_timeout=6 * 3600,
+                 retry_interval=30.0):
+        self.path = path
+        self.client = client
+        self.task_tracker = task_tracker
+        self.default_token = default_token
+        self.batch_size = batch_size
+        self.submit_interval = submit_interval
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.tick = tick
+        self.max_rejections = max_rejections
+        self.task_timeout = task_timeout
+        self.retry_interval = retry_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pid = None
+        self._rejections = {}  # (job_id, task_id) -> polls in a row TikTok rejected it; lease holder only
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @property
+    def worker_id(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    # ---- API used by the routes ----
+
+    def create_job(self, access_token, packages, name=""):
+        job_id = uuid.uuid4().hex[:16]
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.execute(
+                "INSERT INTO jobs (job_id, name, access_token, total, created_at) VALUES (?, ?, ?, ?, ?)",
+                (job_id, name, "" if access_token == self.default_token else access_token,
+                 len(packages), time.time()),
+            )
+            db.executemany(
+                "INSERT INTO items (job_id, idx, avatar_id, script, video_name) VALUES (?, ?, ?, ?, ?)",
+                [(job_id, i, p["avatar_id"], p["script"], p.get("video_name")) for i, p in enumerate(packages)],
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        self.start()
+        return job_id
+
+    def cancel_job(self, job_id):
+        """Stop submitting; items already submitted keep being tracked."""
+        db = self._connect()
+        cur = db.execute("UPDATE jobs SET state = 'cancelling' WHERE job_id = ? AND state = 'running'", (job_id,))
+        return cur.rowcount == 1
+
+    def job_status(self, job_id):
+        db = self._connect()
+        row = db.execute(
+            "SELECT job_id, name, state, total, created_at, started_at, finished_at, lease_owner, last_error "
+            "FROM jobs WHERE job_id = ?", (job_id,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = dict(zip(("job_id", "name", "state", "total", "created_at", "started_at", "finished_at",
+                        "worker", "last_error"), row))
+        counts = dict.fromkeys(ITEM_STATES, 0)
+        counts.update(db.execute("SELECT state, COUNT(*) FROM items WHERE job_id = ? GROUP BY state",
+                                 (job_id,)).fetchall())
+        job["items"] = counts
+
+        done = counts["success"] + counts["failed"]
+        submitted = done + counts["submitted"] + counts["submitting"]
+        job["progress"] = round(done / job["total"], 4) if job["total"] else 1.0
+
+        # Throughput over the job's lifetime so far
+        if job["started_at"]:
+            elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+            minutes = max(elapsed / 60, 1 / 60)
+            job["throughput"] = {
+                "elapsed_seconds": round(elapsed, 1),
+                "submitted_per_minute": round(submitted / minutes, 2),
+                "completed_per_minute": round(done / minutes, 2),
+            }
+            rate = done / minutes
+            remaining = job["total"] - done
+            job["eta_seconds"] = round(remaining / rate * 60) if rate and remaining else None
+        return job
+
+    def list_jobs(self, limit=50):
+        rows = self._connect().execute(
+            "SELECT job_id FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [self.job_status(job_id) for (job_id,) in rows]
+
+    def job_items(self, job_id, state=None, page=1, page_size=100):
+        where, args = "job_id = ?", [job_id]
+        if state:
+            where += " AND state = ?"
+            args.append(state)
+        db = self._connect()
+        total = db.execute(f"SELECT COUNT(*) FROM items WHERE {where}", args).fetchone()[0]
+        rows = db.execute(
+            f"SELECT idx, avatar_id, video_name, state, task_id, error, result, submitted_at, finished_at "
+            f"FROM items WHERE {where} ORDER BY idx LIMIT ? OFFSET ?",
+            args + [page_size, (page - 1) * page_size],
+        ).fetchall()
+        items = []
+        for row in rows:
+            item = dict(zip(("index", "avatar_id", "video_name", "state", "task_id", "error", "result",
+                             "submitted_at", "finished_at"), row))
+            item["result"] = json.loads(item["result"]) if item["result"] else None
+            items.append(item)
+        return items, {"page": page, "page_size": page_size, "total_number": total,
+                       "total_page": max(1, -(-total // page_size))}
+
+    # ---- runner ----
+
+    def start(self):
+        # One runner thread per worker process; re-spawned after a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="bulk-jobs", daemon=True).start()
+
+    def _run(self):
+        while True:
+            try:
+                for job_id in self._lease_jobs():
+                    self._step(job_id)
+            except Exception:
+                log.exception("Bulk job runner error")
+            time.sleep(self.tick)
+
+    def _lease_jobs(self):
+        now = time.time()
+        db = self._connect()
+        leased = []
+        rows = db.execute("SELECT job_id FROM jobs WHERE state IN ('running', 'cancelling')").fetchall()
+        for (job_id,) in rows:
+            cur = db.execute(
+                "UPDATE jobs SET lease_owner = ?, lease_until = ? "
+                "WHERE job_id = ? AND (lease_owner = ? OR lease_until < ?)",
+                (self.worker_id, now + self.lease_seconds, job_id, self.worker_id, now),
+            )
+            if cur.rowcount == 1:
+                leased.append(job_id)
+        return leased
+
+    def _step(self, job_id):
+        db = self._connect()
+        access_token, state, next_submit_at, next_poll_at = db.execute(
+            "SELECT access_token, state, next_submit_at, next_poll_at FROM jobs WHERE job_id = ?", (job_id,),
+        ).fetchone()
+        access_token = access_token or self.default_token
+        now = time.time()
+
+        # Items left in `submitting` by a worker that died mid-request
+        db.execute(
+            "UPDATE items SET state = 'failed', finished_at = ?, "
+            "error = 'interrupted while submitting; not resent to avoid duplicate renders' "
+            "WHERE job_id = ? AND state = 'submitting'",
+            (now, job_id),
+        )
+
+        if state == "cancelling":
+            db.execute(
+                "UPDATE items SET state = 'failed', error = 'cancelled', finished_at = ? "
+                "WHERE job_id = ? AND state = 'pending'", (now, job_id),
+            )
+        elif now >= next_submit_at:
+            retry = self._submit_batch(job_id, access_token)
+            db.execute("UPDATE jobs SET next_submit_at = ?, started_at = COALESCE(started_at, ?) WHERE job_id = ?",
+                       (now + (self.retry_interval if retry else self.submit_interval), now, job_id))
+
+        if now >= next_poll_at:
+            self._poll(job_id, access_token)
+            db.execute("UPDATE jobs SET next_poll_at = ? WHERE job_id = ?", (now + self.poll_interval, job_id))
+
+        open_items = db.execute(
+            "SELECT COUNT(*) FROM items WHERE job_id = ? AND state IN ('pending', 'submitting', 'submitted')",
+            (job_id,),
+        ).fetchone()[0]
+        if open_items == 0:
+            db.execute(
+                "UPDATE jobs SET state = CASE WHEN state = 'cancelling' THEN 'cancelled' ELSE 'finished' END, "
+                "finished_at = ?, lease_owner = NULL WHERE job_id = ?", (time.time(), job_id),
+            )
+
+    def _submit_batch(self, job_id, access_token):
+        """Send the next pending batch; True when it went back to pending to be sent again later."""
+        db = self._connect()
+        rows = db.execute(
+            "SELECT idx, avatar_id, script, video_name FROM items WHERE job_id = ? AND state = 'pending' "
+            "ORDER BY idx LIMIT ?", (job_id, self.batch_size),
+        ).fetchall()
+        if not rows:
+            return False
+        indexes = [row[0] for row in rows]
+        marks = ",".join("?" * len(indexes))
+        db.execute(f"UPDATE items SET state = 'submitting' WHERE job_id = ? AND idx IN ({marks})",
+                   [job_id] + indexes)
+
+        packages = []
+        for _, avatar_id, script, video_name in rows:
+            package = {"avatar_id": avatar_id, "script": script}
+            if video_name:
+                package["video_name"] = video_name
+            packages.append(package)
+
+        try:
+            r = self.client.post(CREATE_PATH, access_token, json={"material_packages": packages})
+        except requests.RequestException as e:
+            # Retry only what certainly never reached TikTok; anything else may have created tasks
+            retry = never_sent(e)
+            db.execute(
+                f"UPDATE items SET state = ?, error = ?, finished_at = ? WHERE job_id = ? AND idx IN ({marks})",
+                ["pending" if retry else "failed", str(e), None if retry else time.time(), job_id] + indexes,
+            )
+            db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?", (str(e), job_id))
+            return retry
+
+        try:
+            body = r.json()
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            body = {"code": None, "message": f"non-JSON response (HTTP {r.status_code})"}
+
+        now = time.time()
+        if r.status_code != 200 or str(body.get("code")) != "0":
+            message = f"{body.get('code')}: {body.get('message')}"
+            # Throttling or a server error turned the batch away; only a clear rejection fails it
+            retry = _transient((body, r.status_code))
+            db.execute(
+                f"UPDATE items SET state = ?, error = ?, finished_at = ? WHERE job_id = ? AND idx IN ({marks})",
+                ["pending" if retry else "failed", message, None if retry else now, job_id] + indexes,
+            )
+            db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?", (message, job_id))
+            return retry
+
+        results = (body.get("data") or {}).get("list") or []
+        task_ids = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for position, idx in enumerate(indexes):
+                result = results[position] if position < len(results) else {}
+                task_id = result.get("task_id")
+                if task_id:
+                    task_ids.append(task_id)
+                    db.execute(
+                        "UPDATE items SET state = 'submitted', task_id = ?, submitted_at = ?, error = NULL "
+                        "WHERE job_id = ? AND idx = ?", (task_id, now, job_id, idx),
+                    )
+                else:
+                    db.execute(
+                        "UPDATE items SET state = 'failed', error = ?, finished_at = ? WHERE job_id = ? AND idx = ?",
+                        (result.get("error_msg") or "no task_id returned", now, job_id, idx),
+                    )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if task_ids:
+            self.task_tracker.track("avatar", access_token, task_ids)
+        return False
+
+    def _poll(self, job_id, access_token):
+        db = self._connect()
+        rows = db.execute(
+            "SELECT idx, task_id FROM items WHERE job_id = ? AND state = 'submitted'", (job_id,)
+        ).fetchall()
+        if not rows:
+            return
+        by_task = {task_id: idx for idx, task_id in rows}
+        task_ids = list(by_task)
+        now = time.time()
+
+        # Tasks TikTok never finished in time would keep the job open forever
+        cur = db.execute(
+            "UPDATE items SET state = 'failed', finished_at = ?, error = ? "
+            "WHERE job_id = ? AND state = 'submitted' AND submitted_at < ?",
+            (now, f"no final status from TikTok within {self.task_timeout // 60} minutes", job_id,
+             now - self.task_timeout),
+        )
+        if cur.rowcount:
+            db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?",
+                       (f"{cur.rowcount} task(s) timed out", job_id))
+
+        # Chunks of the tracker's batch size, so a rejection is about exactly one upstream call
+        step = self.task_tracker.batch_size
+        for i in range(0, len(task_ids), step):
+            chunk = task_ids[i:i + step]
+            try:
+                # The tracker batches the upstream calls and keeps polling in between
+                tasks, error = self.task_tracker.lookup("avatar", access_token, chunk)
+                if error is not None:
+                    tasks = self._isolate_rejected(job_id, access_token, chunk, tasks, error, by_task)
+            except (requests.RequestException, ValueError) as e:
+                db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?", (str(e), job_id))
+                return
+            for task_id in tasks:
+                self._rejections.pop((job_id, task_id), None)
+            for task_id, task in tasks.items():
+                if not task.done:
+                    continue
+                db.execute(
+                    "UPDATE items SET state = ?, result = ?, error = ?, finished_at = ? WHERE job_id = ? AND idx = ?",
+                    ("success" if task.status == "SUCCESS" else "failed", json.dumps(task.result),
+                     (task.result or {}).get("error_msg"), now, job_id, by_task[task_id]),
+                )
+
+    def _isolate_rejected(self, job_id, access_token, chunk, tasks, error, by_task):
+        """
+        Handle a batch TikTok answered with an error; returns the tasks found.
+        Throttling and server errors are transient and only noted. Otherwise
+        one bad ID fails the whole call, so the unresolved IDs are looked up
+        one by one and only those TikTok rejects on their own are counted.
+        """
+        body, status_code = error
+        db = self._connect()
+        if _transient(error):
+            db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?",
+                       (f"Task status poll failed ({body.get('code')}: {body.get('message')})", job_id))
+            return tasks
+        tasks = dict(tasks)
+        unresolved = [task_id for task_id in chunk if task_id not in tasks]
+        if len(unresolved) == 1:
+            self._rejected(job_id, unresolved, error, by_task)
+            return tasks
+        for task_id in unresolved:
+            found, one_error = self.task_tracker.lookup("avatar", access_token, [task_id])
+            tasks.update(found)
+            if one_error is not None and not _transient(one_error):
+                self._rejected(job_id, [task_id], one_error, by_task)
+        return tasks
+
+    def _rejected(self, job_id, task_ids, error, by_task):
+        """Count a rejection of these task IDs; fail the items TikTok rejected max_rejections times in a row."""
+        body, status_code = error
+        message = f"TikTok rejected the task ID ({body.get('code')}: {body.get('message')}, HTTP {status_code})"
+        db = self._connect()
+        db.execute("UPDATE jobs SET last_error = ? WHERE job_id = ?", (message, job_id))
+        give_up = []
+        for task_id in task_ids:
+            key = (job_id, task_id)
+            self._rejections[key] = self._rejections.get(key, 0) + 1
+            if self._rejections[key] >= self.max_rejections:
+                del self._rejections[key]
+                give_up.append(by_task[task_id])
+        if give_up:
+            marks = ",".join("?" * len(give_up))
+            db.execute(
+                f"UPDATE items SET state = 'failed', error = ?, finished_at = ? "
+                f"WHERE job_id = ? AND state = 'submitted' AND idx IN ({marks})",
+                [message, time.time(), job_id] + give_up,
+            )
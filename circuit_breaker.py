@@ -0,0 +1,133 @@
+# circuit_breaker.py
+"""
+Circuit breakers for the TikTok upstream, one per endpoint family.
+
+When TikTok is down or very slow every route would otherwise sit on its
+full read timeout and a sync worker pool runs out of threads. Each worker
+keeps a rolling window of the last `window` calls per family; once at
+least `min_calls` are in it and the share of failures (transport errors,
+5xx) or of calls slower than `slow_call_seconds` crosses its threshold,
+the breaker opens and calls fail immediately with CircuitOpen. After
+`open_seconds` it lets `half_open_probes` calls through: if they succeed
+it closes again, otherwise it reopens.
+"""
+import threading
+import time
+from collections import deque
+
+import requests
+
+from rate_limiter import family_of
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(requests.RequestException):
+    """The breaker for this endpoint family is open; nothing was sent to TikTok."""
+
+
+class CircuitBreaker:
+    def __init__(self, name, window=20, min_calls=10, failure_ratio=0.5, slow_call_seconds=10.0,
+                 slow_ratio=0.8, open_seconds=15.0, half_open_probes=1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_ratio = slow_ratio
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)  # (failed, slow)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._counters = {"rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                return HALF_OPEN
+            return self._state
+
+    def before(self):
+        """Raise CircuitOpen unless a call may go out now."""
+        with self._lock:
+            if self._state == OPEN:
+                remaining = self.open_seconds - (time.monotonic() - self._opened_at)
+                if remaining > 0:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpen(f"TikTok {self.name} API is failing; not calling it for another {remaining:.0f}s")
+                self._state, self._probes = HALF_OPEN, 0
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_probes:
+                    self._counters["rejected"] += 1
+                    raise CircuitOpen(f"TikTok {self.name} API is being probed after failures; try again shortly")
+                self._probes += 1
+
+    def record(self, failed: bool, duration: float):
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._open()
+                else:
+                    self._probes -= 1
+                    if self._probes <= 0:
+                        self._state = CLOSED
+                        self._outcomes.clear()
+                return
+            self._outcomes.append((failed, slow))
+            if self._state == CLOSED and len(self._outcomes) >= self.min_calls:
+                failures = sum(1 for f, _ in self._outcomes if f)
+                slows = sum(1 for _, s in self._outcomes if s)
+                if failures / len(self._outcomes) >= self.failure_ratio or slows / len(self._outcomes) >= self.slow_ratio:
+                    self._open()
+
+    def cancel(self):
+        """A call let through by before() was not sent after all."""
+        with self._lock:
+            if self._state == HALF_OPEN and self._probes > 0:
+                self._probes -= 1
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._counters["opened"] += 1
+
+    def stats(self):
+        state = self.state
+        with self._lock:
+            outcomes = list(self._outcomes)
+            counters = dict(self._counters)
+        return {
+            "state": state,
+            "calls_in_window": len(outcomes),
+            "failures_in_window": sum(1 for f, _ in outcomes if f),
+            "slow_in_window": sum(1 for _, s in outcomes if s),
+            **counters,
+        }
+
+
+class CircuitBreakers:
+    """Lazily created breaker per endpoint family, all sharing the same settings."""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def for_path(self, path):
+        family = family_of(path)
+        with self._lock:
+            breaker = self._breakers.get(family)
+            if breaker is None:
+                breaker = self._breakers[family] = CircuitBreaker(family, **self.settings)
+            return breaker
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {family: breaker.stats() for family, breaker in sorted(breakers.items())}
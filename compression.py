@@ -0,0 +1,145 @@
+# compression.py
+"""
+Response compression, strong ETags and conditional GETs.
+
+An after_request hook that, for successful GET/HEAD responses with a
+compressible content type:
+
+- computes a strong ETag from the uncompressed body and answers a
+  matching If-None-Match with an empty 304
+- compresses bodies of at least `min_size` bytes with brotli (if the
+  optional `brotli` package is installed) or gzip, whichever the client
+  prefers via Accept-Encoding; each encoding gets its own ETag suffix
+
+Compressed bodies are memoized by content hash in a small LRU, so pages
+and unchanged list refreshes are compressed once rather than per request.
+Streamed responses (SSE, relayed streams) are left alone.
+"""
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # optional; gzip only
+    brotli = None
+
+COMPRESSIBLE = ("text/", "application/json", "application/javascript", "image/svg+xml")
+ENCODING_SUFFIX = {"br": "-br", "gzip": "-gz"}
+
+
+def accepted_encodings(accept_encoding):
+    """Encodings the client accepts, best first (q-values honoured, q=0 excluded)."""
+    accepted = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        if params.strip().startswith("q="):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        if name and q > 0:
+            accepted[name.lower()] = q
+    choices = [e for e in ("br", "gzip") if e in accepted and (e != "br" or brotli is not None)]
+    return sorted(choices, key=lambda e: -accepted[e])
+
+
+def _tag_matches(if_none_match, base):
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        tag = tag.removeprefix("W/").strip('"')
+        for suffix in ENCODING_SUFFIX.values():
+            tag = tag.removesuffix(suffix)
+        if tag == base:
+            return True
+    return False
+
+
+class Compressor:
+    def __init__(self, min_size=1024, gzip_level=6, brotli_quality=5, memo_entries=128, memo_max_body=2 * 1024 * 1024):
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.memo_entries = memo_entries
+        self.memo_max_body = memo_max_body
+        self._memo = OrderedDict()  # (digest, encoding) -> compressed bytes
+        self._lock = threading.Lock()
+        self._counters = {"compressed": 0, "memo_hits": 0, "not_modified": 0, "bytes_in": 0, "bytes_out": 0}
+
+    def _compress(self, body, digest, encoding):
+        key = (digest, encoding)
+        with self._lock:
+            cached = self._memo.get(key)
+            if cached is not None:
+                self._memo.move_to_end(key)
+                self._counters["memo_hits"] += 1
+                return cached
+        if encoding == "br":
+            out = brotli.compress(body, quality=self.brotli_quality)
+        else:
+            out = gzip.compress(body, compresslevel=self.gzip_level, mtime=0)
+        if len(body) <= self.memo_max_body:
+            with self._lock:
+                self._memo[key] = out
+                while len(self._memo) > self.memo_entries:
+                    self._memo.popitem(last=False)
+        return out
+
+    def process(self, req, response):
+        """Add an ETag, answer 304 or compress `response` for the request `req`."""
+        if req.method not in ("GET", "HEAD") or response.status_code != 200:
+            return response
+        if response.is_streamed and not response.direct_passthrough:
+            return response  # generators: SSE and relayed streams
+        if "Content-Encoding" in response.headers:
+            return response
+        if not (response.mimetype or "").startswith(COMPRESSIBLE):
+            return response
+
+        # send_from_directory hands back a file wrapper; read it so it can be hashed
+        response.direct_passthrough = False
+        body = response.get_data()
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        response.headers.add("Vary", "Accept-Encoding")
+        response.headers.setdefault("Cache-Control", "private, no-cache")
+
+        encodings = accepted_encodings(req.headers.get("Accept-Encoding", "")) if len(body) >= self.min_size else []
+        encoding = encodings[0] if encodings else None
+        response.headers["ETag"] = f'"{digest}{ENCODING_SUFFIX.get(encoding, "")}"'
+        response.headers.pop("Last-Modified", None)
+
+        if _tag_matches(req.headers.get("If-None-Match", ""), digest):
+            with self._lock:
+                self._counters["not_modified"] += 1
+            response.status_code = 304
+            response.set_data(b"")
+            response.headers.pop("Content-Length", None)
+            return response
+
+        if encoding:
+            compressed = self._compress(body, digest, encoding)
+            response.set_data(compressed)
+            response.headers["Content-Encoding"] = encoding
+            with self._lock:
+                self._counters["compressed"] += 1
+                self._counters["bytes_in"] += len(body)
+                self._counters["bytes_out"] += len(compressed)
+        return response
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        counters["ratio"] = round(counters["bytes_out"] / counters["bytes_in"], 3) if counters["bytes_in"] else None
+        counters["brotli"] = brotli is not None
+        return counters
+
+    def init_app(self, app):
+        @app.after_request
+        def _compress_response(response):
+            return self.process(request, response)
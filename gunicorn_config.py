@@ -2,15 +2,28 @@
 
 import multiprocessing
 import os
+import shutil
+import tempfile
 
 # Server socket
 bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
 backlog = 2048
 
 # Worker processes
-workers = multiprocessing.cpu_count() * 2 + 1
-worker_class = 'sync'
-worker_connections = 1000
+# WORKER_MODE picks the execution model:
+#   sync  - one request per worker thread (default, the original setup)
+#   async - gevent workers: the same Flask routes run as greenlets on an event
+#           loop and the monkey-patched sockets make TikTok calls non-blocking,
+#           so one process can hold hundreds of in-flight upstream requests
+worker_mode = os.environ.get('WORKER_MODE', 'sync').lower()
+if worker_mode == 'async':
+    workers = multiprocessing.cpu_count() + 1
+    worker_class = 'gevent'
+else:
+    workers = multiprocessing.cpu_count() * 2 + 1
+    worker_class = 'sync'
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
 timeout = 120
 keepalive = 2
 
@@ -24,6 +37,9 @@ errorlog = '-'
 loglevel = 'info'
 access_log_format = '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s'
 
+# Workers write Prometheus samples here so /metrics can sum them (see metrics.py)
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(tempfile.gettempdir(), 'tiktok-symphony-metrics'))
+
 # Process naming
 proc_name = 'tiktok-symphony-ai'
 
@@ -37,4 +53,25 @@ tmp_upload_dir = None
 
 # SSL (uncomment if using HTTPS)
 # keyfile = '/path/to/keyfile'
-# certfile = '/path/to/certfile'
\ No newline at end of file
+# certfile = '/path/to/certfile'
+
+
+def on_starting(server):
+    """Start every master run with an empty metrics directory."""
+    metrics_dir = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    """Drop a dead worker's live gauges; its counters keep counting toward the totals."""
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
+
+
+def post_fork(server, worker):
+    """Size each worker's TikTok connection pool to its concurrency."""
+    if server.cfg.worker_class_str == 'gevent':
+        # Every greenlet may be waiting on TikTok; cap sockets at a sane number
+        os.environ.setdefault('TIKTOK_POOL_SIZE', str(min(server.cfg.worker_connections, 200)))
+    os.environ.setdefault('GUNICORN_THREADS', str(server.cfg.threads))
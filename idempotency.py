@@ -0,0 +1,131 @@
+# idempotency.py
+"""
+Idempotency keys for the task-creating endpoints.
+
+Creating a script or avatar task costs money, so a create that is retried
+(flaky network, double click, client timeout) must not start a second
+task. A client sends an `Idempotency-Key` header (or `idempotency_key` in
+the body); the first request with that key runs and its response is
+stored, later ones get the stored response back. Keys are scoped to the
+access token and endpoint, and reusing one with a different body is an
+error. A key whose request never finished (its worker died mid-request)
+is given up after `lease_seconds`, so retries are not refused forever.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    owner TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    idem_key TEXT NOT NULL,
+    request_hash TEXT NOT NULL,
+    status_code INTEGER,
+    body BLOB,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (owner, endpoint, idem_key)
+);
+"""
+
+
+def owner_of(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def request_hash(data):
+    """Hash of the request body without the token or the key itself."""
+    body = {k: v for k, v in (data or {}).items() if k not in ("access_token", "idempotency_key")}
+    return hashlib.sha256(json.dumps(body, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, path, ttl=24 * 3600, lease_seconds=300, purge_every=200):
+        self.path = path
+        self.ttl = ttl
+        # Longer than any create can take (read timeouts plus the rate limiter's wait)
+        self.lease_seconds = lease_seconds
+        self.purge_every = purge_every
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {"started": 0, "replayed": 0, "conflicts": 0, "in_progress": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _count(self, name):
+        with self._lock:
+            self._counters[name] += 1
+            return self._counters[name]
+
+    def begin(self, access_token, endpoint, key, req_hash):
+        """
+        Claim a key. Returns ("new", None), ("done", (body, status_code)),
+        ("in_progress", None) or ("conflict", None) when the key was used
+        with a different request body.
+        """
+        db = self._connect()
+        now = time.time()
+        owner = owner_of(access_token)
+        cur = db.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (owner, endpoint, idem_key, request_hash, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (owner, endpoint, key, req_hash, now),
+        )
+        if cur.rowcount == 1:
+            if self._count("started") % self.purge_every == 0:
+                db.execute("DELETE FROM idempotency_keys WHERE created_at < ?", (now - self.ttl,))
+            return "new", None
+
+        row = db.execute(
+            "SELECT request_hash, status_code, body, created_at FROM idempotency_keys "
+            "WHERE owner = ? AND endpoint = ? AND idem_key = ?",
+            (owner, endpoint, key),
+        ).fetchone()
+        if row is None:
+            return self.begin(access_token, endpoint, key, req_hash)
+        stored_hash, status_code, body, created_at = row
+        if created_at < now - (self.ttl if status_code is not None else self.lease_seconds):
+            # Expired, or abandoned in progress by a worker that died; start over with this request
+            db.execute("DELETE FROM idempotency_keys WHERE owner = ? AND endpoint = ? AND idem_key = ? "
+                       "AND created_at = ?", (owner, endpoint, key, created_at))
+            return self.begin(access_token, endpoint, key, req_hash)
+        if stored_hash != req_hash:
+            self._count("conflicts")
+            return "conflict", None
+        if status_code is None:
+            self._count("in_progress")
+            return "in_progress", None
+        self._count("replayed")
+        return "done", (body, status_code)
+
+    def finish(self, access_token, endpoint, key, body: bytes, status_code: int):
+        self._connect().execute(
+            "UPDATE idempotency_keys SET status_code = ?, body = ? WHERE owner = ? AND endpoint = ? AND idem_key = ?",
+            (status_code, body, owner_of(access_token), endpoint, key),
+        )
+
+    def release(self, access_token, endpoint, key):
+        """Forget a key whose request certainly did not reach TikTok, so it can be retried."""
+        self._connect().execute(
+            "DELETE FROM idempotency_keys WHERE owner = ? AND endpoint = ? AND idem_key = ? AND status_code IS NULL",
+            (owner_of(access_token), endpoint, key),
+        )
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,318 @@
+# media_cache.py
+"""
+Local disk cache for finished avatar videos, covers and avatar images.
+
+TikTok hands out short-lived signed URLs, so every browser used to fetch
+every cover and preview from the CDN again, and links stopped working
+after a few hours. Media is now cached on this host:
+
+- only URLs a URLGuard lets through are fetched (TikTok CDN hosts with
+  public addresses, every redirect checked), and only bodies whose
+  Content-Type matches the kind (image/* or video/*) are kept
+- entries are keyed by the URL without its signed query, so a re-signed
+  URL of the same object hits the same entry
+- `concurrency` background threads per worker download misses; a partly
+  downloaded file is kept as <key>.part and resumed with a Range request
+  on the next attempt (after a dropped connection, or in another worker
+  after a restart); an flock on the .part file keeps two workers from
+  downloading the same entry
+- once an image is in, a JPEG thumbnail `thumb_width` pixels wide is made
+  for it once (needs Pillow; without it the original is served)
+- the index lives in SQLite so all workers share it; when the files
+  take more than `max_bytes` the least recently served ones are deleted
+  until they fit in 90% of it
+
+Files are served by the app with send_file, which answers Range and
+conditional requests and lets gunicorn use sendfile(). They always go
+out as DEFAULT_TYPES[kind], never with the type the source claimed.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from url_guard import UnsafeURL, URLGuard
+
+try:
+    from PIL import Image
+except ImportError:  # optional; no thumbnails, images are served as they are
+    Image = None
+
+log = logging.getLogger(__name__)
+
+KINDS = ("image", "video")
+DEFAULT_TYPES = {"image": "image/jpeg", "video": "video/mp4"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS media (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    content_type TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    thumb_size INTEGER NOT NULL DEFAULT 0,
+    fetched_at REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS media_last_access ON media (last_access);
+"""
+
+
+class MediaError(Exception):
+    """The source answered with something that cannot be cached."""
+
+
+def media_key(kind, url):
+    """Cache key of an asset: its URL without the (signed) query."""
+    parts = urlsplit(url)
+    identity = f"{kind}|url|{parts.netloc.lower()}{parts.path}"
+    return hashlib.sha256(identity.encode()).hexdigest()[:32]
+
+
+def _restart(part):
+    """Empty a .part file so the next write starts it over."""
+    part.seek(0)
+    part.truncate(0)
+
+
+class MediaCache:
+    def __init__(self, root, max_bytes=2 * 1024 ** 3, max_object_bytes=None, concurrency=8, chunk_size=256 * 1024,
+                 timeout=(5, 60), retries=3, thumb_width=320, guard=None, touch_interval=60):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_object_bytes = max_object_bytes or max_bytes // 10
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.thumb_width = thumb_width
+        # Which URLs may be fetched (TikTok CDN hosts, public addresses only)
+        self.guard = guard or URLGuard()
+        self.touch_interval = touch_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> Event set when its download ends, either way
+        self._queue = queue.Queue()
+        self._pid = None
+        self._session = None
+        self._counters = {"hits": 0, "misses": 0, "downloads": 0, "download_errors": 0, "resumed": 0,
+                          "bytes_downloaded": 0, "thumbnails": 0, "evicted": 0}
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.root, "index.sqlite3"), timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _start(self):
+        # Download threads of this worker process; re-spawned after a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._pending = {}
+            self._session = requests.Session()
+            for i in range(self.concurrency):
+                threading.Thread(target=self._run, name=f"media-cache-{i}", daemon=True).start()
+
+    def path(self, key, thumb=False):
+        return os.path.join(self.root, "objects", key[:2], key + (".thumb.jpg" if thumb else ""))
+
+    def allowed(self, url):
+        return self.guard.allowed(url)
+
+    # ---- lookups ----
+
+    def lookup(self, key, thumb=False):
+        """(path, content type) of a cached entry, or None. Marks the entry as recently used."""
+        db = self._connect()
+        row = db.execute("SELECT kind, thumb_size, last_access FROM media WHERE key = ?", (key,)).fetchone()
+        if row is None or not os.path.exists(self.path(key)):
+            with self._lock:
+                self._counters["misses"] += 1
+            return None
+        kind, thumb_size, last_access = row
+        now = time.time()
+        if now - last_access >= self.touch_interval:
+            db.execute("UPDATE media SET last_access = ? WHERE key = ?", (now, key))
+        with self._lock:
+            self._counters["hits"] += 1
+        if thumb and thumb_size:
+            return self.path(key, thumb=True), "image/jpeg"
+        return self.path(key), DEFAULT_TYPES[kind]
+
+    def fetch(self, key, kind, url):
+        """Start downloading `url` into the cache (once per key); returns an Event set when it ends."""
+        self._start()
+        with self._lock:
+            done = self._pending.get(key)
+            if done is not None:
+                return done
+            done = self._pending[key] = threading.Event()
+        self._queue.put((key, kind, url))
+        return done
+
+    # ---- downloads ----
+
+    def _run(self):
+        while True:
+            key, kind, url = self._queue.get()
+            try:
+                self._download(key, kind, url)
+            except Exception as e:
+                with self._lock:
+                    self._counters["download_errors"] += 1
+                if isinstance(e, (MediaError, requests.RequestException, OSError)):
+                    log.info("Media download failed", extra={"key": key, "error": str(e)})
+                else:
+                    log.exception("Media download crashed", extra={"key": key})
+            finally:
+                with self._lock:
+                    done = self._pending.pop(key, None)
+                if done is not None:
+                    done.set()
+
+    def _download(self, key, kind, url):
+        final = self.path(key)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        with open(final + ".part", "ab") as part:
+            try:
+                fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is downloading it
+            indexed = self._connect().execute("SELECT 1 FROM media WHERE key = ?", (key,)).fetchone()
+            if indexed and os.path.exists(final):
+                os.unlink(final + ".part")
+                return  # another worker finished it meanwhile
+            for attempt in range(self.retries + 1):
+                try:
+                    content_type = self._receive(part, kind, url)
+                    break
+                except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+                    if attempt >= self.retries:
+                        raise  # the .part file stays, the next fetch resumes it
+                    time.sleep(min(4.0, 0.5 * 2 ** attempt))
+                except Exception:
+                    os.unlink(final + ".part")  # a refused or unusable source: nothing worth resuming
+                    raise
+            size = part.tell()
+
+            # Thumbnail and index entry first, the file last: whoever sees the file sees a complete entry
+            thumb_size = self._thumbnail(key, final + ".part") if kind == "image" else 0
+            now = time.time()
+            self._connect().execute(
+                "INSERT OR REPLACE INTO media (key, kind, content_type, size, thumb_size, fetched_at, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, content_type, size, thumb_size, now, now),
+            )
+            os.replace(final + ".part", final)
+        with self._lock:
+            self._counters["downloads"] += 1
+        self._evict()
+
+    def _receive(self, part, kind, url):
+        """Append the rest of `url` to `part`, resuming from what it holds; returns the content type."""
+        offset = part.tell()
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        try:
+            r = self.guard.get(self._session, url, headers=headers, stream=True, timeout=self.timeout)
+        except UnsafeURL as e:
+            raise MediaError(str(e))
+        with r:
+            content_type = (r.headers.get("Content-Type") or "").split(";")[0].strip().lower()
+            if r.status_code == 206:
+                start, _, rest = r.headers.get("Content-Range", "").removeprefix("bytes ").partition("-")
+                if start != str(offset):
+                    _restart(part)
+                    raise requests.ConnectionError("Source answered a different range; starting over")
+                total = int(rest.partition("/")[2]) if rest.partition("/")[2].isdigit() else None
+                with self._lock:
+                    self._counters["resumed"] += 1
+            elif r.status_code == 200:
+                _restart(part)  # the source ignored the Range header (or there was none)
+                total = int(r.headers["Content-Length"]) if r.headers.get("Content-Length", "").isdigit() else None
+            else:
+                raise MediaError(f"Source answered HTTP {r.status_code}")
+            # Anything else (text/html, image/svg+xml, ...) could run script on the app's origin
+            if not content_type.startswith(kind + "/") or content_type == "image/svg+xml":
+                raise MediaError(f"Source answered {content_type or 'no content type'} for {kind}")
+            if total and total > self.max_object_bytes:
+                raise MediaError(f"Media is larger than {self.max_object_bytes} bytes")
+
+            for chunk in r.iter_content(self.chunk_size):
+                part.write(chunk)
+                with self._lock:
+                    self._counters["bytes_downloaded"] += len(chunk)
+                if part.tell() > self.max_object_bytes:
+                    _restart(part)
+                    raise MediaError(f"Media is larger than {self.max_object_bytes} bytes")
+            part.flush()
+            if total and part.tell() != total:
+                raise requests.ConnectionError(f"Download ended at {part.tell()} of {total} bytes")
+            if not part.tell():
+                raise MediaError("Source returned an empty body")
+            return content_type
+
+    def _thumbnail(self, key, source):
+        """Write the downscaled JPEG for an image once; returns its size (0 if none was needed or possible)."""
+        if Image is None:
+            return 0
+        target = self.path(key, thumb=True)
+        try:
+            with Image.open(source) as image:
+                if image.width <= self.thumb_width:
+                    return 0
+                image.thumbnail((self.thumb_width, self.thumb_width * 4))
+                image.convert("RGB").save(target + ".tmp", "JPEG", quality=80, optimize=True)
+            os.replace(target + ".tmp", target)
+        except (OSError, ValueError) as e:
+            log.info("Thumbnail failed", extra={"key": key, "error": str(e)})
+            return 0
+        with self._lock:
+            self._counters["thumbnails"] += 1
+        return os.path.getsize(target)
+
+    # ---- eviction ----
+
+    def _evict(self):
+        """Delete least recently served entries until the cache fits in 90% of max_bytes."""
+        db = self._connect()
+        total = db.execute("SELECT COALESCE(SUM(size + thumb_size), 0) FROM media").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in db.execute("SELECT key, size + thumb_size FROM media ORDER BY last_access").fetchall():
+            if total <= self.max_bytes * 0.9:
+                break
+            db.execute("DELETE FROM media WHERE key = ?", (key,))
+            for path in (self.path(key), self.path(key, thumb=True)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            with self._lock:
+                self._counters["evicted"] += 1
+
+    def stats(self):
+        entries, total = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(size + thumb_size), 0) FROM media"
+        ).fetchone()
+        with self._lock:
+            return {"entries": entries, "bytes": total, "max_bytes": self.max_bytes, "downloading": len(self._pending),
+                    "thumbnails_enabled": Image is not None, **self._counters}
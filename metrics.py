@@ -0,0 +1,114 @@
+# metrics.py
+"""
+Prometheus metrics for the app and its TikTok upstream.
+
+Under gunicorn every worker is a separate process, so the metrics use
+prometheus_client's multiprocess mode: gunicorn_config.py points
+PROMETHEUS_MULTIPROC_DIR at a shared directory, each worker writes its
+samples there and /metrics merges all of them (counters and histograms
+are summed, gauges summed over live workers). Without that variable - e.g.
+`python app.py` - the process-local default registry is served.
+"""
+import os
+import time
+
+from flask import g, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "Inbound request latency by route",
+    ["route", "method", "status"], buckets=LATENCY_BUCKETS,
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "Inbound requests being handled", multiprocess_mode="livesum",
+)
+UPSTREAM_LATENCY = Histogram(
+    "tiktok_request_duration_seconds", "TikTok API call latency by path",
+    ["path", "method"], buckets=LATENCY_BUCKETS,
+)
+UPSTREAM_RESPONSES = Counter(
+    "tiktok_responses", "TikTok API responses by path, HTTP status and envelope code",
+    ["path", "http_status", "code"],
+)
+UPSTREAM_ERRORS = Counter(
+    "tiktok_request_errors", "TikTok API calls that raised (timeouts, connection errors, breaker, rate limit)",
+    ["path", "error"],
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "tiktok_requests_in_flight", "TikTok API calls in flight", multiprocess_mode="livesum",
+)
+POOL_CONNECTIONS = Gauge(
+    "tiktok_pool_connections", "TikTok keep-alive pool: configured size and idle connections",
+    ["state"], multiprocess_mode="livesum",
+)
+CACHE_LOOKUPS = Counter(
+    "response_cache_lookups", "Response cache lookups by path and result (HIT, STALE, MISS, STALE-IF-ERROR)",
+    ["path", "result"],
+)
+
+
+def observe_upstream(method, path, seconds, status_code, code, error):
+    """TikTokClient on_response hook."""
+    UPSTREAM_LATENCY.labels(path, method).observe(seconds)
+    if error:
+        UPSTREAM_ERRORS.labels(path, error).inc()
+    else:
+        UPSTREAM_RESPONSES.labels(path, str(status_code), code or "").inc()
+
+
+_pool_updated = [0.0]
+
+
+def update_pool(client, min_interval=1.0):
+    """Publish this worker's connection pool gauges, unless done less than min_interval seconds ago."""
+    now = time.monotonic()
+    if now - _pool_updated[0] < min_interval:
+        return
+    _pool_updated[0] = now
+    stats = client.pool_stats()
+    UPSTREAM_IN_FLIGHT.set(stats["in_flight"])
+    POOL_CONNECTIONS.labels("max").set(stats["pool_size"])
+    POOL_CONNECTIONS.labels("idle").set(sum(pool["idle"] for pool in stats["pools"]))
+
+
+def init_app(app):
+    """Time every request and count the ones in flight."""
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.monotonic()
+        REQUESTS_IN_FLIGHT.inc()
+
+    @app.after_request
+    def _observe(response):
+        started = g.pop("metrics_started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            REQUEST_LATENCY.labels(route, request.method, str(response.status_code)).observe(
+                time.monotonic() - started
+            )
+        return response
+
+    @app.teardown_request
+    def _done(exc):
+        REQUESTS_IN_FLIGHT.dec()
+
+
+def render():
+    """(body, content_type) for a /metrics response covering every worker."""
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
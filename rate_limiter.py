@@ -0,0 +1,216 @@
+# rate_limiter.py
+"""
+Outbound rate limiting for TikTok calls.
+
+One token bucket per (access token, endpoint family), kept in SQLite so
+every gunicorn worker on the host draws from the same bucket. A worker
+reserves the next free slots in a single transaction - the bucket may go
+negative, which makes later callers wait behind earlier ones like a queue -
+and hands them to its callers in process, so the shared bucket is written
+about once per `sync_interval` of traffic instead of on every call (a
+locked SQLite write stalls a whole gevent worker). Slots not handed out
+by the next sync go back to the bucket. A caller sleeps until its slot
+comes up; if the slot is further away than the caller's deadline it gets
+RateLimitExceeded right away instead of waiting for nothing.
+
+The refill rate adapts (AIMD): a throttling response from TikTok halves
+it, every `success_batch` successful calls add `increase` back, up to the
+configured rate.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+import requests
+
+# Endpoint families, matched by path prefix; TikTok limits them separately
+FAMILIES = {
+    "/creative/aigc/": "script",
+    "/creative/digital_avatar/": "avatar",
+    # Long-running video uploads get their own bucket and breaker so they never starve or trip /file/ reads
+    "/file/video/ad/upload/": "upload",
+    "/file/": "file",
+}
+
+# TikTok envelope codes meaning "too many requests"
+THROTTLE_CODES = {"40100"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    owner TEXT NOT NULL,
+    family TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    rate REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    throttled INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (owner, family)
+);
+"""
+
+
+class RateLimitExceeded(requests.RequestException):
+    """No slot within the caller's deadline; nothing was sent to TikTok."""
+
+
+def owner_of(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def family_of(path):
+    for prefix, family in FAMILIES.items():
+        if path.startswith(prefix):
+            return family
+    return "other"
+
+
+class RateLimiter:
+    def __init__(self, path, rate=10.0, min_rate=0.5, max_wait=10.0, decrease=0.5, increase=0.5,
+                 success_batch=10, sync_interval=0.5):
+        self.path = path
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_wait = max_wait
+        self.decrease = decrease
+        self.increase = increase
+        self.success_batch = success_batch
+        self.sync_interval = sync_interval
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._successes = {}  # (owner, family) -> successes not yet credited to the bucket
+        self._share_lock = threading.Lock()
+        self._shares = {}  # (owner, family) -> deque of reserved slot times not handed out yet
+        self._counters = {"acquired": 0, "waited": 0, "wait_time": 0.0, "rejected": 0, "throttled": 0, "syncs": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _reserve(self, owner, family, max_wait, returned=0):
+        """
+        Give back `returned` unused slots and reserve the next ones. Returns
+        their times (at least one), or None if the first is beyond max_wait.
+        """
+        now = time.time()
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute(
+                "SELECT tokens, rate, updated_at FROM buckets WHERE owner = ? AND family = ?", (owner, family)
+            ).fetchone()
+            tokens, rate, updated_at = row if row else (self.rate, self.rate, now)
+            # Burst capacity is one second's worth of calls
+            tokens = min(max(rate, 1.0), tokens + returned + (now - updated_at) * rate)
+            wait = max(0.0, (1 - tokens) / rate)
+            slots = None
+            if wait <= max_wait:
+                # Enough for sync_interval at the current rate; below one call per interval this is per call.
+                # Slots covered by tokens in the bucket are free now, the rest follow at the rate
+                slots = [now + max(0.0, (1 + i - tokens) / rate) for i in range(max(1, int(rate * self.sync_interval)))]
+                tokens -= len(slots)
+            db.execute(
+                "INSERT INTO buckets (owner, family, tokens, rate, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(owner, family) DO UPDATE SET tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (owner, family, tokens, rate, now),
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        with self._lock:
+            self._counters["syncs"] += 1
+        return slots
+
+    def _take(self, owner, family, max_wait):
+        """Hand out this worker's next reserved slot, syncing with the shared bucket when it has none left."""
+        key = (owner, family)
+        with self._share_lock:
+            now = time.time()
+            share = self._shares.get(key)
+            # A slot long past was not used in time; spending it now would burst above the rate
+            if not share or share[0] < now - self.sync_interval:
+                slots = self._reserve(owner, family, max_wait, returned=len(share) if share else 0)
+                share = self._shares[key] = deque(slots or ())
+                if not share:
+                    return None
+            wait = max(0.0, share[0] - time.time())
+            if wait > max_wait:
+                return None
+            share.popleft()
+            return wait
+
+    def acquire(self, path, access_token, max_wait=None):
+        """
+        Block until this call may go out. Raises RateLimitExceeded when the
+        queue ahead is longer than max_wait seconds (default self.max_wait).
+        """
+        family = family_of(path)
+        max_wait = self.max_wait if max_wait is None else max_wait
+        wait = self._take(owner_of(access_token), family, max_wait)
+        with self._lock:
+            if wait is None:
+                self._counters["rejected"] += 1
+            else:
+                self._counters["acquired"] += 1
+                self._counters["waited"] += wait > 0
+                self._counters["wait_time"] += wait
+        if wait is None:
+            raise RateLimitExceeded(f"TikTok {family} rate limit: no slot within {max_wait:g}s, try again later")
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def observe(self, path, access_token, status_code, code):
+        """Adapt the bucket's rate to a TikTok response (HTTP status and envelope code)."""
+        throttled = status_code == 429 or code in THROTTLE_CODES
+
+        key = (owner_of(access_token), family_of(path))
+        if throttled:
+            with self._lock:
+                self._counters["throttled"] += 1
+                self._successes.pop(key, None)
+            with self._share_lock:
+                self._shares.pop(key, None)
+            # Multiplicative decrease, and drain the bucket so queued callers back off too
+            self._adjust(key, "MAX(?, rate * ?)", (self.min_rate, self.decrease), drain=True)
+            return True
+
+        with self._lock:
+            successes = self._successes[key] = self._successes.get(key, 0) + 1
+            if successes < self.success_batch:
+                return False
+            self._successes[key] = 0
+        self._adjust(key, "MIN(?, rate + ?)", (self.rate, self.increase))
+        return False
+
+    def _adjust(self, key, rate_expr, args, drain=False):
+        self._connect().execute(
+            f"UPDATE buckets SET rate = {rate_expr}, throttled = throttled + ?, "
+            f"tokens = CASE WHEN ? THEN MIN(tokens, 0) ELSE tokens END WHERE owner = ? AND family = ?",
+            args + (int(drain), int(drain)) + key,
+        )
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        wait_time = counters.pop("wait_time")
+        counters["avg_wait_ms"] = round(wait_time * 1000 / counters["acquired"], 2) if counters["acquired"] else 0.0
+        counters["buckets"] = [
+            {"owner": owner, "family": family, "rate": round(rate, 2), "throttled": throttled}
+            for owner, family, rate, throttled in self._connect().execute(
+                "SELECT owner, family, rate, throttled FROM buckets ORDER BY owner, family"
+            )
+        ]
+        return counters
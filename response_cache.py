@@ -0,0 +1,194 @@
+# response_cache.py
+"""
+TTL response cache for catalog-style TikTok endpoints, shared by every
+gunicorn worker on the host.
+
+Entries live in a small SQLite database (WAL mode) so all worker processes
+see the same cache. Each entry is keyed on a hash of the access token, the
+upstream path and the normalized params, and is tagged with token + path
+so writes can invalidate every cached page of a list at once. Entries
+past their TTL are still served for a stale window while one worker
+refreshes them in the background, and any entry still on disk is served
+when fetching a fresh copy raises (TikTok down, circuit breaker open).
+The database is kept under a byte cap by evicting least recently used
+entries.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from tiktok_client import body_code
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    key TEXT PRIMARY KEY,
+    tag TEXT NOT NULL,
+    body BLOB NOT NULL,
+    status INTEGER NOT NULL,
+    stored_at REAL NOT NULL,
+    fresh_until REAL NOT NULL,
+    stale_until REAL NOT NULL,
+    last_access REAL NOT NULL,
+    refreshing_until REAL NOT NULL DEFAULT 0,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_tag ON entries (tag);
+CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+"""
+
+
+def _token_hash(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def _is_success(body, status_code):
+    return status_code == 200 and body_code(body) == "0"
+
+
+class ResponseCache:
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, refresh_timeout=30):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.refresh_timeout = refresh_timeout
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0,
+                          "refresh_errors": 0, "errors_served_stale": 0, "invalidations": 0, "evictions": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        # One connection per thread and per process (connections must not cross a fork)
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._counters[name] += n
+
+    @staticmethod
+    def make_key(path, access_token, params=None):
+        normalized = json.dumps(params or {}, sort_keys=True, separators=(",", ":"), default=str)
+        raw = f"{_token_hash(access_token)}|{path}|{normalized}"
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    @staticmethod
+    def make_tag(path, access_token):
+        return f"{_token_hash(access_token)}|{path}"
+
+    def get_or_fetch(self, path, access_token, params, fetch, ttl, stale_ttl=0):
+        """
+        Return (body, status_code, state) where state is HIT, STALE, MISS or
+        STALE-IF-ERROR (fetch raised but an expired entry was still stored).
+
+        `fetch()` must return (body_bytes, status_code). It is called inline
+        on a miss and on a background thread when serving a stale entry.
+        Only successful TikTok responses (HTTP 200, code 0) are stored.
+        """
+        key = self.make_key(path, access_token, params)
+        now = time.time()
+        db = self._connect()
+        row = db.execute(
+            "SELECT body, status, fresh_until, stale_until FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+
+        if row is not None:
+            body, status_code, fresh_until, stale_until = row
+            if now < fresh_until:
+                db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                self._count("hits")
+                return body, status_code, "HIT"
+            if now < stale_until:
+                db.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+                self._count("stale_hits")
+                self._refresh_in_background(key, path, access_token, fetch, ttl, stale_ttl)
+                return body, status_code, "STALE"
+
+        self._count("misses")
+        try:
+            body, status_code = fetch()
+        except Exception:
+            if row is None:
+                raise
+            self._count("errors_served_stale")
+            return row[0], row[1], "STALE-IF-ERROR"
+        self._store(key, path, access_token, body, status_code, ttl, stale_ttl)
+        return body, status_code, "MISS"
+
+    def invalidate(self, path, access_token):
+        """Drop every cached page of `path` for this access token."""
+        cur = self._connect().execute("DELETE FROM entries WHERE tag = ?", (self.make_tag(path, access_token),))
+        self._count("invalidations", cur.rowcount)
+
+    def stats(self):
+        entries, size = self._connect().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        with self._lock:
+            counters = dict(self._counters)
+        lookups = counters["hits"] + counters["stale_hits"] + counters["misses"]
+        counters["hit_ratio"] = round((counters["hits"] + counters["stale_hits"]) / lookups, 3) if lookups else 0.0
+        return {"entries": entries, "bytes": size, "max_bytes": self.max_bytes, **counters}
+
+    def _store(self, key, path, access_token, body, status_code, ttl, stale_ttl):
+        if not _is_success(body, status_code):
+            return
+        now = time.time()
+        db = self._connect()
+        db.execute(
+            "INSERT OR REPLACE INTO entries "
+            "(key, tag, body, status, stored_at, fresh_until, stale_until, last_access, refreshing_until, size) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, ?)",
+            (key, self.make_tag(path, access_token), body, status_code,
+             now, now + ttl, now + ttl + stale_ttl, now, len(body)),
+        )
+        self._evict(db)
+
+    def _evict(self, db):
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Drop expired entries first, then least recently used ones until under the cap
+        cur = db.execute("DELETE FROM entries WHERE stale_until < ?", (time.time(),))
+        evicted = cur.rowcount
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        for key, size in db.execute("SELECT key, size FROM entries ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            db.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            evicted += 1
+        self._count("evictions", evicted)
+
+    def _refresh_in_background(self, key, path, access_token, fetch, ttl, stale_ttl):
+        # Claim the refresh atomically so only one worker process revalidates an entry
+        now = time.time()
+        cur = self._connect().execute(
+            "UPDATE entries SET refreshing_until = ? WHERE key = ? AND refreshing_until < ?",
+            (now + self.refresh_timeout, key, now),
+        )
+        if cur.rowcount != 1:
+            return
+
+        def refresh():
+            self._count("refreshes")
+            try:
+                body, status_code = fetch()
+                self._store(key, path, access_token, body, status_code, ttl, stale_ttl)
+            except Exception as e:
+                self._count("refresh_errors")
+                log.warning("Cache refresh failed for %s: %s", path, e)
+
+        threading.Thread(target=refresh, name="cache-refresh", daemon=True).start()
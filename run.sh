@@ -32,6 +32,9 @@ if [ "$MODE" = "production" ]; then
     echo "🏭 Starting in PRODUCTION mode with Gunicorn..."
     echo "🌐 Server will be available at http://0.0.0.0:${PORT:-5000}"
 
+    # Fingerprinted, precompressed CSS/JS for the pages
+    python build_static.py
+
     # Run with gunicorn using config file
     gunicorn app:app --config gunicorn_config.py
 
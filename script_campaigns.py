@@ -0,0 +1,104 @@
+# script_campaigns.py
+"""
+Script-generation campaigns: many create_task payloads in one request.
+
+A campaign submits every payload to TikTok with bounded concurrency (the
+rate limiter still paces calls per token), hands the created task IDs to
+the task tracker and then follows them until they finish. run() yields
+events as they happen, so a route can stream them out or fold them into
+one aggregated answer:
+
+    {"event": "submitted", "index": i, "task_id": "..."}
+    {"event": "submit_failed", "index": i, "error": "...", ...}
+    {"event": "result", "index": i, "task_id": "...", "status": "...", "result": {...}}
+    {"event": "done", "summary": {...}, "pending": [{"index": i, "task_id": "..."}, ...]}
+
+Tasks still running when the wait ends are listed as pending; the tracker
+keeps polling them, so /api/task_status and /api/tasks/stream pick up
+from there.
+"""
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from tiktok_client import fast_json
+
+log = logging.getLogger(__name__)
+
+CREATE_PATH = "/creative/aigc/script_generation/task/create/"
+
+
+class CampaignRunner:
+    def __init__(self, client, task_tracker, concurrency=5):
+        self.client = client
+        self.task_tracker = task_tracker
+        self.concurrency = concurrency
+
+    def _submit(self, access_token, payload):
+        """Create one task; returns {"task_id"} or the error details."""
+        try:
+            r = self.client.post(CREATE_PATH, access_token, json=payload)
+            body = fast_json.loads(r.content)
+        except requests.RequestException as e:
+            return {"error": f"Request failed: {e}"}
+        except ValueError:
+            return {"error": "TikTok returned a non-JSON response", "status": r.status_code}
+        task_id = (body.get("data") or {}).get("task_id")
+        if r.status_code != 200 or str(body.get("code")) != "0" or not task_id:
+            return {"error": "TikTok API Error", "code": body.get("code"), "message": body.get("message")}
+        return {"task_id": task_id}
+
+    def run(self, access_token, payloads, wait_seconds):
+        """Submit `payloads`, then follow their tasks for up to `wait_seconds`; yields event dicts, "done" last."""
+        started = time.monotonic()
+        pending = {}  # task_id -> index
+        failed = succeeded = 0
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.concurrency, len(payloads))),
+                                thread_name_prefix="campaign") as pool:
+            futures = {pool.submit(contextvars.copy_context().run, self._submit, access_token, payload): index
+                       for index, payload in enumerate(payloads)}
+            for future in as_completed(futures):
+                index, outcome = futures[future], future.result()
+                if "task_id" in outcome:
+                    pending[outcome["task_id"]] = index
+                    self.task_tracker.track("script", access_token, [outcome["task_id"]])
+                    yield {"event": "submitted", "index": index, "task_id": outcome["task_id"]}
+                else:
+                    failed += 1
+                    yield {"event": "submit_failed", "index": index, **outcome}
+
+        deadline = started + wait_seconds
+        try:
+            while pending:
+                version = self.task_tracker.version
+                tasks = self.task_tracker.snapshot("script", access_token, list(pending))
+                for task_id, task in tasks.items():
+                    if task.done:
+                        index = pending.pop(task_id)
+                        succeeded += task.status != "FAILED"
+                        yield {"event": "result", "index": index, "task_id": task_id,
+                               "status": task.status, "result": task.result}
+                remaining = deadline - time.monotonic()
+                if not pending or remaining <= 0:
+                    break
+                self.task_tracker.wait_for_change(version, timeout=min(15, remaining))
+        except Exception:
+            # The tasks exist and stay tracked; report the rest as pending rather than end without "done"
+            log.exception("Script campaign stopped following its tasks")
+
+        summary = {
+            "total": len(payloads),
+            "submit_failed": failed,
+            "finished": len(payloads) - failed - len(pending),
+            "succeeded": succeeded,
+            "pending": len(pending),
+            "seconds": round(time.monotonic() - started, 2),
+        }
+        log.info("Script campaign finished", extra=summary)
+        still_pending = sorted((index, task_id) for task_id, index in pending.items())
+        yield {"event": "done", "summary": summary,
+               "pending": [{"index": index, "task_id": task_id} for index, task_id in still_pending]}
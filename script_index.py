@@ -0,0 +1,257 @@
+# script_index.py
+"""
+Near-duplicate index over generated scripts (MinHash over word shingles).
+
+Every script is reduced to a fixed-size MinHash signature: the text is
+normalized, cut into overlapping `shingle_size`-word shingles, and for
+each of `num_perm` hash permutations the minimum hashed shingle is kept.
+The share of positions where two signatures agree estimates the Jaccard
+similarity of their shingle sets, so "how close is X to everything we
+have" is one vectorized comparison against an (N, num_perm) uint32
+array - a few milliseconds for tens of thousands of scripts.
+
+Signatures are kept per access token in two corpora:
+
+    library   every generated script (fed from list pages and task results)
+    rendered  scripts already submitted for avatar video rendering
+
+They are stored in SQLite, so they survive restarts and are shared by
+workers. Each worker holds its arrays in memory and pulls rows added by
+other workers (by rowid) before answering a query.
+
+NumPy is optional; without it `available` is False and the app answers
+the near-duplicate routes with 501.
+"""
+import hashlib
+import logging
+import os
+import re
+import sqlite3
+import threading
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # optional; near-duplicate checks are disabled
+    np = None
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS signatures (
+    owner TEXT NOT NULL,
+    corpus TEXT NOT NULL,
+    key TEXT NOT NULL,
+    label TEXT NOT NULL DEFAULT '',
+    signature BLOB NOT NULL,
+    PRIMARY KEY (owner, corpus, key)
+);
+"""
+
+CORPORA = ("library", "rendered")
+MERSENNE_PRIME = (1 << 31) - 1
+WORD = re.compile(r"\w+")
+
+
+def owner_of(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def text_key(text):
+    """Key for scripts that have no ID of their own (e.g. rendered package scripts)."""
+    return hashlib.sha1(" ".join(WORD.findall(text.lower())).encode()).hexdigest()[:16]
+
+
+class _Corpus:
+    """Append-only signature array for one (owner, corpus), grown by doubling."""
+
+    def __init__(self, num_perm):
+        self.keys = []
+        self.labels = []
+        self.known = set()
+        self.signatures = np.empty((64, num_perm), dtype=np.uint32)
+        self.last_rowid = 0
+
+    def append(self, key, label, signature):
+        if key in self.known:
+            return
+        n = len(self.keys)
+        if n == len(self.signatures):
+            grown = np.empty((2 * n, self.signatures.shape[1]), dtype=np.uint32)
+            grown[:n] = self.signatures
+            self.signatures = grown
+        self.signatures[n] = signature
+        self.keys.append(key)
+        self.labels.append(label)
+        self.known.add(key)
+
+    def similarities(self, signature):
+        n = len(self.keys)
+        return (self.signatures[:n] == signature).mean(axis=1) if n else np.empty(0)
+
+
+class ScriptIndex:
+    def __init__(self, path, num_perm=128, shingle_size=3, threshold=0.8, seed=1):
+        self.path = path
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.available = np is not None
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._corpora = {}  # (owner, corpus) -> _Corpus
+        if not self.available:
+            log.warning("numpy is not installed; near-duplicate script checks are disabled")
+            return
+        # The permutations must be identical in every worker and across restarts
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self._b = rng.integers(0, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    # ---- signatures ----
+
+    def signature(self, text):
+        """MinHash signature (num_perm uint32) of `text`'s word shingles."""
+        words = WORD.findall((text or "").lower())
+        k = min(self.shingle_size, len(words)) or 1
+        shingles = {" ".join(words[i:i + k]) for i in range(max(1, len(words) - k + 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+        # (a * h + b) mod p for every permutation and shingle at once; a, h < 2^32 so it fits in uint64
+        permuted = (self._a * hashes[np.newaxis, :] + self._b) % MERSENNE_PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def signatures(self, texts):
+        if not texts:
+            return np.empty((0, self.num_perm), dtype=np.uint32)
+        return np.stack([self.signature(text) for text in texts])
+
+    # ---- corpus ----
+
+    def _corpus(self, owner, corpus):
+        """The in-memory corpus, topped up with rows other workers added since it was last read."""
+        with self._lock:
+            entry = self._corpora.get((owner, corpus))
+            if entry is None:
+                entry = self._corpora[(owner, corpus)] = _Corpus(self.num_perm)
+            rows = self._connect().execute(
+                "SELECT rowid, key, label, signature FROM signatures WHERE owner = ? AND corpus = ? AND rowid > ? "
+                "ORDER BY rowid",
+                (owner, corpus, entry.last_rowid),
+            ).fetchall()
+            for rowid, key, label, blob in rows:
+                entry.append(key, label, np.frombuffer(blob, dtype=np.uint32))
+                entry.last_rowid = rowid
+            return entry
+
+    def add(self, access_token, corpus, items):
+        """Index (key, text) pairs into `corpus`; keys already present are skipped. Returns how many were new."""
+        owner = owner_of(access_token)
+        items = [(str(key), text) for key, text in items if key and text]
+        db = self._connect()
+        added = 0
+        for start in range(0, len(items), 500):
+            chunk = items[start:start + 500]
+            known = {key for (key,) in db.execute(
+                f"SELECT key FROM signatures WHERE owner = ? AND corpus = ? AND key IN ({','.join('?' * len(chunk))})",
+                [owner, corpus] + [key for key, _ in chunk],
+            )}
+            fresh = [(key, text) for key, text in chunk if key not in known]
+            if not fresh:
+                continue
+            signatures = self.signatures([text for _, text in fresh])
+            db.executemany(
+                "INSERT OR IGNORE INTO signatures (owner, corpus, key, label, signature) VALUES (?, ?, ?, ?, ?)",
+                [(owner, corpus, key, text[:80], signatures[i].tobytes()) for i, (key, text) in enumerate(fresh)],
+            )
+            added += len(fresh)
+        return added
+
+    def count(self, access_token, corpus):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM signatures WHERE owner = ? AND corpus = ?", (owner_of(access_token), corpus)
+        ).fetchone()[0]
+
+    # ---- queries ----
+
+    def near_duplicates(self, access_token, corpus, text, threshold=None, limit=20, exclude_key=None):
+        """Entries of `corpus` at least `threshold` similar to `text`, most similar first."""
+        threshold = self.threshold if threshold is None else threshold
+        entry = self._corpus(owner_of(access_token), corpus)
+        similarities = entry.similarities(self.signature(text))
+        hits = np.flatnonzero(similarities >= threshold)
+        hits = hits[np.argsort(-similarities[hits], kind="stable")]
+        results = []
+        for i in hits:
+            if entry.keys[i] == exclude_key:
+                continue
+            results.append({"key": entry.keys[i], "label": entry.labels[i], "similarity": round(float(similarities[i]), 3)})
+            if len(results) >= limit:
+                break
+        return results
+
+    def cluster(self, texts, threshold=None):
+        """Group `texts` whose similarity is at least `threshold`; returns lists of indices (largest first)."""
+        threshold = self.threshold if threshold is None else threshold
+        signatures = self.signatures(texts)
+        parent = list(range(len(texts)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        for i in range(len(texts) - 1):
+            similar = np.flatnonzero((signatures[i + 1:] == signatures[i]).mean(axis=1) >= threshold) + i + 1
+            for j in similar:
+                parent[find(int(j))] = find(i)
+
+        groups = {}
+        for i in range(len(texts)):
+            groups.setdefault(find(i), []).append(i)
+        return sorted(groups.values(), key=lambda group: (-len(group), group[0]))
+
+    def check_batch(self, access_token, texts, threshold=None):
+        """
+        For each text: the closest already-rendered script at or above
+        `threshold` ("rendered_match") and/or the earlier text of the same
+        batch it duplicates ("batch_duplicate_of"); None when it is new.
+        """
+        threshold = self.threshold if threshold is None else threshold
+        entry = self._corpus(owner_of(access_token), "rendered")
+        signatures = self.signatures(texts)
+        report = []
+        for i, signature in enumerate(signatures):
+            finding = {}
+            similarities = entry.similarities(signature)
+            if len(similarities):
+                best = int(similarities.argmax())
+                if similarities[best] >= threshold:
+                    finding["rendered_match"] = {"key": entry.keys[best], "label": entry.labels[best],
+                                                 "similarity": round(float(similarities[best]), 3)}
+            if i:
+                earlier = (signatures[:i] == signature).mean(axis=1)
+                first = np.flatnonzero(earlier >= threshold)
+                if len(first):
+                    finding["batch_duplicate_of"] = int(first[0])
+            report.append(finding or None)
+        return report
+
+    def stats(self):
+        with self._lock:
+            loaded = {f"{owner}/{corpus}": len(entry.keys) for (owner, corpus), entry in self._corpora.items()}
+        return {"available": self.available, "num_perm": self.num_perm, "threshold": self.threshold, "loaded": loaded}
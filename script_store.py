@@ -0,0 +1,275 @@
+# script_store.py
+"""
+Local mirror of the generated-script library with full-text search.
+
+TikTok only lists scripts 20 at a time, so searching the library meant
+paging through /creative/aigc/script/list/ over and over. ScriptStore keeps
+a copy in SQLite (one FTS5 index over title + script) per access token:
+
+- sync() pulls pages newest-first and stops at the first page that holds
+  a script it already has, so a refresh usually costs one upstream call
+- add_scripts() writes the scripts of a finished generation task as soon
+  as the task tracker sees it complete
+- search() answers keyword / date / pagination queries locally
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scripts (
+    owner TEXT NOT NULL,
+    script_id TEXT NOT NULL,
+    title TEXT NOT NULL DEFAULT '',
+    script TEXT NOT NULL DEFAULT '',
+    create_time TEXT NOT NULL DEFAULT '',
+    update_time TEXT NOT NULL DEFAULT '',
+    task_id TEXT,
+    raw TEXT NOT NULL,
+    PRIMARY KEY (owner, script_id)
+);
+CREATE INDEX IF NOT EXISTS scripts_owner_created ON scripts (owner, create_time);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS scripts_fts USING fts5(
+    title, script, content='scripts', content_rowid='rowid'
+);
+CREATE TRIGGER IF NOT EXISTS scripts_ai AFTER INSERT ON scripts BEGIN
+    INSERT INTO scripts_fts (rowid, title, script) VALUES (new.rowid, new.title, new.script);
+END;
+CREATE TRIGGER IF NOT EXISTS scripts_ad AFTER DELETE ON scripts BEGIN
+    INSERT INTO scripts_fts (scripts_fts, rowid, title, script) VALUES ('delete', old.rowid, old.title, old.script);
+END;
+CREATE TRIGGER IF NOT EXISTS scripts_au AFTER UPDATE ON scripts BEGIN
+    INSERT INTO scripts_fts (scripts_fts, rowid, title, script) VALUES ('delete', old.rowid, old.title, old.script);
+    INSERT INTO scripts_fts (rowid, title, script) VALUES (new.rowid, new.title, new.script);
+END;
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    owner TEXT PRIMARY KEY,
+    last_sync REAL NOT NULL DEFAULT 0,
+    complete INTEGER NOT NULL DEFAULT 0,
+    total_number INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+LIST_PATH = "/creative/aigc/script/list/"
+
+
+def owner_of(access_token):
+    """Scripts belong to whoever the access token is; never store the token itself."""
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+def _fts_query(q):
+    # Quote every term so user input can't inject FTS syntax; prefix-match the last one
+    terms = [t.replace('"', '""') for t in q.split() if t.strip()]
+    if not terms:
+        return None
+    quoted = [f'"{t}"' for t in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+class ScriptStore:
+    def __init__(self, path, page_size=20, max_pages=500, on_added=None):
+        self.path = path
+        self.on_added = on_added  # called as on_added(access_token, new_scripts) after new scripts are stored
+        self.page_size = page_size
+        self.max_pages = max_pages
+
+        self._local = threading.local()
+        self._syncing = set()
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    # ---- writes ----
+
+    def add_scripts(self, access_token, scripts, task_id=None):
+        """Insert or update script dicts as returned by TikTok. Returns how many were new."""
+        owner = owner_of(access_token)
+        db = self._connect()
+        new = []
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            for item in scripts:
+                script_id = str(item.get("script_id") or "")
+                if not script_id:
+                    continue
+                exists = db.execute(
+                    "SELECT 1 FROM scripts WHERE owner = ? AND script_id = ?", (owner, script_id)
+                ).fetchone()
+                values = (
+                    item.get("title") or "",
+                    item.get("script") or "",
+                    str(item.get("create_time") or ""),
+                    str(item.get("update_time") or ""),
+                    json.dumps(item),
+                )
+                if exists:
+                    db.execute(
+                        "UPDATE scripts SET title = ?, script = ?, create_time = ?, update_time = ?, raw = ?, "
+                        "task_id = COALESCE(task_id, ?) WHERE owner = ? AND script_id = ?",
+                        values + (task_id, owner, script_id),
+                    )
+                else:
+                    db.execute(
+                        "INSERT INTO scripts (title, script, create_time, update_time, raw, task_id, owner, script_id) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        values + (task_id, owner, script_id),
+                    )
+                    new.append(item)
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if new and self.on_added is not None:
+            try:
+                self.on_added(access_token, new)
+            except Exception:
+                log.exception("Script on_added hook failed")
+        return len(new)
+
+    def sync(self, client, access_token, full=False):
+        """
+        Pull new scripts from TikTok, newest page first. Stops at the first
+        page containing an already stored script, unless this is the first
+        (or a `full`) sync, which walks every page. Returns a summary dict.
+        Raises requests.RequestException on transport errors.
+        """
+        owner = owner_of(access_token)
+        db = self._connect()
+        state = db.execute("SELECT complete FROM sync_state WHERE owner = ?", (owner,)).fetchone()
+        walk_all = full or not (state and state[0])
+
+        pages = added = 0
+        total_number = None
+        page = 1
+        while page <= self.max_pages:
+            r = client.get(LIST_PATH, access_token, params={"page": page, "page_size": self.page_size})
+            body = r.json()
+            if r.status_code != 200 or str(body.get("code")) != "0":
+                return {"ok": False, "pages": pages, "added": added, "error": body}
+            data = body.get("data") or {}
+            items = data.get("list") or []
+            page_info = data.get("page_info") or {}
+            total_number = page_info.get("total_number", total_number)
+            pages += 1
+
+            new = self.add_scripts(access_token, items)
+            added += new
+            if not items or page >= (page_info.get("total_page") or page):
+                break
+            if not walk_all and new < len(items):
+                break  # reached scripts we already have
+            page += 1
+
+        db.execute(
+            "INSERT INTO sync_state (owner, last_sync, complete, total_number) VALUES (?, ?, 1, ?) "
+            "ON CONFLICT(owner) DO UPDATE SET last_sync = excluded.last_sync, complete = 1, "
+            "total_number = excluded.total_number",
+            (owner, time.time(), total_number or 0),
+        )
+        return {"ok": True, "pages": pages, "added": added, "total_number": total_number}
+
+    def sync_in_background(self, client, access_token, max_age):
+        """Start a sync on a daemon thread if the last one is older than max_age seconds."""
+        owner = owner_of(access_token)
+        if time.time() - self.last_sync(access_token) < max_age:
+            return False
+        with self._lock:
+            if owner in self._syncing:
+                return False
+            self._syncing.add(owner)
+
+        def run():
+            try:
+                self.sync(client, access_token)
+            except Exception as e:
+                log.warning("Script library sync failed: %s", e)
+            finally:
+                with self._lock:
+                    self._syncing.discard(owner)
+
+        threading.Thread(target=run, name="script-sync", daemon=True).start()
+        return True
+
+    # ---- reads ----
+
+    def last_sync(self, access_token):
+        row = self._connect().execute(
+            "SELECT last_sync FROM sync_state WHERE owner = ?", (owner_of(access_token),)
+        ).fetchone()
+        return row[0] if row else 0.0
+
+    def is_syncing(self, access_token):
+        with self._lock:
+            return owner_of(access_token) in self._syncing
+
+    def get(self, access_token, script_id):
+        """One stored script dict, or None."""
+        row = self._connect().execute(
+            "SELECT raw FROM scripts WHERE owner = ? AND script_id = ?", (owner_of(access_token), script_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def all_scripts(self, access_token):
+        """Every stored (script_id, script) of this access token."""
+        return self._connect().execute(
+            "SELECT script_id, script FROM scripts WHERE owner = ?", (owner_of(access_token),)
+        ).fetchall()
+
+    def search(self, access_token, q="", start_date=None, end_date=None, page=1, page_size=20):
+        """
+        Newest-first page of scripts matching every keyword in `q` (title or
+        body) and created between start_date and end_date (YYYY-MM-DD,
+        inclusive). Returns (list, page_info) shaped like TikTok's list API.
+        """
+        where = ["s.owner = ?"]
+        args = [owner_of(access_token)]
+        join = ""
+        match = _fts_query(q or "")
+        if match:
+            join = "JOIN scripts_fts f ON f.rowid = s.rowid"
+            where.append("scripts_fts MATCH ?")
+            args.append(match)
+        if start_date:
+            where.append("substr(s.create_time, 1, 10) >= ?")
+            args.append(start_date)
+        if end_date:
+            where.append("substr(s.create_time, 1, 10) <= ?")
+            args.append(end_date)
+        clause = " AND ".join(where)
+
+        db = self._connect()
+        total = db.execute(f"SELECT COUNT(*) FROM scripts s {join} WHERE {clause}", args).fetchone()[0]
+        rows = db.execute(
+            f"SELECT s.raw FROM scripts s {join} WHERE {clause} "
+            f"ORDER BY s.create_time DESC, s.script_id DESC LIMIT ? OFFSET ?",
+            args + [page_size, (page - 1) * page_size],
+        ).fetchall()
+
+        page_info = {
+            "page": page,
+            "page_size": page_size,
+            "total_number": total,
+            "total_page": max(1, -(-total // page_size)),
+        }
+        return [json.loads(raw) for (raw,) in rows], page_info
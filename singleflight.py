@@ -0,0 +1,135 @@
+# singleflight.py
+"""
+Coalesce identical concurrent upstream calls.
+
+When several requests need the same TikTok GET at the same moment (many
+users opening the avatar page, overlapping status polls), only the first
+one - the leader - calls TikTok. Followers wait for the leader and get its
+result. Within a worker this is a dict of in-flight calls; with
+`shared=True` the leaders of different worker processes also serialize on
+a per-key file lock, and the first one publishes its result in a short-lived
+file that the others pick up instead of calling TikTok again.
+"""
+import fcntl
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+
+
+class _Call:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lock_dir=None, shared=False, share_ttl=1.0, lock_timeout=35.0, sweep_every=500):
+        self.shared = shared and lock_dir is not None
+        self.lock_dir = lock_dir
+        self.share_ttl = share_ttl
+        self.lock_timeout = lock_timeout
+        self.sweep_every = sweep_every
+
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "leaders": 0, "merged": 0, "shared_hits": 0}
+
+        if self.shared:
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key: str, fn):
+        """Run fn() once for all concurrent callers using the same key and return its result."""
+        with self._lock:
+            self._counters["calls"] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._counters["merged"] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._run_shared(key, fn) if self.shared else self._run(fn)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+        saved = counters["merged"] + counters["shared_hits"]
+        counters["saved_ratio"] = round(saved / counters["calls"], 3) if counters["calls"] else 0.0
+        counters["in_flight"] = len(self._calls)
+        counters["shared"] = self.shared
+        return counters
+
+    def _run(self, fn):
+        with self._lock:
+            self._counters["leaders"] += 1
+        return fn()
+
+    def _run_shared(self, key, fn):
+        name = hashlib.sha256(key.encode()).hexdigest()[:32]
+        lock_path = os.path.join(self.lock_dir, f"{name}.lock")
+        result_path = os.path.join(self.lock_dir, f"{name}.result")
+
+        with open(lock_path, "a+") as lock_file:
+            # Poll instead of blocking in flock so gevent workers keep serving
+            deadline = time.monotonic() + self.lock_timeout
+            locked = False
+            while not locked and time.monotonic() < deadline:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    locked = True
+                except BlockingIOError:
+                    time.sleep(0.02)
+            try:
+                # Another worker may have finished the same call while we waited
+                try:
+                    if time.time() - os.path.getmtime(result_path) < self.share_ttl:
+                        with open(result_path, "rb") as f:
+                            result = pickle.load(f)
+                        with self._lock:
+                            self._counters["shared_hits"] += 1
+                        return result
+                except (OSError, EOFError, pickle.UnpicklingError):
+                    pass
+
+                result = self._run(fn)
+                if self._counters["leaders"] % self.sweep_every == 0:
+                    self._sweep()
+                fd, tmp_path = tempfile.mkstemp(dir=self.lock_dir)
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(result, f)
+                os.replace(tmp_path, result_path)
+                return result
+            finally:
+                if locked:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _sweep(self, max_age=600):
+        """Remove lock/result files of keys nobody asked for in a while."""
+        cutoff = time.time() - max_age
+        for entry in os.scandir(self.lock_dir):
+            try:
+                if entry.stat().st_mtime < cutoff and entry.stat().st_atime < cutoff:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
@@ -0,0 +1,148 @@
+# structured_logging.py
+"""
+JSON-lines logging that stays off the request path.
+
+Handlers only put records on a bounded queue (QueueHandler); a listener
+thread does the expensive part - redacting, truncating and serializing -
+and writes one JSON object per line to stdout or LOG_FILE. If the queue is
+full, records are dropped and counted rather than blocking a request.
+
+Anything passed in `extra=` becomes a field of the line. Fields named like
+credentials are redacted, long values are cut to `max_field_chars`, and
+every line written while handling a request carries its request ID.
+Request/response bodies should go through sample_body() so that only a
+fraction of them (all of them at DEBUG) are logged at all.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+SECRET_KEYS = {"access_token", "access-token", "authorization", "password", "secret", "secret_key", "token"}
+SECRET_IN_TEXT = re.compile(r"""(access[_-]token["']?\s*[:=]\s*["']?)[^"'&\s,}]+""", re.IGNORECASE)
+
+# Attributes every LogRecord has; everything else came in through `extra=`
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "taskName"}
+
+_state = {"body_sample_rate": 0.01, "listener": None, "dropped": 0}
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {k: "[redacted]" if str(k).lower() in SECRET_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(v) for v in value]
+    if isinstance(value, str):
+        return SECRET_IN_TEXT.sub(r"\1[redacted]", value)
+    return value
+
+
+def sample_body(body):
+    """`body` for a sampled share of calls (every call when DEBUG is on), otherwise None."""
+    if logging.getLogger().isEnabledFor(logging.DEBUG) or random.random() < _state["body_sample_rate"]:
+        return body
+    return None
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, max_field_chars=2000):
+        super().__init__()
+        self.max_field_chars = max_field_chars
+
+    def _truncate(self, value):
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        text = value if isinstance(value, str) else json.dumps(value, default=str, separators=(",", ":"))
+        if len(text) <= self.max_field_chars:
+            return value
+        return f"{text[:self.max_field_chars]}...(+{len(text) - self.max_field_chars} chars)"
+
+    def format(self, record):
+        line = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": redact(record.getMessage()),
+        }
+        for key, value in vars(record).items():
+            if key in _STANDARD_ATTRS or value is None:
+                continue
+            line[key] = "[redacted]" if key.lower() in SECRET_KEYS else self._truncate(redact(value))
+        if record.exc_info:
+            line["exc"] = redact(self.formatException(record.exc_info))
+        return json.dumps(line, default=str, ensure_ascii=False)
+
+
+class _RequestIdFilter(logging.Filter):
+    """Stamp records with the current Flask request's ID while still on the request thread."""
+
+    def filter(self, record):
+        if not hasattr(record, "request_id"):
+            record.request_id = g.get("request_id") if has_request_context() else None
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _state["dropped"] += 1
+
+
+def setup_logging(level="INFO", log_file=None, body_sample_rate=0.01, max_field_chars=2000, queue_size=10000):
+    """Route the root logger through a background queue to a JSON-lines handler."""
+    _state["body_sample_rate"] = body_sample_rate
+    target = logging.FileHandler(log_file) if log_file else logging.StreamHandler(sys.stdout)
+    target.setFormatter(JsonFormatter(max_field_chars))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = _DroppingQueueHandler(log_queue)
+    handler.addFilter(_RequestIdFilter())
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        if isinstance(existing, _DroppingQueueHandler):
+            root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+
+    def start_listener():
+        listener = logging.handlers.QueueListener(log_queue, target, respect_handler_level=True)
+        listener.start()
+        _state["listener"] = listener
+
+    start_listener()
+    # Flush what is still queued when the process exits
+    atexit.register(lambda: _state["listener"].stop())
+    # The listener thread does not survive a fork; gunicorn workers need their own
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=start_listener)
+
+
+def stats():
+    return {"dropped": _state["dropped"], "body_sample_rate": _state["body_sample_rate"]}
+
+
+def init_app(app):
+    """Give every request an ID (X-Request-ID if the caller sent one) and echo it back."""
+    @app.before_request
+    def _assign_request_id():
+        incoming = request.headers.get("X-Request-ID", "")
+        g.request_id = incoming[:64] if incoming else uuid.uuid4().hex[:16]
+
+    @app.after_request
+    def _echo_request_id(response):
+        request_id = g.get("request_id")
+        if request_id:
+            response.headers["X-Request-ID"] = request_id
+        return response
@@ -0,0 +1,432 @@
+# task_tracker.py
+"""
+Background poller for TikTok script and avatar video tasks.
+
+Browsers used to poll TikTok themselves, one request per open tab every
+few seconds. The tracker instead remembers which task IDs are pending for
+each access token, polls TikTok for them in batches (backing off while a
+task's status does not change) and keeps the latest result of every task.
+The status routes read from that store, so upstream calls grow with the
+number of batches rather than with the number of tabs.
+
+The store lives in SQLite, so every gunicorn worker sees the same tasks
+and results. Each worker runs a poller thread, but only the one holding
+the `poller` lease polls; the others stand by and take over when a lease
+is not renewed within `lease_seconds`. Upstream traffic therefore does not
+grow with the number of workers.
+
+Streaming clients can block on wait_for_change() to be woken up whenever
+a tracked task changes status. Changes bump a version counter in the
+database, which waiting clients of other workers notice within `tick`.
+
+Like bulk_jobs.py, the store keeps the access token of each task so the
+poller can use it - except for the server's own TIKTOK_ACCESS_TOKEN,
+which is stored as an empty string and taken from `default_token`.
+"""
+import contextvars
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+log = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = {"SUCCESS", "PARTIAL_SUCCESS", "FAILED"}
+
+# kind -> upstream status endpoint and whether it accepts a list of IDs
+TASK_KINDS = {
+    "script": {"path": "/creative/aigc/script/task/get/", "batched": False},
+    "avatar": {"path": "/creative/digital_avatar/video/task/get/", "batched": True},
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    kind TEXT NOT NULL,
+    access_token TEXT NOT NULL,
+    task_id TEXT NOT NULL,
+    result TEXT,
+    envelope TEXT,
+    status TEXT,
+    done INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL DEFAULT 0,
+    last_seen REAL NOT NULL,
+    next_poll REAL NOT NULL DEFAULT 0,
+    interval REAL NOT NULL,
+    polled_status TEXT,
+    PRIMARY KEY (kind, access_token, task_id)
+);
+CREATE INDEX IF NOT EXISTS tasks_due ON tasks (done, next_poll);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    until REAL NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO meta (name) VALUES ('version');
+INSERT OR IGNORE INTO meta (name) VALUES ('poller');
+"""
+
+
+def _ok(body, status_code):
+    # TikTok signals success with HTTP 200 and code 0 (sometimes sent as "0")
+    return status_code == 200 and str(body.get("code")) == "0"
+
+
+class TrackedTask:
+    __slots__ = ("kind", "access_token", "task_id", "result", "envelope", "status", "updated_at")
+
+    def __init__(self, kind, access_token, task_id, result, envelope, status, updated_at):
+        self.kind = kind
+        self.access_token = access_token
+        self.task_id = task_id
+        self.result = result        # per-task payload: script task `data`, or one avatar `data.list` item
+        self.envelope = envelope    # code / message / request_id of the response it came from
+        self.status = status
+        self.updated_at = updated_at
+
+    @property
+    def done(self):
+        return self.status in TERMINAL_STATUSES
+
+
+class TaskTracker:
+    def __init__(self, path, client, default_token="", batch_size=20, min_interval=2.0, max_interval=15.0,
+                 backoff=1.5, idle_ttl=120, result_ttl=1800, tick=0.5, poll_concurrency=4, lease_seconds=30,
+                 touch_interval=10, on_done=None):
+        self.path = path
+        self.client = client
+        self.default_token = default_token
+        self.on_done = on_done  # called as on_done(kind, access_token, task) when a task finishes
+        self.batch_size = batch_size
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.idle_ttl = idle_ttl
+        self.result_ttl = result_ttl
+        self.tick = tick
+        self.poll_concurrency = poll_concurrency  # batches polled at once (script tasks are one per call)
+        self.lease_seconds = lease_seconds
+        self.touch_interval = touch_interval  # last_seen is written at most this often per task
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._local_version = 0  # bumped when this worker changes a task's status
+        self._pid = None
+        self._counters = {"upstream_calls": 0, "upstream_errors": 0, "lookups": 0, "store_hits": 0,
+                          "lease_acquired": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    @property
+    def worker_id(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _stored_token(self, access_token):
+        return "" if access_token == self.default_token else access_token
+
+    def _task(self, kind, stored_token, task_id, result, envelope, status, updated_at):
+        return TrackedTask(kind, stored_token or self.default_token, task_id, json.loads(result),
+                           json.loads(envelope) if envelope else {}, status, updated_at)
+
+    # ---- public API ----
+
+    def track(self, kind, access_token, task_ids):
+        """Start polling task IDs in the background (e.g. right after they were created)."""
+        now = time.time()
+        self._connect().executemany(
+            "INSERT OR IGNORE INTO tasks (kind, access_token, task_id, last_seen, interval) VALUES (?, ?, ?, ?, ?)",
+            [(kind, self._stored_token(access_token), task_id, now, self.min_interval) for task_id in task_ids],
+        )
+        self._ensure_running()
+
+    def lookup(self, kind, access_token, task_ids):
+        """
+        Return (tasks, error). `tasks` maps task_id -> TrackedTask for every ID
+        TikTok knows about. IDs never seen before are fetched synchronously
+        once; if that upstream call fails `error` is the (body, status_code)
+        TikTok returned so the route can relay it unchanged.
+        Raises requests.RequestException on transport errors.
+        """
+        self._ensure_running()
+        with self._lock:
+            self._counters["lookups"] += 1
+        tasks, known = self._read(kind, access_token, task_ids)
+        unknown = [task_id for task_id in dict.fromkeys(task_ids) if task_id not in known]
+        if unknown:
+            self.track(kind, access_token, unknown)
+        missing = [task_id for task_id in dict.fromkeys(task_ids) if task_id not in tasks]
+        if not missing:
+            with self._lock:
+                self._counters["store_hits"] += 1
+            return tasks, None
+
+        error = None
+        for chunk in self._chunks(kind, missing):
+            body, status_code = self._fetch(kind, access_token, chunk)
+            if not _ok(body, status_code):
+                # Do not keep polling IDs TikTok rejected on first sight
+                marks = ",".join("?" * len(chunk))
+                self._connect().execute(
+                    f"DELETE FROM tasks WHERE kind = ? AND access_token = ? AND result IS NULL "
+                    f"AND task_id IN ({marks})",
+                    [kind, self._stored_token(access_token)] + chunk,
+                )
+                error = (body, status_code)
+                break
+        return self._read(kind, access_token, task_ids, touch=False)[0], error
+
+    def snapshot(self, kind, access_token, task_ids):
+        """Like lookup() for tracked IDs, but never calls TikTok: only tasks with a result so far."""
+        return self._read(kind, access_token, task_ids)[0]
+
+    @property
+    def version(self):
+        """Changes whenever a tracked task changes status, in any worker."""
+        with self._lock:
+            local = self._local_version
+        return local, self._db_version()
+
+    def wait_for_change(self, version, timeout):
+        """Block until a task changed status after `version` was read, or timeout. Returns the new version."""
+        local, shared = version
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: self._local_version != local,
+                                       timeout=max(0.0, min(self.tick, deadline - time.monotonic())))
+                current_local = self._local_version
+            current = (current_local, self._db_version())
+            if current_local != local or current[1] != shared or time.monotonic() >= deadline:
+                return current
+
+    def stats(self):
+        tracked, pending = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(done = 0), 0) FROM tasks"
+        ).fetchone()
+        owner, until = self._connect().execute("SELECT owner, until FROM meta WHERE name = 'poller'").fetchone()
+        with self._lock:
+            return {"tracked": tracked, "pending": pending, "poller": owner if until > time.time() else None,
+                    "polling_here": owner == self.worker_id and until > time.time(), **self._counters}
+
+    # ---- internals ----
+
+    def _read(self, kind, access_token, task_ids, touch=True):
+        """(tasks with a result, IDs in the store at all) and refresh last_seen of the ones read."""
+        tasks, known, stale = {}, set(), []
+        if not task_ids:
+            return tasks, known
+        now = time.time()
+        stored = self._stored_token(access_token)
+        db = self._connect()
+        for i in range(0, len(task_ids), 500):
+            chunk = task_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = db.execute(
+                f"SELECT task_id, result, envelope, status, updated_at, last_seen FROM tasks "
+                f"WHERE kind = ? AND access_token = ? AND task_id IN ({marks})",
+                [kind, stored] + chunk,
+            ).fetchall()
+            for task_id, result, envelope, status, updated_at, last_seen in rows:
+                known.add(task_id)
+                if now - last_seen >= self.touch_interval:
+                    stale.append(task_id)
+                if result is not None:
+                    tasks[task_id] = self._task(kind, stored, task_id, result, envelope, status, updated_at)
+        if touch and stale:
+            # Tasks nobody asks about any more stop being polled after idle_ttl
+            db.executemany("UPDATE tasks SET last_seen = ? WHERE kind = ? AND access_token = ? AND task_id = ?",
+                           [(now, kind, stored, task_id) for task_id in stale])
+        return tasks, known
+
+    def _db_version(self):
+        return self._connect().execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+
+    def _chunks(self, kind, task_ids):
+        if not TASK_KINDS[kind]["batched"]:
+            return [[task_id] for task_id in task_ids]
+        return [task_ids[i:i + self.batch_size] for i in range(0, len(task_ids), self.batch_size)]
+
+    def _fetch(self, kind, access_token, task_ids):
+        """Call TikTok for one batch, store whatever came back and reschedule the batch."""
+        path = TASK_KINDS[kind]["path"]
+        if TASK_KINDS[kind]["batched"]:
+            params = {"task_ids": json.dumps(task_ids)}
+        else:
+            params = {"task_id": task_ids[0]}
+
+        with self._lock:
+            self._counters["upstream_calls"] += 1
+        try:
+            r = self.client.get(path, access_token, params=params)
+            body = r.json()
+        except (requests.RequestException, ValueError):
+            with self._lock:
+                self._counters["upstream_errors"] += 1
+            self._store(kind, access_token, task_ids, [], None, ok=False)
+            raise
+
+        ok = _ok(body, r.status_code)
+        if not ok:
+            with self._lock:
+                self._counters["upstream_errors"] += 1
+            results, envelope = [], None
+        else:
+            data = body.get("data") or {}
+            envelope = {k: body.get(k) for k in ("code", "message", "request_id")}
+            if kind == "script":
+                results = [(task_ids[0], data)]
+            else:
+                results = [(item.get("task_id"), item) for item in data.get("list") or []]
+
+        finished = self._store(kind, access_token, task_ids, results, envelope, ok=ok)
+        if self.on_done:
+            for task in finished:
+                try:
+                    self.on_done(kind, access_token, task)
+                except Exception as e:
+                    log.warning("Task tracker on_done hook failed for %s: %s", task.task_id, e)
+        return body, r.status_code
+
+    def _store(self, kind, access_token, task_ids, results, envelope, ok):
+        """
+        Write the results of one poll and schedule the next one, in one
+        transaction. Returns the tasks that finished with it (each one is
+        returned by exactly one worker, so on_done runs once per task).
+        """
+        now = time.time()
+        stored = self._stored_token(access_token)
+        results = {task_id: result for task_id, result in results if task_id}
+        marks = ",".join("?" * len(task_ids))
+        finished, changed = [], False
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute(
+                f"SELECT task_id, status, done, interval, polled_status, result IS NULL FROM tasks "
+                f"WHERE kind = ? AND access_token = ? AND task_id IN ({marks})",
+                [kind, stored] + task_ids,
+            ).fetchall()
+            for task_id, status, was_done, interval, polled_status, unseen in rows:
+                result = results.get(task_id)
+                if result is not None:
+                    new_status = result.get("status")
+                    done = new_status in TERMINAL_STATUSES
+                    changed = changed or unseen or new_status != status
+                    status = new_status
+                    db.execute(
+                        "UPDATE tasks SET result = ?, envelope = ?, status = ?, done = ?, updated_at = ? "
+                        "WHERE kind = ? AND access_token = ? AND task_id = ?",
+                        (json.dumps(result), json.dumps(envelope), status, done, now, kind, stored, task_id),
+                    )
+                    if done and not was_done:
+                        finished.append(TrackedTask(kind, access_token, task_id, result, envelope, status, now))
+                if not ok:
+                    interval = min(interval * 2, self.max_interval)
+                elif status != polled_status:
+                    interval = self.min_interval
+                else:
+                    interval = min(interval * self.backoff, self.max_interval)
+                db.execute(
+                    "UPDATE tasks SET interval = ?, polled_status = ?, next_poll = ? "
+                    "WHERE kind = ? AND access_token = ? AND task_id = ?",
+                    (interval, status, now + interval, kind, stored, task_id),
+                )
+            if changed:
+                db.execute("UPDATE meta SET value = value + 1 WHERE name = 'version'")
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        if changed:
+            with self._changed:
+                self._local_version += 1
+                self._changed.notify_all()
+        return finished
+
+    def _hold_lease(self):
+        """Take or renew the poller lease; True while this worker is the one polling."""
+        now = time.time()
+        db = self._connect()
+        owner, until = db.execute("SELECT owner, until FROM meta WHERE name = 'poller'").fetchone()
+        if owner == self.worker_id and until - now > self.lease_seconds / 2:
+            return True
+        if owner != self.worker_id and until >= now:
+            return False
+        cur = db.execute(
+            "UPDATE meta SET owner = ?, until = ? WHERE name = 'poller' AND (owner = ? OR until < ?)",
+            (self.worker_id, now + self.lease_seconds, self.worker_id, now),
+        )
+        return cur.rowcount == 1
+
+    def _collect_due(self):
+        """Evict stale entries and group tasks that are due by (kind, token)."""
+        now = time.time()
+        db = self._connect()
+        db.execute("DELETE FROM tasks WHERE (done = 1 AND updated_at < ?) OR (done = 0 AND last_seen < ?)",
+                   (now - self.result_ttl, now - self.idle_ttl))
+        due = {}
+        for kind, stored, task_id in db.execute(
+            "SELECT kind, access_token, task_id FROM tasks WHERE done = 0 AND next_poll <= ? ORDER BY next_poll",
+            (now,),
+        ):
+            due.setdefault((kind, stored or self.default_token), []).append(task_id)
+        return due
+
+    def _ensure_running(self):
+        # One poller thread per worker process; re-spawned after a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="task-tracker", daemon=True).start()
+
+    def _poll(self, kind, access_token, chunk):
+        try:
+            self._fetch(kind, access_token, chunk)
+        except (requests.RequestException, ValueError) as e:
+            log.warning("Task tracker poll failed for %s %s: %s", kind, chunk, e)
+
+    def _run(self):
+        pool = ThreadPoolExecutor(max_workers=self.poll_concurrency, thread_name_prefix="task-poll")
+        leading = False
+        while True:
+            try:
+                holds = self._hold_lease()
+                if holds and not leading:
+                    with self._lock:
+                        self._counters["lease_acquired"] += 1
+                    log.info("Task tracker polling in this worker", extra={"worker": self.worker_id})
+                leading = holds
+                if leading:
+                    batches = [
+                        (kind, access_token, chunk)
+                        for (kind, access_token), task_ids in self._collect_due().items()
+                        for chunk in self._chunks(kind, task_ids)
+                    ]
+                    # A round takes as long as its slowest few calls, not the sum of all of them
+                    for future in [pool.submit(contextvars.copy_context().run, self._poll, *batch)
+                                   for batch in batches]:
+                        future.result()
+            except Exception:
+                log.exception("Task tracker error")
+            time.sleep(self.tick)
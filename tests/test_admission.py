@@ -0,0 +1,126 @@
+# tests/test_admission.py
+import threading
+import time
+
+import pytest
+
+from admission import AdmissionController, queued_for
+
+
+def controller(**kwargs):
+    return AdmissionController(**{"limit": 4, "min_limit": 1, "update_interval": 0, **kwargs})
+
+
+def test_queued_for_reads_every_router_unit():
+    now = 1_700_000_010.0
+    assert queued_for("t=1700000008.5", now) == 1.5
+    assert queued_for("1700000008500", now) == 1.5
+    assert queued_for("1700000008500000", now) == 1.5
+    assert queued_for("garbled", now) == queued_for(None, now) == 0.0
+    assert queued_for(str(now + 5), now) == 0.0
+
+
+def test_lower_classes_only_use_their_share_of_the_limit():
+    admission = controller(limit=10, deadlines={"poll": 0.05, "read": 0.05, "create": 0.05})
+    assert all(admission.admit("poll")[0] for _ in range(5))
+    ticket, retry_after = admission.admit("poll")  # 50% of the limit is in use
+    assert ticket is None and retry_after >= 1
+    assert all(admission.admit("read")[0] for _ in range(3))  # reads may go up to 80%
+    assert admission.admit("read")[0] is None
+    assert all(admission.admit("create")[0] for _ in range(2))  # creates may use the whole limit
+    assert admission.admit("create")[0] is None
+    assert admission.admit("interactive")[0]  # pages are never held back
+    shed = admission.stats()["shed_by_class"]
+    assert (shed["interactive"], shed["create"], shed["read"], shed["poll"]) == (0, 1, 1, 1)
+
+
+def test_queued_request_starts_when_a_slot_frees_up():
+    admission = controller(limit=1)
+    held = admission.admit("create")[0]
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(admission.admit("create")))
+    waiter.start()
+    time.sleep(0.05)
+    assert admission.stats()["waiting"]["create"] == 1
+    admission.release(held)
+    waiter.join(2)
+    assert result[0][0] is not None and admission.stats()["queued"] == 1
+
+
+def test_higher_classes_leave_the_queue_first():
+    admission = controller(limit=1)
+    held = admission.admit("create")[0]
+    order = []
+
+    def wait(route_class):
+        ticket, _ = admission.admit(route_class)
+        order.append(route_class)
+        admission.release(ticket)
+
+    threads = [threading.Thread(target=wait, args=(route_class,)) for route_class in ("poll", "read", "create")]
+    for thread in threads:
+        thread.start()
+        time.sleep(0.05)
+    admission.release(held)
+    for thread in threads:
+        thread.join(2)
+    assert order == ["create", "read", "poll"]
+
+
+def test_requests_that_would_miss_their_deadline_are_shed_at_once():
+    admission = controller(limit=1, max_queue=1)
+    admission.admit("create")
+    started = time.monotonic()
+    assert admission.admit("create", already_queued=10.0) == (None, 1)
+    assert time.monotonic() - started < 0.05
+
+    threading.Thread(target=admission.admit, args=("create",), daemon=True).start()
+    time.sleep(0.05)
+    assert admission.admit("create")[0] is None  # the queue is full
+    assert admission.stats()["shed"] == 2
+
+
+def test_failures_cut_the_limit_and_steady_latency_grows_it():
+    admission = controller(limit=10, backoff=0.5)
+    admission.observe_upstream(0.1, failed=True)
+    assert admission.stats()["limit"] == 5
+
+    tickets = [admission.admit("create")[0] for _ in range(5)]  # the limit is in use
+    for _ in range(5):
+        admission.observe_upstream(0.1, failed=False)
+    assert admission.stats()["limit"] > 5
+    for ticket in tickets:
+        admission.release(ticket)
+
+
+def test_rising_latency_shrinks_the_limit():
+    admission = controller(limit=20)
+    for _ in range(20):
+        admission.observe_upstream(0.1, failed=False)
+    before = admission.stats()["limit"]
+    for _ in range(20):
+        admission.observe_upstream(2.0, failed=False)
+    assert admission.stats()["limit"] < before
+
+
+def test_streamed_response_holds_its_ticket_until_the_stream_ends():
+    flask = pytest.importorskip("flask")
+    app = flask.Flask(__name__)
+    admission = controller()
+    admission.init_app(app, lambda request: "long")
+    seen = []
+
+    @app.get("/stream")
+    def stream():
+        def events():
+            for i in range(2):
+                seen.append(admission.stats()["in_flight"]["long"])
+                yield f"{i}\n"
+        return flask.Response(flask.stream_with_context(events()))
+
+    response = app.test_client().get("/stream", buffered=False)
+    assert admission.stats()["in_flight"]["long"] == 1
+    assert b"".join(response.response) == b"0\n1\n"
+    response.close()
+    assert seen == [1, 1]
+    assert admission.stats()["in_flight"]["long"] == 0
@@ -0,0 +1,80 @@
+# tests/test_asset_index.py
+import time
+
+import pytest
+
+from asset_index import AssetIndex
+
+TOKEN = "token"
+ADVERTISER = "adv"
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+class TikTok:
+    """Asset search stand-in serving `videos` in pages; `on_page(page)` runs before each page is answered."""
+
+    def __init__(self, videos, page_size=2):
+        self.videos = videos
+        self.page_size = page_size
+        self.on_page = None
+
+    def get(self, path, access_token, params=None):
+        page = params["page"]
+        if self.on_page:
+            self.on_page(page)
+        start = (page - 1) * self.page_size
+        return Response({"code": 0, "message": "OK", "data": {
+            "list": [{"video_id": video_id} for video_id in self.videos[start:start + self.page_size]],
+            "page_info": {"total_number": len(self.videos),
+                          "total_page": max(1, -(-len(self.videos) // self.page_size))},
+        }})
+
+
+@pytest.fixture
+def index(tmp_path):
+    return AssetIndex(str(tmp_path / "assets.sqlite3"), page_size=2, concurrency=2)
+
+
+def video_ids(index):
+    return sorted(video["video_id"] for video in index.query(TOKEN, ADVERTISER)[0])
+
+
+def test_full_crawl_drops_videos_deleted_upstream(index):
+    index.refresh(TikTok(["a", "b", "c"]), TOKEN, ADVERTISER, full=True)
+    index.refresh(TikTok(["a", "c"]), TOKEN, ADVERTISER, full=True)
+    assert video_ids(index) == ["a", "c"]
+
+
+def test_one_crawl_per_library_at_a_time(index):
+    other_worker = AssetIndex(index.path, page_size=2)
+    tiktok = TikTok(["a", "b", "c"])
+    results = []
+    tiktok.on_page = lambda page: page == 1 and results.append(
+        other_worker.refresh(TikTok(["x"]), TOKEN, ADVERTISER, full=True))
+
+    assert index.refresh(tiktok, TOKEN, ADVERTISER, full=True)["pages"] == 2
+    assert results == [None]  # the other worker found the lease taken
+    assert video_ids(index) == ["a", "b", "c"]
+    assert other_worker.refresh(TikTok(["a"]), TOKEN, ADVERTISER, full=True) is not None  # released
+
+
+def test_crawl_that_lost_its_lease_keeps_videos_it_did_not_see(index):
+    index.refresh(TikTok(["a", "b", "c", "d"]), TOKEN, ADVERTISER, full=True)
+
+    def take_over(page):
+        if page == 2:  # the lease ran out and another crawl took it
+            index._connect().execute("UPDATE crawl_leases SET holder = 'other', until = ?", (time.time() + 60,))
+
+    tiktok = TikTok(["a", "b", "c"])
+    tiktok.on_page = take_over
+    index.refresh(tiktok, TOKEN, ADVERTISER, full=True)
+    assert video_ids(index) == ["a", "b", "c", "d"]
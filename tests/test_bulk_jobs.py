@@ -0,0 +1,213 @@
+# tests/test_bulk_jobs.py
+import os
+import time
+
+import pytest
+import requests
+
+from bulk_jobs import BulkJobRunner
+from task_tracker import TERMINAL_STATUSES
+
+TOKEN = "token"
+
+
+class Died(BaseException):
+    """The worker process went away in the middle of a TikTok call."""
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class TikTok:
+    """Client stand-in for the create endpoint: one task per package, or `error` raised / `answer` given instead."""
+
+    def __init__(self):
+        self.error = None
+        self.answer = None
+        self.sent = []
+
+    def post(self, path, access_token, json=None):
+        if self.error is not None:
+            raise self.error
+        if self.answer is not None:
+            status_code, body = self.answer
+            return Response(body, status_code)
+        scripts = [package["script"] for package in json["material_packages"]]
+        self.sent.extend(scripts)
+        return Response({"code": 0, "message": "OK",
+                         "data": {"list": [{"task_id": f"t-{script}"} for script in scripts]}})
+
+
+class Task:
+    def __init__(self, task_id, status):
+        self.status = status
+        self.result = {"task_id": task_id, "status": status}
+
+    @property
+    def done(self):
+        return self.status in TERMINAL_STATUSES
+
+
+class Tracker:
+    """Task tracker stand-in: tasks finish when the test says so; `rejected` IDs fail every batch they are in."""
+
+    batch_size = 20
+
+    def __init__(self):
+        self.statuses = {}
+        self.rejected = set()
+
+    def track(self, kind, access_token, task_ids):
+        for task_id in task_ids:
+            self.statuses.setdefault(task_id, "PROCESSING")
+
+    def lookup(self, kind, access_token, task_ids):
+        if self.rejected & set(task_ids):
+            return {}, ({"code": 40002, "message": "Invalid task_id"}, 200)
+        return {task_id: Task(task_id, status)
+                for task_id, status in self.statuses.items() if task_id in task_ids}, None
+
+
+class Runner(BulkJobRunner):
+    """A runner that is a separate worker, without its background thread."""
+
+    def __init__(self, *args, name, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self._pid = os.getpid()
+
+    @property
+    def worker_id(self):
+        return self.name
+
+
+@pytest.fixture
+def tiktok():
+    return TikTok()
+
+
+@pytest.fixture
+def tracker():
+    return Tracker()
+
+
+@pytest.fixture
+def make_runner(tmp_path, tiktok, tracker):
+    def make(name, **kwargs):
+        kwargs = {"batch_size": 2, "submit_interval": 0, "poll_interval": 0, "lease_seconds": 60, **kwargs}
+        return Runner(str(tmp_path / "bulk.sqlite3"), tiktok, tracker, name=name, **kwargs)
+    return make
+
+
+def packages(n):
+    return [{"avatar_id": "a", "script": f"s{i}"} for i in range(n)]
+
+
+def states(runner, job_id):
+    return [item["state"] for item in runner.job_items(job_id)[0]]
+
+
+def test_lease_is_kept_by_its_holder_until_it_expires(make_runner):
+    first, second = make_runner("first", lease_seconds=0.05), make_runner("second")
+    job_id = first.create_job(TOKEN, packages(1))
+
+    assert first._lease_jobs() == [job_id]
+    assert second._lease_jobs() == []
+    assert first._lease_jobs() == [job_id]  # renewing its own lease
+    time.sleep(0.1)
+    assert second._lease_jobs() == [job_id]
+    assert first._lease_jobs() == []
+    assert first.job_status(job_id)["worker"] == "second"
+
+
+def test_takeover_fails_items_interrupted_mid_submit_and_resumes_the_rest(make_runner, tiktok):
+    first, second = make_runner("first", lease_seconds=0.05), make_runner("second")
+    job_id = first.create_job(TOKEN, packages(4))
+
+    first._lease_jobs()
+    tiktok.error = Died()
+    with pytest.raises(Died):
+        first._step(job_id)
+    assert states(first, job_id) == ["submitting", "submitting", "pending", "pending"]
+
+    tiktok.error = None
+    time.sleep(0.1)
+    assert second._lease_jobs() == [job_id]
+    second._step(job_id)
+
+    # The interrupted batch may have created tasks; it is never sent again
+    assert tiktok.sent == ["s2", "s3"]
+    assert states(second, job_id) == ["failed", "failed", "submitted", "submitted"]
+    assert "interrupted" in second.job_items(job_id)[0][0]["error"]
+
+
+def test_submit_failures_are_retried_only_when_nothing_was_sent(make_runner, tiktok):
+    runner = make_runner("only")
+    job_id = runner.create_job(TOKEN, packages(4))
+
+    tiktok.error = requests.ConnectTimeout("connect timed out")
+    runner._submit_batch(job_id, TOKEN)
+    assert states(runner, job_id) == ["pending"] * 4
+
+    tiktok.error = requests.ReadTimeout("read timed out")
+    runner._submit_batch(job_id, TOKEN)
+    assert states(runner, job_id) == ["failed", "failed", "pending", "pending"]
+
+
+def test_throttled_or_failed_batches_are_sent_again_later(make_runner, tiktok):
+    runner = make_runner("only", retry_interval=60)
+    job_id = runner.create_job(TOKEN, packages(2))
+    runner._lease_jobs()
+
+    tiktok.answer = (429, {"code": 40100, "message": "Too many requests"})
+    runner._step(job_id)
+    assert states(runner, job_id) == ["pending"] * 2
+    next_submit_at = runner._connect().execute("SELECT next_submit_at FROM jobs").fetchone()[0]
+    assert next_submit_at > time.time() + 30
+    tiktok.answer = (200, {"code": 40100, "message": "Too many requests"})
+    assert runner._submit_batch(job_id, TOKEN) is True
+    tiktok.answer = (502, "<html>Bad Gateway</html>")
+    assert runner._submit_batch(job_id, TOKEN) is True
+    assert states(runner, job_id) == ["pending"] * 2
+    assert tiktok.sent == []
+
+    tiktok.answer = (200, {"code": 40002, "message": "Invalid avatar_id"})
+    assert runner._submit_batch(job_id, TOKEN) is False
+    assert states(runner, job_id) == ["failed"] * 2
+
+
+def test_job_finishes_when_every_task_is_final(make_runner, tracker):
+    runner = make_runner("only")
+    job_id = runner.create_job(TOKEN, packages(3))
+    runner._lease_jobs()
+    runner._step(job_id)
+    runner._step(job_id)
+    assert states(runner, job_id) == ["submitted"] * 3
+
+    tracker.statuses.update({"t-s0": "SUCCESS", "t-s1": "FAILED", "t-s2": "SUCCESS"})
+    runner._step(job_id)
+    job = runner.job_status(job_id)
+    assert states(runner, job_id) == ["success", "failed", "success"]
+    assert job["state"] == "finished" and job["worker"] is None and job["progress"] == 1.0
+
+
+def test_task_ids_tiktok_keeps_rejecting_are_failed(make_runner, tracker):
+    runner = make_runner("only", max_rejections=3)
+    job_id = runner.create_job(TOKEN, packages(2))
+    runner._lease_jobs()
+    runner._step(job_id)
+    tracker.rejected.add("t-s1")
+    tracker.statuses["t-s0"] = "SUCCESS"
+
+    for _ in range(2):
+        runner._poll(job_id, TOKEN)
+    assert states(runner, job_id) == ["success", "submitted"]
+    runner._poll(job_id, TOKEN)
+    assert states(runner, job_id) == ["success", "failed"]
+    assert "rejected" in runner.job_items(job_id)[0][1]["error"]
@@ -0,0 +1,91 @@
+# tests/test_circuit_breaker.py
+import time
+
+import pytest
+
+from circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakers, CircuitOpen
+
+
+@pytest.fixture
+def breaker():
+    return CircuitBreaker("file", window=10, min_calls=4, failure_ratio=0.5, slow_call_seconds=1.0,
+                          slow_ratio=0.75, open_seconds=0.05)
+
+
+def call(breaker, failed=False, duration=0.01):
+    breaker.before()
+    breaker.record(failed, duration)
+
+
+def open_it(breaker):
+    for failed in (True, False, True, True):
+        call(breaker, failed)
+
+
+def test_opens_once_enough_calls_fail(breaker):
+    for failed in (True, True, True):
+        call(breaker, failed)
+    assert breaker.state == CLOSED  # fewer than min_calls so far
+    call(breaker)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    assert breaker.stats()["rejected"] == 1 and breaker.stats()["opened"] == 1
+
+
+def test_stays_closed_below_the_failure_ratio(breaker):
+    for failed in (True, False, False, False, True, False, False, False):
+        call(breaker, failed)
+    assert breaker.state == CLOSED
+
+
+def test_opens_when_most_calls_are_slow(breaker):
+    for duration in (2.0, 2.0, 0.1, 2.0):
+        call(breaker, duration=duration)
+    assert breaker.state == OPEN
+
+
+def test_half_open_probe_success_closes(breaker):
+    open_it(breaker)
+    time.sleep(0.06)
+    assert breaker.state == HALF_OPEN
+    breaker.before()  # the probe
+    with pytest.raises(CircuitOpen):
+        breaker.before()  # only one probe at a time
+    breaker.record(False, 0.01)
+    assert breaker.state == CLOSED
+    assert breaker.stats()["calls_in_window"] == 0
+    call(breaker)
+
+
+def test_half_open_probe_failure_reopens(breaker):
+    open_it(breaker)
+    time.sleep(0.06)
+    breaker.before()
+    breaker.record(True, 0.01)
+    assert breaker.state == OPEN
+    with pytest.raises(CircuitOpen):
+        breaker.before()
+    assert breaker.stats()["opened"] == 2
+
+
+def test_cancelled_probe_frees_its_slot(breaker):
+    open_it(breaker)
+    time.sleep(0.06)
+    breaker.before()
+    breaker.cancel()  # e.g. the rate limiter refused the call after all
+    breaker.before()
+    breaker.record(False, 0.01)
+    assert breaker.state == CLOSED
+
+
+def test_one_breaker_per_endpoint_family():
+    breakers = CircuitBreakers(min_calls=1, failure_ratio=0.5, open_seconds=60)
+    files = breakers.for_path("/file/video/ad/info/")
+    assert files is breakers.for_path("/file/video/ad/search/")
+    call(files, failed=True)
+    with pytest.raises(CircuitOpen):
+        breakers.for_path("/file/video/ad/info/").before()
+    breakers.for_path("/creative/aigc/script/list/").before()
+    assert breakers.stats()["file"]["state"] == OPEN
+    assert breakers.stats()["script"]["state"] == CLOSED
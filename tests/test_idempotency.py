@@ -0,0 +1,71 @@
+# tests/test_idempotency.py
+import time
+
+import pytest
+
+from idempotency import IdempotencyStore, request_hash
+
+TOKEN = "token"
+BODY = {"access_token": TOKEN, "material_packages": [{"avatar_id": "a", "script": "hi"}]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return IdempotencyStore(str(tmp_path / "idempotency.sqlite3"))
+
+
+def test_finished_request_is_replayed(store):
+    req = request_hash(BODY)
+    assert store.begin(TOKEN, "create", "key-1", req) == ("new", None)
+    store.finish(TOKEN, "create", "key-1", b'{"task_id":"t1"}', 200)
+    assert store.begin(TOKEN, "create", "key-1", req) == ("done", (b'{"task_id":"t1"}', 200))
+    assert store.stats()["replayed"] == 1
+
+
+def test_request_hash_ignores_the_token_and_the_key():
+    assert request_hash(BODY) == request_hash({**BODY, "access_token": "other", "idempotency_key": "k"})
+    assert request_hash(BODY) != request_hash({**BODY, "material_packages": []})
+
+
+def test_key_is_scoped_to_token_and_endpoint(store):
+    req = request_hash(BODY)
+    store.begin(TOKEN, "create", "key-1", req)
+    assert store.begin("other", "create", "key-1", req)[0] == "new"
+    assert store.begin(TOKEN, "upload", "key-1", req)[0] == "new"
+
+
+def test_reuse_with_another_body_is_a_conflict(store):
+    store.begin(TOKEN, "create", "key-1", request_hash(BODY))
+    store.finish(TOKEN, "create", "key-1", b"{}", 200)
+    assert store.begin(TOKEN, "create", "key-1", request_hash({"other": 1})) == ("conflict", None)
+
+
+def test_running_request_blocks_repeats_until_its_lease_ends(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), lease_seconds=0.05)
+    req = request_hash(BODY)
+    store.begin(TOKEN, "create", "key-1", req)
+    assert store.begin(TOKEN, "create", "key-1", req) == ("in_progress", None)
+    time.sleep(0.1)
+    # Its worker died mid-request; the next retry takes the key over
+    assert store.begin(TOKEN, "create", "key-1", req) == ("new", None)
+
+
+def test_finished_keys_outlive_the_lease(tmp_path):
+    store = IdempotencyStore(str(tmp_path / "idempotency.sqlite3"), lease_seconds=0.05)
+    req = request_hash(BODY)
+    store.begin(TOKEN, "create", "key-1", req)
+    store.finish(TOKEN, "create", "key-1", b"{}", 500)
+    time.sleep(0.1)
+    assert store.begin(TOKEN, "create", "key-1", req) == ("done", (b"{}", 500))
+
+
+def test_released_key_can_be_retried(store):
+    req = request_hash(BODY)
+    store.begin(TOKEN, "create", "key-1", req)
+    store.release(TOKEN, "create", "key-1")
+    assert store.begin(TOKEN, "create", "key-1", req) == ("new", None)
+
+    store.finish(TOKEN, "create", "key-1", b"{}", 200)
+    store.release(TOKEN, "create", "key-1")  # a stored response is never released
+    assert store.begin(TOKEN, "create", "key-1", req)[0] == "done"
+    assert store.stats()["started"] == 2
@@ -0,0 +1,169 @@
+# tests/test_media_cache.py
+import os
+import threading
+
+import pytest
+import requests
+
+import media_cache
+from media_cache import MediaCache, MediaError, media_key
+from url_guard import URLGuard
+
+URL = "https://p16.tiktokcdn.com/video/abc.mp4?x-signature=1"
+VIDEO = b"0123456789"
+
+
+class Response:
+    def __init__(self, status_code, headers, chunks, drop=False):
+        self.status_code = status_code
+        self.headers = headers
+        self.chunks = chunks
+        self.drop = drop
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.drop:
+            raise requests.exceptions.ChunkedEncodingError("Connection broken")
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class Source:
+    """requests.Session stand-in for the CDN: honours Range, can drop the connection after `drop_after` bytes."""
+
+    def __init__(self, body=VIDEO, content_type="video/mp4", ranges=True, drop_after=None):
+        self.opened = threading.Event()
+        self.opened.set()
+        self.body = body
+        self.content_type = content_type
+        self.ranges = ranges
+        self.drop_after = drop_after
+        self.requests = []
+
+    def get(self, url, allow_redirects=True, headers=None, stream=False, timeout=None):
+        assert allow_redirects is False  # the guard follows redirects itself
+        self.opened.wait(5)
+        headers = headers or {}
+        self.requests.append((url, headers))
+        start = int(headers["Range"].removeprefix("bytes=").rstrip("-")) if "Range" in headers else 0
+        if not self.ranges:
+            start = 0
+        rest = self.body[start:]
+        response_headers = {"Content-Type": self.content_type, "Content-Length": str(len(rest))}
+        status_code = 200
+        if start:
+            status_code = 206
+            response_headers["Content-Range"] = f"bytes {start}-{len(self.body) - 1}/{len(self.body)}"
+        drop = self.drop_after is not None
+        if drop:
+            rest, self.drop_after = rest[:self.drop_after], None
+        return Response(status_code, response_headers, [rest[i:i + 3] for i in range(0, len(rest), 3)], drop)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = MediaCache(str(tmp_path / "media"), max_bytes=10 ** 6, retries=0, touch_interval=0,
+                       guard=URLGuard(allow_private=True))
+    cache._session = Source()
+    return cache
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_key_ignores_the_signed_query():
+    assert media_key("video", URL) == media_key("video", URL.replace("x-signature=1", "x-signature=2"))
+    assert media_key("video", URL) != media_key("image", URL)
+    assert media_key("video", URL) != media_key("video", URL.replace("abc", "abd"))
+
+
+def test_download_then_lookup(cache):
+    key = media_key("video", URL)
+    assert cache.lookup(key) is None
+    cache._download(key, "video", URL)
+    path, content_type = cache.lookup(key)
+    assert read(path) == VIDEO and content_type == "video/mp4"
+    assert not os.path.exists(path + ".part")
+
+
+def test_dropped_download_resumes_with_a_range_request(cache):
+    key = media_key("video", URL)
+    cache._session = source = Source(drop_after=4)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        cache._download(key, "video", URL)
+    assert cache.lookup(key) is None
+    assert read(cache.path(key) + ".part") == VIDEO[:4]
+
+    cache._download(key, "video", URL)
+    assert source.requests[1][1] == {"Range": "bytes=4-"}
+    assert read(cache.lookup(key)[0]) == VIDEO
+    assert cache.stats()["resumed"] == 1
+
+
+def test_source_ignoring_range_starts_over(cache):
+    key = media_key("video", URL)
+    cache._session = Source(ranges=False, drop_after=4)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        cache._download(key, "video", URL)
+    cache._download(key, "video", URL)
+    assert read(cache.lookup(key)[0]) == VIDEO
+
+
+def test_rejects_content_of_another_kind(cache):
+    key = media_key("image", URL)
+    for content_type in ("text/html", "image/svg+xml", "video/mp4"):
+        cache._session = Source(content_type=content_type)
+        with pytest.raises(MediaError):
+            cache._download(key, "image", URL)
+    assert cache.lookup(key) is None
+    assert not os.path.exists(cache.path(key) + ".part")
+
+
+def test_rejects_hosts_outside_the_allowlist(cache):
+    with pytest.raises(MediaError):
+        cache._download(media_key("video", "https://example.com/a.mp4"), "video", "https://example.com/a.mp4")
+    assert cache._session.requests == []
+
+
+def test_rejects_objects_over_the_size_cap(cache):
+    cache.max_object_bytes = 5
+    with pytest.raises(MediaError):
+        cache._download(media_key("video", URL), "video", URL)
+    assert cache.lookup(media_key("video", URL)) is None
+    assert not os.path.exists(cache.path(media_key("video", URL)) + ".part")
+
+
+def test_evicts_least_recently_served_entries(cache):
+    cache.max_bytes = 25
+    urls = [URL.replace("abc", name) for name in ("a", "b", "c")]
+    keys = [media_key("video", url) for url in urls]
+    cache._download(keys[0], "video", urls[0])
+    cache._download(keys[1], "video", urls[1])
+    assert cache.lookup(keys[0])  # a is now more recently served than b
+    cache._download(keys[2], "video", urls[2])
+
+    assert cache.lookup(keys[1]) is None and not os.path.exists(cache.path(keys[1]))
+    assert cache.lookup(keys[0]) and cache.lookup(keys[2])
+    assert cache.stats()["evicted"] == 1 and cache.stats()["bytes"] == 20
+
+
+def test_concurrent_fetches_of_one_key_download_once(cache, monkeypatch):
+    source = Source()
+    source.opened.clear()
+    monkeypatch.setattr(media_cache.requests, "Session", lambda: source)
+    key = media_key("video", URL)
+    first, second = cache.fetch(key, "video", URL), cache.fetch(key, "video", URL)
+    assert first is second
+    source.opened.set()
+    assert first.wait(5)
+    assert len(source.requests) == 1
+    assert read(cache.lookup(key)[0]) == VIDEO
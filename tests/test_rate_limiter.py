@@ -0,0 +1,86 @@
+# tests/test_rate_limiter.py
+import time
+
+import pytest
+
+from rate_limiter import RateLimiter, RateLimitExceeded, family_of
+
+PATH = "/file/video/ad/info/"
+TOKEN = "token"
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    return str(tmp_path / "ratelimit.sqlite3")
+
+
+def bucket(limiter, family="file"):
+    return next(b for b in limiter.stats()["buckets"] if b["family"] == family)
+
+
+def test_families_follow_path_prefixes():
+    assert family_of("/creative/aigc/script/list/") == "script"
+    assert family_of("/creative/digital_avatar/get/") == "avatar"
+    assert family_of("/file/video/ad/upload/") == "upload"
+    assert family_of(PATH) == "file"
+    assert family_of("/advertiser/info/") == "other"
+
+
+def test_burst_is_free_and_slots_are_reserved_in_batches(db_path):
+    limiter = RateLimiter(db_path, rate=10, max_wait=5, sync_interval=0.5)
+    waits = [limiter.acquire(PATH, TOKEN) for _ in range(5)]
+    assert waits == [0.0] * 5  # a full bucket holds a second's worth of calls
+    assert limiter.stats()["syncs"] == 1
+    limiter.acquire(PATH, TOKEN)
+    assert limiter.stats()["syncs"] == 2
+
+
+def test_calls_beyond_the_burst_wait_for_their_slot(db_path):
+    limiter = RateLimiter(db_path, rate=4, max_wait=5, sync_interval=1.0)
+    for _ in range(4):
+        assert limiter.acquire(PATH, TOKEN) == 0.0
+    started = time.monotonic()
+    wait = limiter.acquire(PATH, TOKEN)
+    assert 0.1 < wait <= 0.25
+    assert time.monotonic() - started >= wait - 0.01
+    assert limiter.stats()["waited"] == 1
+
+
+def test_workers_share_one_bucket(db_path):
+    first = RateLimiter(db_path, rate=2, max_wait=5, sync_interval=1.0)
+    second = RateLimiter(db_path, rate=2, max_wait=0)
+    first.acquire(PATH, TOKEN)  # reserves both of this second's slots
+    with pytest.raises(RateLimitExceeded):
+        second.acquire(PATH, TOKEN)
+    assert second.stats()["rejected"] == 1
+    second.acquire("/creative/aigc/script/list/", TOKEN)  # other family, other bucket
+    second.acquire(PATH, "other token")
+
+
+def test_throttling_halves_the_rate_and_successes_win_it_back(db_path):
+    limiter = RateLimiter(db_path, rate=8, min_rate=1, max_wait=5, decrease=0.5, increase=2, success_batch=3)
+    limiter.acquire(PATH, TOKEN)
+    assert limiter.observe(PATH, TOKEN, 429, None) is True
+    assert bucket(limiter)["rate"] == 4
+    assert limiter.observe(PATH, TOKEN, 200, "40100") is True
+    assert bucket(limiter)["rate"] == 2
+    for _ in range(3):
+        limiter.observe(PATH, TOKEN, 429, None)
+    assert bucket(limiter)["rate"] == 1  # never below min_rate
+
+    for _ in range(3):
+        assert limiter.observe(PATH, TOKEN, 200, "0") is False
+    assert bucket(limiter)["rate"] == 3
+    for _ in range(9):
+        limiter.observe(PATH, TOKEN, 200, "0")
+    assert bucket(limiter)["rate"] == 8  # never above the configured rate
+    assert bucket(limiter)["throttled"] == 5
+
+
+def test_throttling_drains_the_bucket_and_the_local_share(db_path):
+    limiter = RateLimiter(db_path, rate=10, max_wait=0, sync_interval=0.5)
+    limiter.acquire(PATH, TOKEN)
+    limiter.observe(PATH, TOKEN, 429, None)
+    # The slots this worker still held are dropped and the bucket is empty: the next call has to queue
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire(PATH, TOKEN)
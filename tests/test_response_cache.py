@@ -0,0 +1,129 @@
+# tests/test_response_cache.py
+import threading
+import time
+
+import pytest
+import requests
+
+from response_cache import ResponseCache
+
+PATH = "/creative/digital_avatar/get/"
+TOKEN = "token"
+
+
+def ok(n):
+    return f'{{"code":0,"message":"OK","data":{{"n":{n}}}}}'.encode(), 200
+
+
+class Upstream:
+    """fetch() stand-in: answers ok(1), ok(2), ... and counts its calls."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(5)
+        return ok(self.calls)
+
+
+def wait_for_refreshes():
+    for thread in threading.enumerate():
+        if thread.name == "cache-refresh":
+            thread.join(5)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return ResponseCache(str(tmp_path / "cache.sqlite3"))
+
+
+def test_miss_then_hit(cache):
+    upstream = Upstream()
+    assert cache.get_or_fetch(PATH, TOKEN, {"page": 1}, upstream, ttl=60) == (*ok(1), "MISS")
+    assert cache.get_or_fetch(PATH, TOKEN, {"page": 1}, upstream, ttl=60) == (*ok(1), "HIT")
+    assert upstream.calls == 1
+    # Other params, other tokens: other entries
+    cache.get_or_fetch(PATH, TOKEN, {"page": 2}, upstream, ttl=60)
+    cache.get_or_fetch(PATH, "other", {"page": 1}, upstream, ttl=60)
+    assert upstream.calls == 3
+
+
+def test_stale_entry_served_while_one_refresh_runs(cache):
+    upstream = Upstream()
+    cache.get_or_fetch(PATH, TOKEN, {}, upstream, ttl=0, stale_ttl=60)
+
+    upstream.release.clear()
+    first = cache.get_or_fetch(PATH, TOKEN, {}, upstream, ttl=0, stale_ttl=60)
+    second = cache.get_or_fetch(PATH, TOKEN, {}, upstream, ttl=0, stale_ttl=60)
+    assert first == second == (*ok(1), "STALE")
+    upstream.release.set()
+    wait_for_refreshes()
+
+    assert upstream.calls == 2  # only one of the stale reads claimed the refresh
+    assert cache.get_or_fetch(PATH, TOKEN, {}, upstream, ttl=0, stale_ttl=60)[0] == ok(2)[0]
+
+
+def test_expired_entry_served_when_fetch_fails(cache):
+    cache.get_or_fetch(PATH, TOKEN, {}, Upstream(), ttl=0, stale_ttl=0)
+    time.sleep(0.01)
+
+    def down():
+        raise requests.ConnectionError("TikTok is down")
+
+    assert cache.get_or_fetch(PATH, TOKEN, {}, down, ttl=60) == (*ok(1), "STALE-IF-ERROR")
+    assert cache.stats()["errors_served_stale"] == 1
+    with pytest.raises(requests.ConnectionError):
+        cache.get_or_fetch(PATH, TOKEN, {"page": 2}, down, ttl=60)
+
+
+def test_failed_refresh_keeps_stale_entry(cache):
+    cache.get_or_fetch(PATH, TOKEN, {}, Upstream(), ttl=0, stale_ttl=60)
+
+    def down():
+        raise requests.ConnectionError("TikTok is down")
+
+    assert cache.get_or_fetch(PATH, TOKEN, {}, down, ttl=0, stale_ttl=60) == (*ok(1), "STALE")
+    wait_for_refreshes()
+    assert cache.stats()["refresh_errors"] == 1
+    assert cache.get_or_fetch(PATH, TOKEN, {}, down, ttl=0, stale_ttl=60)[:2] == ok(1)
+
+
+def test_only_successful_responses_are_stored(cache):
+    calls = []
+
+    def error():
+        calls.append(1)
+        return b'{"code":40001,"message":"Invalid token"}', 200
+
+    cache.get_or_fetch(PATH, TOKEN, {}, error, ttl=60)
+    assert cache.get_or_fetch(PATH, TOKEN, {}, error, ttl=60)[2] == "MISS"
+    assert len(calls) == 2
+
+
+def test_invalidate_drops_every_page(cache):
+    upstream = Upstream()
+    for page in (1, 2):
+        cache.get_or_fetch(PATH, TOKEN, {"page": page}, upstream, ttl=60)
+    cache.invalidate(PATH, TOKEN)
+    assert cache.stats()["entries"] == 0
+    assert cache.get_or_fetch(PATH, TOKEN, {"page": 1}, upstream, ttl=60)[2] == "MISS"
+
+
+def test_evicts_least_recently_used_over_the_cap(tmp_path):
+    body, _ = ok(1)
+    cache = ResponseCache(str(tmp_path / "cache.sqlite3"), max_bytes=2 * len(body))
+    fetch = lambda: ok(1)  # noqa: E731
+    cache.get_or_fetch(PATH, TOKEN, {"page": 1}, fetch, ttl=60)
+    time.sleep(0.01)
+    cache.get_or_fetch(PATH, TOKEN, {"page": 2}, fetch, ttl=60)
+    time.sleep(0.01)
+    cache.get_or_fetch(PATH, TOKEN, {"page": 1}, fetch, ttl=60)  # page 1 is now the most recently used
+    cache.get_or_fetch(PATH, TOKEN, {"page": 3}, fetch, ttl=60)
+
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["evictions"] == 1
+    assert cache.get_or_fetch(PATH, TOKEN, {"page": 1}, fetch, ttl=60)[2] == "HIT"
+    assert cache.get_or_fetch(PATH, TOKEN, {"page": 2}, fetch, ttl=60)[2] == "MISS"
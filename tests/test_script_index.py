@@ -0,0 +1,61 @@
+# tests/test_script_index.py
+import pytest
+
+pytest.importorskip("numpy")
+
+from script_index import ScriptIndex, text_key  # noqa: E402
+
+TOKEN = "token"
+BASE = ("Meet the new trail runner from our spring line. It grips wet rock, drains in seconds "
+        "and weighs less than a cup of coffee. Tap the link to get twenty percent off today.")
+NEAR = BASE.replace("twenty percent", "20 percent")
+OTHER = ("Our winter parka keeps you warm down to minus thirty. Recycled down, a hood that "
+         "fits over a helmet and pockets for everything. Order now and it ships tomorrow.")
+
+
+@pytest.fixture
+def index(tmp_path):
+    return ScriptIndex(str(tmp_path / "index.sqlite3"), threshold=0.6)
+
+
+def test_signature_is_stable_and_ignores_case_and_punctuation(index):
+    assert (index.signature(BASE) == index.signature(BASE.upper().replace(".", " !"))).all()
+    assert (index.signature(BASE) == index.signature(OTHER)).mean() < 0.2
+
+
+def test_near_duplicates_ranks_by_similarity(index):
+    assert index.add(TOKEN, "library", [("s1", BASE), ("s2", OTHER), ("s3", NEAR)]) == 3
+    assert index.add(TOKEN, "library", [("s1", BASE), ("", "no key"), ("s4", "")]) == 0
+
+    hits = index.near_duplicates(TOKEN, "library", BASE)
+    assert [hit["key"] for hit in hits] == ["s1", "s3"]
+    assert hits[0]["similarity"] == 1.0 > hits[1]["similarity"] >= 0.6
+    assert [hit["key"] for hit in index.near_duplicates(TOKEN, "library", BASE, exclude_key="s1")] == ["s3"]
+    assert index.near_duplicates(TOKEN, "rendered", BASE) == []
+    assert index.near_duplicates("other", "library", BASE) == []
+
+
+def test_rows_added_by_another_worker_are_picked_up(index, tmp_path):
+    other_worker = ScriptIndex(str(tmp_path / "index.sqlite3"), threshold=0.6)
+    assert index.near_duplicates(TOKEN, "library", BASE) == []  # loads the (empty) corpus
+    other_worker.add(TOKEN, "library", [("s1", BASE)])
+    assert [hit["key"] for hit in index.near_duplicates(TOKEN, "library", NEAR)] == ["s1"]
+
+
+def test_corpus_grows_past_its_initial_capacity(index):
+    texts = [(f"s{i}", f"{OTHER} variant {i} with {i * 7} extra words number {i}") for i in range(150)]
+    index.add(TOKEN, "library", texts + [("base", BASE)])
+    assert index.count(TOKEN, "library") == 151
+    assert [hit["key"] for hit in index.near_duplicates(TOKEN, "library", NEAR)] == ["base"]
+
+
+def test_cluster_groups_similar_texts(index):
+    assert index.cluster([OTHER, BASE, "something else entirely, short", NEAR]) == [[1, 3], [0], [2]]
+
+
+def test_check_batch_reports_rendered_and_in_batch_duplicates(index):
+    index.add(TOKEN, "rendered", [(text_key(BASE), BASE)])
+    report = index.check_batch(TOKEN, [NEAR, OTHER, OTHER.lower()])
+    assert report[0]["rendered_match"]["key"] == text_key(BASE)
+    assert report[1] is None
+    assert report[2] == {"batch_duplicate_of": 1}
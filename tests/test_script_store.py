@@ -0,0 +1,114 @@
+# tests/test_script_store.py
+import pytest
+
+from script_store import LIST_PATH, ScriptStore
+
+TOKEN = "token"
+
+
+def script(n, text=None, day=None):
+    return {"script_id": f"s{n}", "title": f"Script {n}", "script": text or f"script number {n}",
+            "create_time": f"2026-01-{day or n:02d} 10:00:00"}
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class Library:
+    """TikTok's script list, newest first, served page by page; counts the pages it was asked for."""
+
+    def __init__(self, scripts):
+        self.scripts = scripts
+        self.pages = []
+
+    def get(self, path, access_token, params=None):
+        assert path == LIST_PATH
+        page, size = params["page"], params["page_size"]
+        self.pages.append(page)
+        newest_first = sorted(self.scripts, key=lambda s: s["create_time"], reverse=True)
+        total_page = max(1, -(-len(newest_first) // size))
+        return Response({"code": 0, "message": "OK", "data": {
+            "list": newest_first[(page - 1) * size:page * size],
+            "page_info": {"page": page, "page_size": size, "total_number": len(newest_first),
+                          "total_page": total_page},
+        }})
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ScriptStore(str(tmp_path / "scripts.sqlite3"), page_size=5)
+
+
+def ids(scripts):
+    return [s["script_id"] for s in scripts]
+
+
+def test_first_sync_walks_every_page_then_stops_at_known_scripts(store):
+    library = Library([script(n) for n in range(1, 13)])
+    assert store.sync(library, TOKEN) == {"ok": True, "pages": 3, "added": 12, "total_number": 12}
+
+    library.scripts += [script(13), script(14)]
+    library.pages.clear()
+    summary = store.sync(library, TOKEN)
+    assert summary["added"] == 2 and library.pages == [1]
+
+    library.pages.clear()
+    assert store.sync(library, TOKEN, full=True)["pages"] == 3
+    assert store.search(TOKEN, page_size=50)[1]["total_number"] == 14
+
+
+def test_failed_sync_does_not_mark_the_library_complete(store):
+    class Down:
+        def get(self, path, access_token, params=None):
+            return Response({"code": 40100, "message": "Too many requests"}, 429)
+
+    assert store.sync(Down(), TOKEN)["ok"] is False
+    assert store.last_sync(TOKEN) == 0.0
+
+
+def test_search_index_follows_updates(store):
+    store.add_scripts(TOKEN, [script(1, "summer sale on running shoes"), script(2, "winter jackets")])
+    assert ids(store.search(TOKEN, "shoes")[0]) == ["s1"]
+
+    # Rewriting a script must drop its old words from the index, not just add the new ones
+    assert store.add_scripts(TOKEN, [script(1, "autumn boots")]) == 0
+    assert store.search(TOKEN, "shoes")[0] == []
+    assert ids(store.search(TOKEN, "boots")[0]) == ["s1"]
+    assert store.get(TOKEN, "s1")["script"] == "autumn boots"
+
+
+def test_search_terms_dates_and_pages(store):
+    store.add_scripts(TOKEN, [script(n, f"jacket deal {n}", day=n) for n in range(1, 8)]
+                      + [script(9, "running shoes", day=9)])
+
+    assert ids(store.search(TOKEN, "run")[0]) == ["s9"]  # the last term is a prefix
+    assert store.search(TOKEN, "jacket shoes")[0] == []  # every term must match
+    assert ids(store.search(TOKEN, "jacket", start_date="2026-01-03", end_date="2026-01-04")[0]) == ["s4", "s3"]
+
+    items, page_info = store.search(TOKEN, "jacket", page=2, page_size=3)
+    assert ids(items) == ["s4", "s3", "s2"]
+    assert page_info == {"page": 2, "page_size": 3, "total_number": 7, "total_page": 3}
+
+
+def test_search_input_is_not_fts_syntax(store):
+    store.add_scripts(TOKEN, [script(1, 'say "hello" NEAR the OR door')])
+    assert ids(store.search(TOKEN, '"hello" NEAR OR')[0]) == ["s1"]
+    assert store.search(TOKEN, 'title:* "')[0] == []
+
+
+def test_scripts_are_kept_per_access_token(store):
+    added = []
+    store.on_added = lambda access_token, scripts: added.append((access_token, ids(scripts)))
+    store.add_scripts(TOKEN, [script(1)])
+    store.add_scripts("other", [script(1), script(2)])
+    store.add_scripts("other", [script(2)])
+
+    assert added == [(TOKEN, ["s1"]), ("other", ["s1", "s2"])]
+    assert store.search(TOKEN)[1]["total_number"] == 1
+    assert store.search("other")[1]["total_number"] == 2
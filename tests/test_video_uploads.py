@@ -0,0 +1,171 @@
+# tests/test_video_uploads.py
+import hashlib
+import json
+import os
+
+import pytest
+
+from url_guard import URLGuard
+from video_uploads import UPLOAD_PATH, MultipartFile, UploadError, VideoUploader, video_id_of
+
+VIDEO_URL = "https://v16.tiktokcdn.com/video/finished.mp4?sig=1"
+VIDEO = b"not really an mp4, " * 100
+TOKEN = "token"
+
+
+class Response:
+    def __init__(self, status_code=200, body=None, chunks=(), headers=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b""
+        self.chunks = chunks
+        self.headers = headers or {}
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TikTok:
+    """Upload endpoint stand-in: refuses UPLOAD_BY_URL when `refuse_url`, keeps every multipart body it gets."""
+
+    def __init__(self, refuse_url=False):
+        self.refuse_url = refuse_url
+        self.calls = []
+        self.files = []
+
+    def post(self, path, access_token, json=None, data=None, content_type=None):
+        assert path == UPLOAD_PATH
+        if json is not None:
+            self.calls.append(json["upload_type"])
+            if self.refuse_url:
+                return Response(body={"code": 40002, "message": "video_url is not reachable"})
+            return Response(body={"code": 0, "data": [{"video_id": "v-url"}]})
+        self.calls.append("UPLOAD_BY_FILE")
+        self.files.append(data.read())
+        return Response(body={"code": 0, "data": {"video_id": "v-file"}})
+
+
+class Source:
+    """requests.Session stand-in for the CDN the finished video is on."""
+
+    def __init__(self, body=VIDEO, status_code=200):
+        self.body = body
+        self.status_code = status_code
+        self.requests = []
+
+    def get(self, url, allow_redirects=True, stream=False, timeout=None):
+        self.requests.append(url)
+        chunks = [self.body[i:i + 64] for i in range(0, len(self.body), 64)]
+        return Response(self.status_code, chunks=chunks, headers={"Content-Length": str(len(self.body))})
+
+
+@pytest.fixture
+def make_uploader(tmp_path):
+    def make(client, source=None, **kwargs):
+        uploader = VideoUploader(str(tmp_path / "uploads.sqlite3"), client, str(tmp_path / "spool"),
+                                 chunk_size=64, guard=URLGuard(allow_private=True), **kwargs)
+        uploader._source = source or Source()
+        return uploader
+    return make
+
+
+class Stop(BaseException):
+    pass
+
+
+class OneJob:
+    """Queue stand-in that hands out one job, then stops the uploader loop."""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def get(self):
+        if self.job_id is None:
+            raise Stop()
+        job_id, self.job_id = self.job_id, None
+        return job_id
+
+
+def run(uploader, mode, video_url=VIDEO_URL):
+    """Run one job on this thread instead of the uploader threads; returns its status."""
+    uploader._pid = os.getpid()  # no uploader threads
+    job_id = uploader.submit(TOKEN, "adv", video_url, "launch", mode)
+    uploader._queue = OneJob(job_id)
+    with pytest.raises(Stop):
+        uploader._run()
+    return uploader.job_status(job_id)
+
+
+def test_url_mode_lets_tiktok_fetch_the_video(make_uploader):
+    tiktok, source = TikTok(), Source()
+    job = run(make_uploader(tiktok, source), "url")
+    assert job["state"] == "success" and job["video_id"] == "v-url"
+    assert tiktok.calls == ["UPLOAD_BY_URL"] and source.requests == []
+
+
+def test_auto_mode_falls_back_to_streaming_the_file(make_uploader, tmp_path):
+    tiktok, uploaded = TikTok(refuse_url=True), []
+    uploader = make_uploader(tiktok, on_uploaded=lambda *args: uploaded.append(args))
+    job = run(uploader, "auto")
+
+    assert job["state"] == "success" and job["video_id"] == "v-file"
+    assert "not reachable" in job["fallback_reason"]
+    assert tiktok.calls == ["UPLOAD_BY_URL", "UPLOAD_BY_FILE"]
+    body = tiktok.files[0]
+    assert VIDEO in body and hashlib.md5(VIDEO).hexdigest().encode() in body
+    assert uploaded == [(TOKEN, "adv", "v-file")]
+    assert os.listdir(tmp_path / "spool") == []  # the spool file is gone
+
+
+def test_failing_hook_leaves_the_upload_a_success(make_uploader):
+    def hook(*args):
+        raise RuntimeError("index is gone")
+
+    job = run(make_uploader(TikTok(), on_uploaded=hook), "url")
+    assert job["state"] == "success" and job["video_id"] == "v-url" and job["error"] is None
+
+
+def test_url_mode_reports_tiktok_refusing(make_uploader):
+    job = run(make_uploader(TikTok(refuse_url=True)), "url")
+    assert job["state"] == "failed" and "not reachable" in job["error"]
+
+
+def test_oversized_and_failed_downloads_fail_the_job(make_uploader, tmp_path):
+    job = run(make_uploader(TikTok(), max_bytes=100), "file")
+    assert job["state"] == "failed" and "larger than" in job["error"]
+    job = run(make_uploader(TikTok(), Source(status_code=404)), "file")
+    assert job["state"] == "failed" and "HTTP 404" in job["error"]
+    assert os.listdir(tmp_path / "spool") == []
+
+
+def test_sources_outside_the_media_hosts_are_never_downloaded(make_uploader):
+    source = Source()
+    job = run(make_uploader(TikTok(), source), "file", video_url="http://169.254.169.254/latest/meta-data/")
+    assert job["state"] == "failed" and "not an allowed media host" in job["error"]
+    assert source.requests == []
+
+
+def test_multipart_body_streams_the_file(tmp_path):
+    path = tmp_path / "video.mp4"
+    path.write_bytes(VIDEO)
+    multipart = MultipartFile({"advertiser_id": "adv"}, "video_file", "v.mp4", str(path))
+    seen = []
+    multipart.on_read = seen.append
+    body = b"".join(iter(lambda: multipart.read(100), b""))
+    assert len(body) == len(multipart) and VIDEO in body
+    assert b'name="advertiser_id"\r\n\r\nadv\r\n' in body
+    assert seen[-1] == len(multipart)
+
+
+def test_video_id_of_either_response_shape():
+    assert video_id_of([{"video_id": "a"}]) == "a"
+    assert video_id_of({"video_id": "b"}) == "b"
+    assert video_id_of(None) is None
@@ -0,0 +1,366 @@
+# tiktok_client.py
+"""
+Shared HTTP client for the TikTok Business API.
+
+Every gunicorn worker holds one TikTokClient. It keeps a keep-alive
+connection pool to business-api.tiktok.com so routes stop paying a fresh
+TCP + TLS handshake per call, applies per-endpoint connect/read timeouts
+and keeps a few counters about the pool. When given a SingleFlight,
+identical concurrent GETs (same path, params and token) share one
+upstream call. When given a RateLimiter, every call first waits for a
+slot in its token's bucket and reports throttling responses back to it.
+GETs (reads, safe to repeat) are retried on transport errors and 5xx
+answers with exponential backoff and full jitter; POSTs never are.
+With CircuitBreakers, calls to a failing endpoint family fail fast. GETs
+to `hedge_paths` are hedged: if the first attempt has not answered after
+the path's p95 latency a second one is sent and the first answer wins.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+from circuit_breaker import CircuitOpen
+from rate_limiter import RateLimitExceeded
+
+try:
+    import simplejson as fast_json  # C-accelerated, listed in requirements.txt
+except ImportError:
+    import json as fast_json
+
+TIKTOK_BASE = "https://business-api.tiktok.com/open_api/v1.3"
+
+# (connect, read) timeouts in seconds, matched by longest path prefix.
+# Paths not listed here use TIKTOK_CONNECT_TIMEOUT / TIKTOK_READ_TIMEOUT.
+ENDPOINT_TIMEOUTS = {
+    # Status polls are cheap upstream; fail them fast and let the next poll retry
+    "/creative/aigc/script/task/get/": (3.05, 10),
+    "/creative/digital_avatar/video/task/get/": (3.05, 10),
+    # Catalog / list endpoints
+    "/creative/digital_avatar/get/": (3.05, 15),
+    "/creative/aigc/script/list/": (3.05, 15),
+    "/creative/digital_avatar/video/list/": (3.05, 15),
+    "/file/video/ad/search/": (3.05, 20),
+    "/file/video/ad/info/": (3.05, 15),
+    # Uploads send the whole video; TikTok answers once it has stored it
+    "/file/video/ad/upload/": (5, 300),
+    # Task creation can be slow on TikTok's side
+    "/creative/aigc/script_generation/task/create/": (5, 30),
+    "/creative/digital_avatar/video/task/create/": (5, 30),
+}
+
+
+# Upstream answers worth retrying for idempotent calls
+RETRY_STATUSES = {500, 502, 503, 504}
+
+
+def tt_headers(access_token: str, content_type="application/json"):
+    headers = {"Access-Token": access_token}
+    if content_type:
+        headers["Content-Type"] = content_type
+    return headers
+
+
+def env_timeout():
+    return (
+        float(os.getenv("TIKTOK_CONNECT_TIMEOUT", "5")),
+        float(os.getenv("TIKTOK_READ_TIMEOUT", "30")),
+    )
+
+
+def default_pool_size():
+    """
+    Pool size for this worker: TIKTOK_POOL_SIZE if set, otherwise the
+    number of threads gunicorn gives the worker (exported by
+    gunicorn_config.post_fork), otherwise 10.
+    """
+    for name in ("TIKTOK_POOL_SIZE", "GUNICORN_THREADS"):
+        value = os.getenv(name)
+        if value and value.isdigit() and int(value) > 0:
+            return int(value)
+    return 10
+
+
+# TikTok puts "code" first in its envelope; read it without parsing the whole body
+_LEADING_CODE = re.compile(rb'\s*\{\s*"code"\s*:\s*"?(-?\d+)"?\s*[,}]')
+
+
+def body_code(body: bytes):
+    """TikTok's envelope `code` of a raw JSON body as a string, or None."""
+    match = _LEADING_CODE.match(body)
+    if match:
+        return match.group(1).decode()
+    try:
+        return str(fast_json.loads(body).get("code"))
+    except (ValueError, AttributeError):
+        return None
+
+
+def envelope_code(response):
+    """TikTok's `code` field of a response as a string, or None for non-JSON bodies."""
+    if "json" not in response.headers.get("Content-Type", ""):
+        return None
+    return body_code(response.content)
+
+
+def never_sent(error):
+    """
+    Whether a request that raised `error` certainly never reached TikTok:
+    refused by the rate limiter or an open circuit, or no connection could
+    be made. Anything else (read timeouts, dropped connections, ...) may
+    have been processed upstream.
+    """
+    if isinstance(error, (RateLimitExceeded, CircuitOpen, requests.ConnectTimeout)):
+        return True
+    if isinstance(error, requests.ConnectionError):
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+    return False
+
+
+def _detached(response):
+    """
+    Copy of a fully read response without the request (and its Access-Token)
+    attached, safe to hand to other threads or pickle for other workers.
+    """
+    copy = requests.Response()
+    copy._content = response.content
+    copy.status_code = response.status_code
+    copy.headers = response.headers
+    copy.url = response.url
+    copy.encoding = response.encoding
+    copy.reason = response.reason
+    copy.elapsed = response.elapsed
+    return copy
+
+
+class TikTokClient:
+    def __init__(self, base_url=TIKTOK_BASE, pool_size=None, timeouts=None, default_timeout=None, singleflight=None,
+                 rate_limiter=None, retries=None, backoff_base=0.25, backoff_max=4.0, breakers=None,
+                 hedge_paths=(), hedge_min_delay=0.05, hedge_default_delay=1.0, hedge_budget=0.1,
+                 on_response=None):
+        self.base_url = base_url.rstrip("/")
+        self.singleflight = singleflight
+        self.rate_limiter = rate_limiter
+        self.breakers = breakers
+        self.hedge_paths = set(hedge_paths)
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        # Hedges may add at most this share of extra upstream calls
+        self.hedge_budget = hedge_budget
+        # on_response(method, path, seconds, status_code, code, error) after every call, e.g. for metrics
+        self.on_response = on_response
+        self.retries = int(os.getenv("TIKTOK_RETRIES", "2")) if retries is None else retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size or default_pool_size()
+        self.timeouts = dict(ENDPOINT_TIMEOUTS)
+        if timeouts:
+            self.timeouts.update(timeouts)
+        self.default_timeout = default_timeout or env_timeout()
+
+        self._lock = threading.Lock()
+        self._counters = {"requests": 0, "errors": 0, "retries": 0, "hedged": 0, "hedge_wins": 0,
+                          "in_flight": 0, "total_time": 0.0}
+        self._latencies = {}  # path -> recent successful call durations
+        self._new_session()
+
+        # A session must never be shared between a parent and a forked child
+        if hasattr(os, "register_at_fork"):
+            os.register_at_fork(after_in_child=self._new_session)
+
+    def _new_session(self):
+        session = requests.Session()
+        # pool_block=True caps sockets at pool_size; extra threads wait for a free connection
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=True)
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        self.session = session
+        self._hedge_pool = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="tiktok-hedge")
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}{path}"
+
+    def timeout_for(self, path: str):
+        best = None
+        for prefix in self.timeouts:
+            if path.startswith(prefix) and (best is None or len(prefix) > len(best)):
+                best = prefix
+        return self.timeouts[best] if best else self.default_timeout
+
+    def request(self, method: str, path: str, access_token: str, timeout=None, content_type=None, **kwargs):
+        """
+        Send a request to TIKTOK_BASE + path. Raises requests.RequestException
+        on transport errors, exactly like requests.get/post, and
+        RateLimitExceeded / CircuitOpen (both RequestExceptions) when the
+        call is not sent at all.
+        """
+        headers = tt_headers(access_token, content_type)
+        headers.update(kwargs.pop("headers", None) or {})
+        breaker = self.breakers.for_path(path) if self.breakers is not None else None
+        if breaker is not None:
+            breaker.before()
+        if self.rate_limiter is not None:
+            try:
+                self.rate_limiter.acquire(path, access_token)
+            except RateLimitExceeded:
+                if breaker is not None:
+                    breaker.cancel()
+                raise
+
+        with self._lock:
+            self._counters["requests"] += 1
+            self._counters["in_flight"] += 1
+        started = time.monotonic()
+        failed = True
+        status_code = code = error = None
+        try:
+            r = self.session.request(
+                method,
+                self.url(path),
+                headers=headers,
+                timeout=timeout or self.timeout_for(path),
+                **kwargs,
+            )
+            failed = r.status_code >= 500
+            status_code = r.status_code
+            code = None if kwargs.get("stream") else envelope_code(r)
+            if self.rate_limiter is not None:
+                self.rate_limiter.observe(path, access_token, r.status_code, code)
+            return r
+        except requests.RequestException as e:
+            error = type(e).__name__
+            with self._lock:
+                self._counters["errors"] += 1
+            raise
+        finally:
+            duration = time.monotonic() - started
+            if self.on_response is not None:
+                self.on_response(method, path, duration, status_code, code, error)
+            if breaker is not None:
+                breaker.record(failed, duration)
+            with self._lock:
+                self._counters["in_flight"] -= 1
+                self._counters["total_time"] += duration
+                if not failed:
+                    self._latencies.setdefault(path, deque(maxlen=200)).append(duration)
+
+    def hedge_delay(self, path: str):
+        """p95 of recent successful calls to path, or hedge_default_delay until there are enough."""
+        with self._lock:
+            samples = sorted(self._latencies.get(path) or ())
+        if len(samples) < 20:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, samples[int(len(samples) * 0.95) - 1])
+
+    def request_hedged(self, method: str, path: str, access_token: str, **kwargs):
+        """
+        Send the request; if it has not answered after hedge_delay(path), send
+        it again and return whichever answer arrives first. Only for calls
+        that are safe to repeat.
+        """
+        # Run both attempts in the caller's context so per-request state (e.g. tracing) follows them
+        first = self._hedge_pool.submit(contextvars.copy_context().run, self.request, method, path, access_token, **kwargs)
+        try:
+            return first.result(timeout=self.hedge_delay(path))
+        except FutureTimeout:
+            pass
+
+        with self._lock:
+            if self._counters["hedged"] >= self._counters["requests"] * self.hedge_budget:
+                over_budget = True
+            else:
+                over_budget = False
+                self._counters["hedged"] += 1
+        if over_budget:
+            return first.result()
+
+        second = self._hedge_pool.submit(contextvars.copy_context().run, self.request, method, path, access_token,
+                                         **kwargs)
+        error = None
+        for future in as_completed((first, second)):
+            if future.exception() is not None:
+                error = future.exception()
+                continue
+            loser = second if future is first else first
+            # Close the slower response once it arrives so its connection returns to the pool
+            loser.add_done_callback(lambda f: f.exception() is None and f.result().close())
+            if future is second:
+                with self._lock:
+                    self._counters["hedge_wins"] += 1
+            return future.result()
+        raise error
+
+    def request_with_retries(self, method: str, path: str, access_token: str, **kwargs):
+        """
+        request() for idempotent calls: transport errors and 5xx answers are
+        retried up to self.retries times, sleeping a random 0..base*2^n
+        seconds (capped at backoff_max) before retry n. Rate-limit rejections
+        are not retried; the caller's deadline has already passed.
+        """
+        send = self.request
+        if path in self.hedge_paths and not kwargs.get("stream"):
+            send = self.request_hedged
+        attempt = 0
+        while True:
+            try:
+                r = send(method, path, access_token, **kwargs)
+                if r.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return r
+                r.close()
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            attempt += 1
+            with self._lock:
+                self._counters["retries"] += 1
+            time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+
+    def get(self, path: str, access_token: str, params=None, **kwargs):
+        if self.singleflight is None or kwargs.get("stream"):
+            return self.request_with_retries("GET", path, access_token, params=params, **kwargs)
+
+        token_hash = hashlib.sha256(access_token.encode()).hexdigest()[:16]
+        key = f"GET|{path}|{token_hash}|{json.dumps(params or {}, sort_keys=True, default=str)}"
+        return self.singleflight.do(
+            key, lambda: _detached(self.request_with_retries("GET", path, access_token, params=params, **kwargs))
+        )
+
+    def post(self, path: str, access_token: str, json=None, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        return self.request("POST", path, access_token, json=json, **kwargs)
+
+    def pool_stats(self):
+        """Snapshot of the client counters and of every urllib3 host pool."""
+        with self._lock:
+            counters = dict(self._counters)
+        total_time = counters.pop("total_time")
+        counters["avg_latency_ms"] = round(total_time * 1000 / counters["requests"], 2) if counters["requests"] else 0.0
+
+        pools = []
+        manager = self.adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            queue = list(pool.pool.queue) if pool.pool is not None else []
+            pools.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+                "idle": sum(1 for conn in queue if conn is not None),
+                "connections_opened": pool.num_connections,
+                "requests_sent": pool.num_requests,
+            })
+
+        counters["hedge_delay_ms"] = {path: round(self.hedge_delay(path) * 1000, 1) for path in sorted(self.hedge_paths)}
+        return {"pool_size": self.pool_size, "pid": os.getpid(), **counters, "pools": pools}
@@ -0,0 +1,251 @@
+# tracing.py
+"""
+Lightweight per-request span tracing.
+
+Every request gets a Trace in a context variable. Code that wants its
+time accounted for wraps it in `span(name, **attrs)`; finished TikTok
+calls are added with `record()` from the client's on_response hook. The
+request itself is split into three phases without any help from the
+routes:
+
+    before   request start until the view runs (session, admission queue)
+    handler  the view function, with the spans opened inside it
+    after    after_request hooks (compression, ETags, headers)
+
+The spans go back to the browser in a Server-Timing header, so the
+network panel shows where a slow request spent its time. Requests
+slower than `slow_ms` are kept, with all their spans, in a ring buffer
+of the last `keep` of them per worker (`slow_requests()`).
+
+`arm_profile(n, path_prefix)` runs the next n matching requests under
+cProfile and folds them into one capture, read with `profile_report()`.
+Only one request is profiled at a time, so concurrent requests are
+skipped rather than mixing their stacks.
+"""
+import contextvars
+import cProfile
+import io
+import marshal
+import pstats
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from flask import g, request
+
+_current = contextvars.ContextVar("trace", default=None)
+_UNSAFE = re.compile(r'["\\,;\s]+')
+
+
+class Trace:
+    __slots__ = ("method", "path", "endpoint", "request_id", "started_at", "started", "spans", "marks")
+
+    def __init__(self, method, path):
+        self.method = method
+        self.path = path
+        self.endpoint = None
+        self.request_id = None
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []  # (name, start offset s, duration s, attrs)
+        self.marks = {}
+
+    def add(self, name, start, duration, attrs, max_spans=200):
+        if len(self.spans) < max_spans:
+            self.spans.append((name, start - self.started, duration, attrs))
+
+    def as_dict(self, total):
+        return {
+            "method": self.method,
+            "path": self.path,
+            "endpoint": self.endpoint,
+            "request_id": self.request_id,
+            "started_at": round(self.started_at, 3),
+            "total_ms": round(total * 1000, 2),
+            "spans": [{"name": name, "start_ms": round(start * 1000, 2), "duration_ms": round(duration * 1000, 2),
+                       **attrs} for name, start, duration, attrs in self.spans],
+        }
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time the block as a span of the current request (no-op outside a traced request)."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, started, time.perf_counter() - started, attrs)
+
+
+def record(name, duration, **attrs):
+    """Add a span that has just ended after `duration` seconds."""
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, time.perf_counter() - duration, duration, attrs)
+
+
+def server_timing(trace, total, max_entries=30):
+    """Server-Timing header value for a trace: its spans (the ones past max_entries summed up) and the total."""
+    entries = []
+    for i, (name, _, duration, attrs) in enumerate(trace.spans):
+        if i >= max_entries:
+            entries.append(f"more;dur={sum(d for _, _, d, _ in trace.spans[i:]) * 1000:.1f};"
+                           f'desc="{len(trace.spans) - i} more spans"')
+            break
+        desc = " ".join(f"{key}={value}" for key, value in attrs.items() if value is not None)
+        entry = f"{_UNSAFE.sub('_', name)};dur={duration * 1000:.1f}"
+        if desc:
+            entry += f';desc="{_UNSAFE.sub(" ", desc).strip()[:100]}"'
+        entries.append(entry)
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+class Tracer:
+    def __init__(self, slow_ms=500, keep=100, header=True):
+        self.slow_seconds = slow_ms / 1000
+        self.header = header
+        self._slow = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._counters = {"traced": 0, "slow": 0}
+        # On-demand cProfile capture
+        self._profile_lock = threading.Lock()  # held by the request being profiled
+        self._profile_left = 0
+        self._profile_prefix = ""
+        self._profile_stats = None
+        self._profiled = 0
+
+    # ---- slow requests ----
+
+    def slow_requests(self, limit=None):
+        """Slow requests of this worker, newest first."""
+        with self._lock:
+            traces = list(self._slow)
+        traces.reverse()
+        return traces[:limit] if limit else traces
+
+    def stats(self):
+        with self._lock:
+            return {"slow_ms": self.slow_seconds * 1000, "kept": len(self._slow), **self._counters,
+                    "profile_pending": self._profile_left, "profiled": self._profiled}
+
+    # ---- profiling ----
+
+    def arm_profile(self, requests=10, path_prefix=""):
+        """Profile the next `requests` requests whose path starts with `path_prefix`; clears the last capture."""
+        with self._lock:
+            self._profile_left = requests
+            self._profile_prefix = path_prefix
+            self._profile_stats = None
+            self._profiled = 0
+
+    def _start_profile(self, path):
+        with self._lock:
+            if self._profile_left <= 0 or not path.startswith(self._profile_prefix):
+                return None
+            if not self._profile_lock.acquire(blocking=False):
+                return None  # another request is being profiled
+            self._profile_left -= 1
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def _stop_profile(self, profile):
+        profile.disable()
+        try:
+            with self._lock:
+                if self._profile_stats is None:
+                    self._profile_stats = pstats.Stats(profile)
+                else:
+                    self._profile_stats.add(profile)
+                self._profiled += 1
+        finally:
+            self._profile_lock.release()
+
+    def profile_report(self, sort="cumulative", limit=40):
+        """Text report of the capture, or None if nothing was captured yet."""
+        with self._lock:
+            if self._profile_stats is None:
+                return None
+            out = io.StringIO()
+            self._profile_stats.stream = out
+            self._profile_stats.sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def profile_dump(self):
+        """The capture in the binary pstats format (for snakeviz, pstats.Stats(path), ...), or None."""
+        with self._lock:
+            if self._profile_stats is None:
+                return None
+            return marshal.dumps(self._profile_stats.stats)
+
+    # ---- Flask hooks ----
+
+    def init_app(self, app):
+        """Trace every request. Call before other init_app()s so the trace starts first and ends last."""
+        @app.before_request
+        def _start_trace():
+            trace = Trace(request.method, request.path)
+            trace.endpoint = request.endpoint
+            g.trace_token = _current.set(trace)
+            g.trace_profile = self._start_profile(request.path)
+
+        dispatch = app.dispatch_request
+
+        def traced_dispatch():
+            trace = _current.get()
+            if trace is None:
+                return dispatch()
+            now = time.perf_counter()
+            trace.add("before", trace.started, now - trace.started, {})
+            try:
+                with span("handler", endpoint=request.endpoint):
+                    return dispatch()
+            finally:
+                trace.marks["handler_done"] = time.perf_counter()
+
+        app.dispatch_request = traced_dispatch
+
+        @app.after_request
+        def _server_timing(response):
+            # Registered first, so it runs after every other after_request hook
+            trace = _current.get()
+            if trace is None:
+                return response
+            now = time.perf_counter()
+            handler_done = trace.marks.get("handler_done")
+            if handler_done is not None:
+                trace.add("after", handler_done, now - handler_done, {})
+            trace.request_id = g.get("request_id")
+            trace.marks["streamed"] = response.is_streamed and not response.direct_passthrough
+            if self.header:
+                response.headers["Server-Timing"] = server_timing(trace, now - trace.started)
+            return response
+
+        @app.teardown_request
+        def _finish_trace(exc):
+            profile = g.pop("trace_profile", None)
+            if profile is not None:
+                self._stop_profile(profile)
+            token = g.pop("trace_token", None)
+            trace = _current.get()
+            if token is not None:
+                try:
+                    _current.reset(token)
+                except ValueError:  # a streamed response is torn down from another context
+                    _current.set(None)
+            if trace is None:
+                return
+            total = time.perf_counter() - trace.started
+            with self._lock:
+                self._counters["traced"] += 1
+                # Event streams are slow by design
+                if total >= self.slow_seconds and not trace.marks.get("streamed"):
+                    self._counters["slow"] += 1
+                    self._slow.append(trace.as_dict(total))
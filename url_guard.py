@@ -0,0 +1,87 @@
+# url_guard.py
+"""
+Outbound fetches of URLs that came from a client.
+
+The media cache and the Ads uploader download URLs the browser hands
+them. Unchecked, that lets any logged-in user make the server fetch
+internal addresses (the cloud metadata service, localhost, the office
+network) and read the answer back. A URLGuard only lets a URL through
+when
+
+- it is http(s) and its host is one of `allowed_hosts` or a subdomain of
+  one (the TikTok CDNs by default), and
+- every address the host resolves to is a public one: private, loopback,
+  link-local, shared, reserved and multicast ranges are refused
+
+`get()` follows redirects itself and checks every hop the same way, so an
+allowed host cannot bounce the request inward.
+"""
+import ipaddress
+import socket
+from urllib.parse import urljoin, urlsplit
+
+# Hosts TikTok serves video previews, covers and avatar images from
+DEFAULT_MEDIA_HOSTS = (
+    "tiktokcdn.com",
+    "tiktokcdn-us.com",
+    "tiktokcdn-eu.com",
+    "ibyteimg.com",
+    "ibytedtos.com",
+    "byteimg.com",
+)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class UnsafeURL(ValueError):
+    """The URL is not allowed to be fetched from the server."""
+
+
+def public_address(address):
+    """Whether an IP address (string) is routable on the public internet."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+class URLGuard:
+    def __init__(self, allowed_hosts=DEFAULT_MEDIA_HOSTS, allow_private=False, max_redirects=5):
+        self.allowed_hosts = tuple(host.lower().strip(".") for host in allowed_hosts)
+        # Only for local stand-ins (bench/mock_tiktok.py); never in production
+        self.allow_private = allow_private
+        self.max_redirects = max_redirects
+
+    def allowed(self, url):
+        """Whether the URL's scheme and host are allowed (no DNS lookup)."""
+        parts = urlsplit(url)
+        host = (parts.hostname or "").lower().rstrip(".")
+        if parts.scheme not in ("http", "https") or not host:
+            return False
+        return any(host == h or host.endswith("." + h) for h in self.allowed_hosts)
+
+    def check(self, url):
+        """Raise UnsafeURL unless the URL is allowed and its host resolves to public addresses only."""
+        if not self.allowed(url):
+            raise UnsafeURL(f"{urlsplit(url).hostname or url!r} is not an allowed media host")
+        if self.allow_private:
+            return
+        parts = urlsplit(url)
+        try:
+            infos = socket.getaddrinfo(parts.hostname, parts.port or (443 if parts.scheme == "https" else 80),
+                                       type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise UnsafeURL(f"Cannot resolve {parts.hostname}: {e}")
+        for info in infos:
+            if not public_address(info[4][0]):
+                raise UnsafeURL(f"{parts.hostname} resolves to a non-public address")
+
+    def get(self, session, url, **kwargs):
+        """session.get() that checks the URL and each redirect it follows; raises UnsafeURL."""
+        for _ in range(self.max_redirects + 1):
+            self.check(url)
+            r = session.get(url, allow_redirects=False, **kwargs)
+            if r.status_code not in REDIRECT_CODES or not r.headers.get("Location"):
+                return r
+            url = urljoin(url, r.headers["Location"])
+            r.close()
+        raise UnsafeURL("Too many redirects")
@@ -0,0 +1,138 @@
+# video_info.py
+"""
+Batched, cached lookups against /file/video/ad/info/.
+
+Clients may ask for any number of video IDs. VideoInfoLookup answers what
+it can from a per-video SQLite cache (shared by the workers on the host),
+splits the rest into chunks the upstream accepts, fetches the chunks
+concurrently with a bounded fan-out and returns the merged list in the
+order the IDs were requested. Video metadata hardly ever changes, but the
+signed preview/cover URLs inside it expire, so entries still get a TTL.
+"""
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+INFO_PATH = "/file/video/ad/info/"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS video_info (
+    owner TEXT NOT NULL,
+    advertiser_id TEXT NOT NULL,
+    video_id TEXT NOT NULL,
+    raw TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (owner, advertiser_id, video_id)
+);
+"""
+
+
+def owner_of(access_token):
+    return hashlib.sha256(access_token.encode()).hexdigest()[:16]
+
+
+class VideoInfoLookup:
+    def __init__(self, path, chunk_size=60, concurrency=4, ttl=3600):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.ttl = ttl
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._counters = {"ids_requested": 0, "cache_hits": 0, "upstream_calls": 0}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _cached(self, owner, advertiser_id, video_ids):
+        found = {}
+        db = self._connect()
+        cutoff = time.time() - self.ttl
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(video_ids), 500):
+            chunk = video_ids[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows = db.execute(
+                f"SELECT video_id, raw FROM video_info WHERE owner = ? AND advertiser_id = ? "
+                f"AND fetched_at > ? AND video_id IN ({marks})",
+                [owner, advertiser_id, cutoff] + chunk,
+            ).fetchall()
+            found.update((video_id, json.loads(raw)) for video_id, raw in rows)
+        return found
+
+    def _remember(self, owner, advertiser_id, items):
+        now = time.time()
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            db.executemany(
+                "INSERT OR REPLACE INTO video_info (owner, advertiser_id, video_id, raw, fetched_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                [(owner, advertiser_id, str(item["video_id"]), json.dumps(item), now)
+                 for item in items if item.get("video_id")],
+            )
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def lookup(self, client, access_token, advertiser_id, video_ids):
+        """
+        Return (items, error, stats). `items` follows the order of `video_ids`
+        (duplicates collapsed, unknown IDs left out). `error` is the first
+        failing upstream (body, status_code), if any.
+        Raises requests.RequestException on transport errors.
+        """
+        owner = owner_of(access_token)
+        wanted = list(dict.fromkeys(str(video_id) for video_id in video_ids))
+        found = self._cached(owner, advertiser_id, wanted)
+        missing = [video_id for video_id in wanted if video_id not in found]
+
+        def fetch(chunk):
+            r = client.get(INFO_PATH, access_token, params={
+                "advertiser_id": advertiser_id,
+                "video_ids": json.dumps(chunk),
+            })
+            return r.json(), r.status_code
+
+        error = None
+        chunks = [missing[i:i + self.chunk_size] for i in range(0, len(missing), self.chunk_size)]
+        if chunks:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(chunks)),
+                                    thread_name_prefix="video-info") as pool:
+                # Each chunk runs in a copy of this request's context so its spans reach the trace
+                futures = [pool.submit(contextvars.copy_context().run, fetch, chunk) for chunk in chunks]
+                for body, status_code in (future.result() for future in futures):
+                    if status_code != 200 or str(body.get("code")) != "0":
+                        error = error or (body, status_code)
+                        continue
+                    items = (body.get("data") or {}).get("list") or []
+                    self._remember(owner, advertiser_id, items)
+                    found.update((str(item.get("video_id")), item) for item in items)
+
+        stats = {"requested": len(wanted), "cache_hits": len(wanted) - len(missing), "upstream_calls": len(chunks)}
+        with self._lock:
+            self._counters["ids_requested"] += stats["requested"]
+            self._counters["cache_hits"] += stats["cache_hits"]
+            self._counters["upstream_calls"] += stats["upstream_calls"]
+        return [found[video_id] for video_id in wanted if video_id in found], error, stats
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
@@ -0,0 +1,379 @@
+# video_uploads.py
+"""
+Background transfers of finished videos into an advertiser's Ads library.
+
+POST /api/upload_video_to_ads queues a job and answers at once; the job
+runs on one of `concurrency` uploader threads of the worker that took it
+and records its progress in SQLite, so any worker can report it.
+
+Modes:
+
+    url    ask TikTok to fetch the source itself (UPLOAD_BY_URL); no video
+           bytes pass through the app
+    file   download the source and send it as UPLOAD_BY_FILE
+    auto   url first; if TikTok refuses it, fall back to file
+
+In file mode the source is streamed in `chunk_size` pieces to a spool file
+under `spool_dir` while its MD5 (TikTok's `video_signature`) is computed
+on the fly, then sent from disk as a multipart body with a known length.
+Each upload holds about one chunk in memory no matter how large the video
+is, so several can run side by side without growing the worker. Spool
+files are removed as soon as the upload is over. The server only
+downloads sources a URLGuard lets through: an allowed media host that
+resolves to public addresses, checked again on every redirect.
+
+Jobs are not resumed after a restart: a running job whose worker process
+is gone is reported as failed.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+import requests
+
+from tiktok_client import fast_json
+from url_guard import UnsafeURL, URLGuard
+
+log = logging.getLogger(__name__)
+
+UPLOAD_PATH = "/file/video/ad/upload/"
+MODES = ("auto", "url", "file")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    job_id TEXT PRIMARY KEY,
+    advertiser_id TEXT NOT NULL,
+    video_url TEXT NOT NULL,
+    video_name TEXT NOT NULL DEFAULT '',
+    mode TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    phase TEXT NOT NULL DEFAULT '',
+    bytes_done INTEGER NOT NULL DEFAULT 0,
+    bytes_total INTEGER,
+    worker TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    video_id TEXT,
+    result TEXT,
+    fallback_reason TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created_at);
+"""
+
+
+class UploadError(Exception):
+    """The transfer failed; the message is shown to the user."""
+
+
+class MultipartFile:
+    """
+    File-like multipart/form-data body: the form fields, then one file read
+    from disk. requests sends it with a Content-Length and reads it in
+    blocks, so the file is never loaded whole. `on_read(n)` is called with
+    the number of body bytes handed out so far.
+    """
+
+    def __init__(self, fields, file_field, filename, path, content_type="video/mp4"):
+        boundary = uuid.uuid4().hex
+        self.content_type = f"multipart/form-data; boundary={boundary}"
+        head = io.BytesIO()
+        for name, value in fields.items():
+            head.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+        head.write(f'--{boundary}\r\nContent-Disposition: form-data; name="{file_field}"; '
+                   f'filename="{filename}"\r\nContent-Type: {content_type}\r\n\r\n'.encode())
+        tail = f"\r\n--{boundary}--\r\n".encode()
+        self._parts = [io.BytesIO(head.getvalue()), open(path, "rb"), io.BytesIO(tail)]
+        self._length = len(head.getvalue()) + os.path.getsize(path) + len(tail)
+        self.on_read = None
+        self.sent = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and (size < 0 or size > 0):
+            chunk = self._parts[0].read(size)
+            if not chunk:
+                self._parts.pop(0).close()
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        data = b"".join(chunks)
+        self.sent += len(data)
+        if self.on_read is not None and data:
+            self.on_read(self.sent)
+        return data
+
+    def close(self):
+        while self._parts:
+            self._parts.pop().close()
+
+
+def video_id_of(data):
+    """The video_id of an upload response's data (a list of videos or one video)."""
+    items = data if isinstance(data, list) else [data or {}]
+    return next((item.get("video_id") for item in items if isinstance(item, dict) and item.get("video_id")), None)
+
+
+class VideoUploader:
+    def __init__(self, path, client, spool_dir, concurrency=3, chunk_size=1024 * 1024,
+                 max_bytes=500 * 1024 * 1024, source_timeout=(5, 60), progress_interval=0.5, guard=None,
+                 on_uploaded=None):
+        self.path = path
+        self.client = client
+        # on_uploaded(access_token, advertiser_id, video_id) after every successful upload
+        self.on_uploaded = on_uploaded
+        self.spool_dir = spool_dir
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.source_timeout = source_timeout
+        self.progress_interval = progress_interval
+        # Which source URLs the server itself may download
+        self.guard = guard or URLGuard()
+
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._tokens = {}  # job_id -> access token, only while the job is queued or running
+        self._pid = None
+        self._source = None
+        self._counters = {"submitted": 0, "succeeded": 0, "failed": 0, "bytes_downloaded": 0, "bytes_uploaded": 0,
+                          "url_fallbacks": 0}
+        os.makedirs(spool_dir, exist_ok=True)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _start(self):
+        # Uploader threads of this worker process; re-spawned after a fork
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._source = requests.Session()
+            for i in range(self.concurrency):
+                threading.Thread(target=self._run, name=f"video-upload-{i}", daemon=True).start()
+
+    @staticmethod
+    def _worker_id():
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    # ---- jobs ----
+
+    def submit(self, access_token, advertiser_id, video_url, video_name="", mode="auto"):
+        """Queue a transfer of `video_url` into the advertiser's library; returns the job ID."""
+        self._start()
+        job_id = uuid.uuid4().hex
+        self._connect().execute(
+            "INSERT INTO uploads (job_id, advertiser_id, video_url, video_name, mode, worker, created_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, advertiser_id, video_url, video_name, mode, self._worker_id(), time.time()),
+        )
+        with self._lock:
+            self._tokens[job_id] = access_token
+            self._counters["submitted"] += 1
+        self._queue.put(job_id)
+        return job_id
+
+    def _update(self, job_id, **fields):
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._connect().execute(f"UPDATE uploads SET {columns} WHERE job_id = ?", (*fields.values(), job_id))
+
+    def _progress(self, job_id, phase, total):
+        """Callback recording bytes done in `phase`, written at most once per progress_interval."""
+        last = [0.0]
+
+        def report(done):
+            now = time.monotonic()
+            if now - last[0] >= self.progress_interval or (total and done >= total):
+                last[0] = now
+                self._update(job_id, phase=phase, bytes_done=done, bytes_total=total)
+        return report
+
+    def _run(self):
+        while True:
+            job_id = self._queue.get()
+            with self._lock:
+                access_token = self._tokens.get(job_id)
+            try:
+                row = self._connect().execute(
+                    "SELECT advertiser_id, video_url, video_name, mode FROM uploads WHERE job_id = ?", (job_id,)
+                ).fetchone()
+                if row is None or access_token is None:
+                    continue
+                self._update(job_id, state="running", started_at=time.time())
+                self._transfer(job_id, access_token, *row)
+            except Exception as e:
+                if not isinstance(e, (UploadError, requests.RequestException)):
+                    log.exception("Video upload crashed", extra={"job_id": job_id})
+                with self._lock:
+                    self._counters["failed"] += 1
+                self._update(job_id, state="failed", phase="", error=str(e) or type(e).__name__,
+                             finished_at=time.time())
+            finally:
+                with self._lock:
+                    self._tokens.pop(job_id, None)
+
+    def _transfer(self, job_id, access_token, advertiser_id, video_url, video_name, mode):
+        body = None
+        if mode in ("auto", "url"):
+            self._update(job_id, phase="fetching_by_url")
+            body = self._post(access_token, json={
+                "advertiser_id": advertiser_id,
+                "upload_type": "UPLOAD_BY_URL",
+                "video_url": video_url,
+                "file_name": video_name,
+            })
+            if str(body.get("code")) != "0":
+                reason = f"TikTok API Error {body.get('code')}: {body.get('message')}"
+                if mode == "url":
+                    raise UploadError(reason)
+                with self._lock:
+                    self._counters["url_fallbacks"] += 1
+                self._update(job_id, fallback_reason=reason)
+                body = None
+
+        if body is None:
+            spool, signature, size = self._download(job_id, video_url)
+            try:
+                body = self._upload_file(job_id, access_token, advertiser_id, video_name, spool, signature, size)
+            finally:
+                os.unlink(spool)
+            if str(body.get("code")) != "0":
+                raise UploadError(f"TikTok API Error {body.get('code')}: {body.get('message')}")
+
+        data = body.get("data")
+        with self._lock:
+            self._counters["succeeded"] += 1
+        self._update(job_id, state="success", phase="", video_id=video_id_of(data), result=json.dumps(data),
+                     finished_at=time.time())
+        if self.on_uploaded is not None:
+            try:
+                self.on_uploaded(access_token, advertiser_id, video_id_of(data))
+            except Exception:
+                # The video is in the library either way; the job stays a success
+                log.exception("Upload hook failed", extra={"job_id": job_id})
+        log.info("Video uploaded to Ads", extra={"job_id": job_id, "advertiser_id": advertiser_id})
+
+    def _post(self, access_token, **kwargs):
+        r = self.client.post(UPLOAD_PATH, access_token, **kwargs)
+        try:
+            return fast_json.loads(r.content)
+        except ValueError:
+            raise UploadError(f"TikTok returned a non-JSON response (HTTP {r.status_code})")
+
+    def _download(self, job_id, video_url):
+        """Stream the source into a spool file; returns (path, md5 hex, size)."""
+        try:
+            r = self.guard.get(self._source, video_url, stream=True, timeout=self.source_timeout)
+        except UnsafeURL as e:
+            raise UploadError(f"Cannot download the video: {e}")
+        with r:
+            if r.status_code != 200:
+                raise UploadError(f"Could not download the video: HTTP {r.status_code}")
+            total = int(r.headers.get("Content-Length") or 0) or None
+            if total and total > self.max_bytes:
+                raise UploadError(f"Video is larger than {self.max_bytes // (1024 * 1024)} MB")
+            report = self._progress(job_id, "downloading", total)
+            report(0)
+            md5 = hashlib.md5()
+            size = 0
+            fd, spool = tempfile.mkstemp(dir=self.spool_dir, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in r.iter_content(self.chunk_size):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise UploadError(f"Video is larger than {self.max_bytes // (1024 * 1024)} MB")
+                        md5.update(chunk)
+                        f.write(chunk)
+                        report(size)
+            except BaseException:
+                os.unlink(spool)
+                raise
+        with self._lock:
+            self._counters["bytes_downloaded"] += size
+        if not size:
+            os.unlink(spool)
+            raise UploadError("The video URL returned an empty file")
+        return spool, md5.hexdigest(), size
+
+    def _upload_file(self, job_id, access_token, advertiser_id, video_name, spool, signature, size):
+        multipart = MultipartFile(
+            {"advertiser_id": advertiser_id, "upload_type": "UPLOAD_BY_FILE", "video_signature": signature,
+             "file_name": video_name},
+            "video_file", (video_name or "video") + ".mp4", spool,
+        )
+        multipart.on_read = self._progress(job_id, "uploading", len(multipart))
+        self._update(job_id, phase="uploading", bytes_done=0, bytes_total=len(multipart))
+        try:
+            body = self._post(access_token, data=multipart, content_type=multipart.content_type)
+        finally:
+            multipart.close()
+        with self._lock:
+            self._counters["bytes_uploaded"] += size
+        return body
+
+    # ---- status ----
+
+    def _interrupted(self, worker):
+        """Whether a job's worker process on this host is gone (jobs of other hosts cannot be checked)."""
+        host, _, pid = worker.rpartition(":")
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return True
+        except PermissionError:
+            return False
+        return False
+
+    def job_status(self, job_id):
+        db = self._connect()
+        db.row_factory = sqlite3.Row
+        try:
+            row = db.execute("SELECT * FROM uploads WHERE job_id = ?", (job_id,)).fetchone()
+        finally:
+            db.row_factory = None
+        if row is None:
+            return None
+        job = dict(row)
+        worker = job.pop("worker")
+        if job["state"] in ("queued", "running") and self._interrupted(worker):
+            self._update(job_id, state="failed", error="The upload was interrupted by a restart",
+                         finished_at=time.time())
+            return self.job_status(job_id)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        job["progress"] = round(job["bytes_done"] / job["bytes_total"], 3) if job["bytes_total"] else None
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {"concurrency": self.concurrency, "active": len(self._tokens), **self._counters}